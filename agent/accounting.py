@@ -0,0 +1,287 @@
+"""
+Module Name:
+  accounting.py
+
+
+Description:
+  Module provides per-device byte accounting with iptables. The Agent keeps
+  its own NETMON_ACCT chain in the filter table, jumped to from the INPUT,
+  OUTPUT and FORWARD chains, with two counting rules per device: one matching
+  packets sent by the device (-s) and one matching packets sent to it (-d).
+
+  Counters of all rules are read with a single iptables-save -c dump per
+  round, instead of walking the chain rule by rule, and rules of devices which
+  appeared or disappeared are installed or removed in one atomic
+  iptables-restore --noflush batch. Separate RX and TX totals are kept per
+  IPv4 address, across rule re-creation and counter resets.
+
+  It needs root and the iptables-save/iptables-restore commands.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import re
+import subprocess
+import threading
+import traceback
+from datetime import datetime
+
+
+# Accounting chain in the filter table.
+CHAIN = 'NETMON_ACCT'
+
+# Built-in chains, which jump to the accounting chain.
+HOOKS = ('INPUT', 'OUTPUT', 'FORWARD')
+
+IPTABLES_SAVE = 'iptables-save'
+IPTABLES_RESTORE = 'iptables-restore'
+
+# Time (s) an iptables command may run.
+COMMAND_TIMEOUT = 10
+
+# Shared accounting engine, see start_accounting function.
+engine = None
+
+
+
+
+
+def parse_dump(output, chain = CHAIN):
+  """
+  Function parses iptables-save -c output of the filter table.
+
+  Arguments:
+  - output: iptables-save output.
+  - chain: Accounting chain name.
+
+  Returns Tuple (counters, hooks). Counters is a dictionary, key is IPv4
+  address and value is a dictionary with rx_bytes, rx_packets, tx_bytes and
+  tx_packets keys; hooks is a set of built-in chains jumping to chain.
+  """
+
+  rule_re = re.compile(r'^\[(\d+):(\d+)\] -A ' + re.escape(chain) +
+                       r' (-s|-d) (\d+\.\d+\.\d+\.\d+)(?:/32)?\s*$')
+  jump_re = re.compile(r'^(?:\[\d+:\d+\] )?-A (\S+) -j ' + re.escape(chain) + r'\s*$')
+
+  counters = {}
+  hooks = set()
+  for line in output.splitlines():
+    match = rule_re.match(line)
+    if match is not None:
+      packets, octets, direction, ip_addr = match.groups()
+      # Device sends packets with its address as source.
+      prefix = 'tx_' if direction == '-s' else 'rx_'
+      entry = counters.setdefault(ip_addr, {'rx_bytes': 0, 'rx_packets': 0, 'tx_bytes': 0, 'tx_packets': 0})
+      entry[prefix + 'bytes'] += int(octets)
+      entry[prefix + 'packets'] += int(packets)
+      continue
+
+    match = jump_re.match(line)
+    if match is not None:
+      hooks.add(match.group(1))
+
+  return (counters, hooks)
+
+
+
+
+
+def rule_lines(ip_addr, action, chain = CHAIN):
+  """
+  Function returns iptables-restore lines, which append (action '-A') or
+  delete (action '-D') counting rules of given IPv4 address.
+  """
+
+  return ['%s %s -s %s/32' % (action, chain, ip_addr),
+          '%s %s -d %s/32' % (action, chain, ip_addr)]
+
+
+
+
+
+class Accounting(object):
+  """
+  Per-IPv4 address byte accounting engine.
+  """
+
+  def __init__(self, chain = CHAIN):
+    self.chain = chain
+    # IPv4 addresses with counting rules, as of the last dump or change.
+    self.installed = set()
+    # Last read rule counters and accumulated totals by IPv4 address.
+    self.last = {}
+    self.totals = {}
+    self.lock = threading.Lock()
+    self.stats = {'dumps': 0, 'batches': 0, 'added': 0, 'removed': 0, 'resets': 0}
+
+
+  def run(self, args, data = None):
+    """
+    Method runs an iptables command and returns its standard output. Raises
+    OSError if command is missing and subprocess.CalledProcessError if it
+    fails.
+    """
+
+    result = subprocess.run(args, input = data, stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                            universal_newlines = True, timeout = COMMAND_TIMEOUT, check = True)
+    return result.stdout
+
+
+  def restore(self, lines):
+    """
+    Method applies rule changes of the filter table in one atomic batch.
+    """
+
+    self.run([IPTABLES_RESTORE, '--noflush'], '\n'.join(['*filter'] + lines + ['COMMIT', '']))
+    self.stats['batches'] += 1
+
+
+  def dump(self):
+    self.stats['dumps'] += 1
+    return parse_dump(self.run([IPTABLES_SAVE, '-c', '-t', 'filter']), self.chain)
+
+
+  def setup(self):
+    """
+    Method creates the accounting chain, or empties it if it exists, and
+    hooks it into built-in chains, which do not jump to it yet.
+    """
+
+    counters, hooks = self.dump()
+    # Chain declaration flushes an existing chain even with --noflush.
+    lines = [':%s - [0:0]' % self.chain]
+    for hook in HOOKS:
+      if hook not in hooks:
+        lines.append('-I %s 1 -j %s' % (hook, self.chain))
+
+    with self.lock:
+      self.restore(lines)
+      self.installed = set()
+      self.last = {}
+
+
+  def sync(self, ip_addrs):
+    """
+    Method installs counting rules of new IPv4 addresses and removes rules of
+    addresses, which are not in given list, in one batch. Totals of removed
+    addresses are kept.
+
+    Returns Tuple (number of added addresses, number of removed addresses).
+    """
+
+    wanted = set(ip_addrs)
+    with self.lock:
+      added = sorted(wanted - self.installed)
+      removed = sorted(self.installed - wanted)
+      if not added and not removed:
+        return (0, 0)
+
+      lines = []
+      for ip_addr in removed:
+        lines.extend(rule_lines(ip_addr, '-D', self.chain))
+      for ip_addr in added:
+        lines.extend(rule_lines(ip_addr, '-A', self.chain))
+
+      self.restore(lines)
+      self.installed = wanted
+      for ip_addr in removed:
+        self.last.pop(ip_addr, None)
+      self.stats['added'] += len(added)
+      self.stats['removed'] += len(removed)
+
+    return (len(added), len(removed))
+
+
+  def read(self):
+    """
+    Method reads counters of all rules with one dump and adds their increase
+    since the previous read to the totals. A counter, which went back (rule
+    was re-created or counters were zeroed), is counted from zero.
+
+    Returns a dictionary, key is IPv4 address and value is a dictionary of
+    total rx_bytes, rx_packets, tx_bytes and tx_packets.
+    """
+
+    counters, hooks = self.dump()
+
+    with self.lock:
+      # Rules may have been changed by somebody else.
+      self.installed = set(counters)
+      for ip_addr, values in counters.items():
+        last = self.last.get(ip_addr, {})
+        total = self.totals.setdefault(ip_addr, {'rx_bytes': 0, 'rx_packets': 0, 'tx_bytes': 0, 'tx_packets': 0})
+        for key, value in values.items():
+          delta = value - last.get(key, 0)
+          if delta < 0:
+            delta = value
+            self.stats['resets'] += 1
+          total[key] += delta
+        self.last[ip_addr] = values
+
+      return dict((ip_addr, dict(total)) for ip_addr, total in self.totals.items())
+
+
+  def get_totals(self):
+    """
+    Method returns totals of the last read, see read method.
+    """
+
+    with self.lock:
+      return dict((ip_addr, dict(total)) for ip_addr, total in self.totals.items())
+
+
+  def teardown(self):
+    """
+    Method removes the hooks and the accounting chain.
+    """
+
+    counters, hooks = self.dump()
+    lines = ['-D %s -j %s' % (hook, self.chain) for hook in sorted(hooks)]
+    lines += ['-F %s' % self.chain, '-X %s' % self.chain]
+    with self.lock:
+      self.restore(lines)
+      self.installed = set()
+
+
+
+
+
+def start_accounting():
+  """
+  Function creates the shared accounting engine and sets up its chain.
+
+  Returns the engine or None if iptables cannot be used (e.g., not root or
+  iptables is not installed).
+  """
+
+  global engine
+
+  new_engine = Accounting()
+  try:
+    new_engine.setup()
+  except (OSError, subprocess.SubprocessError) as e:
+    utc_time_now = str(datetime.utcnow())
+    print('[' + utc_time_now + '] ' + 'Byte accounting is not available: %s' % e)
+    return None
+  except Exception:
+    traceback.print_exc()
+    return None
+
+  engine = new_engine
+  return engine
+
+
+
+
+
+def get_engine():
+  """
+  Function returns the shared accounting engine or None if it is not
+  running.
+  """
+
+  return engine
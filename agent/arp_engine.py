@@ -0,0 +1,415 @@
+"""
+Module Name:
+  arp_engine.py
+
+
+Description:
+  Module provides a native ARP request/reply engine on top of Linux AF_PACKET
+  raw sockets. Request frames are pre-built per interface, the kernel drops
+  everything but ARP replies with a BPF filter and replies are parsed with
+  struct into (IPv4 address, MAC address) tuples, so no Scapy packets are
+  created on the hot path.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import ctypes
+import fcntl
+import socket
+import struct
+import time
+
+
+ETH_P_ARP = 0x0806
+ETH_P_IP = 0x0800
+ARP_REQUEST = 1
+ARP_REPLY = 2
+
+# From <asm-generic/socket.h> and <linux/sockios.h>, Python socket module
+# does not export them.
+SO_ATTACH_FILTER = 26
+SIOCGIFADDR = 0x8915
+
+BROADCAST_MAC = b'\xff' * 6
+ZERO_MAC = b'\x00' * 6
+
+# Interval (s) between two attempts to take a request from a budget.
+BUDGET_WAIT = 0.01
+
+# Ethernet header followed by an ARP header for IPv4 over Ethernet.
+ARP_FRAME = struct.Struct('!6s6sHHHBBH6s4s6s4s')
+ARP_FRAME_LEN = ARP_FRAME.size
+
+# Classic BPF instructions as (code, jt, jf, k).
+BPF_LD_H_ABS = 0x28
+BPF_JEQ_K = 0x15
+BPF_RET_K = 0x06
+
+# Accept ARP replies only:
+#   ldh [12]             ; EtherType
+#   jeq #0x806, 0, 3
+#   ldh [20]             ; ARP opcode
+#   jeq #2, 0, 1
+#   ret #0x40000
+#   ret #0
+ARP_REPLY_FILTER = [
+  (BPF_LD_H_ABS, 0, 0, 12),
+  (BPF_JEQ_K, 0, 3, ETH_P_ARP),
+  (BPF_LD_H_ABS, 0, 0, 20),
+  (BPF_JEQ_K, 0, 1, ARP_REPLY),
+  (BPF_RET_K, 0, 0, 0x40000),
+  (BPF_RET_K, 0, 0, 0),
+]
+
+# Accept every ARP packet (requests, replies and gratuitous ARP).
+ARP_ANY_FILTER = [
+  (BPF_LD_H_ABS, 0, 0, 12),
+  (BPF_JEQ_K, 0, 1, ETH_P_ARP),
+  (BPF_RET_K, 0, 0, 0x40000),
+  (BPF_RET_K, 0, 0, 0),
+]
+
+
+# Cache of open ARP sockets, key is network interface name.
+arp_sockets = {}
+
+
+
+
+
+def attach_filter(sock, instructions):
+  """
+  Function attaches a classic BPF program to the given socket, so the kernel
+  drops unwanted packets before they are copied to user space.
+
+  Arguments:
+  - sock: A socket object.
+  - instructions: A list of (code, jt, jf, k) tuples.
+
+  Returns the ctypes buffer holding the program, the caller may keep it
+  alongside the socket.
+  """
+
+  program = b''.join(struct.pack('HBBI', *ins) for ins in instructions)
+  buf = ctypes.create_string_buffer(program)
+  fprog = struct.pack('HL', len(instructions), ctypes.addressof(buf))
+  sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+  return buf
+
+
+
+
+
+def format_mac(mac_bytes):
+  """
+  Function returns MAC address bytes in aa:bb:cc:dd:ee:ff format.
+  """
+  return '%02x:%02x:%02x:%02x:%02x:%02x' % tuple(mac_bytes)
+
+
+
+
+
+def parse_arp_frame(frame):
+  """
+  Function parses an Ethernet frame which carries an ARP packet.
+
+  Arguments:
+  - frame: Raw Ethernet frame (bytes).
+
+  Returns Tuple (opcode, sender IPv4, sender MAC, target IPv4) or None if frame
+  is not an IPv4 over Ethernet ARP packet.
+  """
+
+  if len(frame) < ARP_FRAME_LEN:
+    return None
+
+  (eth_dst, eth_src, eth_type, htype, ptype, hlen, plen, opcode,
+   sha, spa, tha, tpa) = ARP_FRAME.unpack_from(frame)
+
+  if eth_type != ETH_P_ARP or ptype != ETH_P_IP or hlen != 6 or plen != 4:
+    return None
+
+  return (opcode, socket.inet_ntoa(spa), format_mac(sha), socket.inet_ntoa(tpa))
+
+
+
+
+
+class ArpSocket(object):
+  """
+  AF_PACKET socket bound to one network interface, which sends pre-built ARP
+  requests and receives ARP replies.
+  """
+
+  def __init__(self, iface, src_ip = None, bpf_filter = ARP_REPLY_FILTER):
+    """
+    Arguments:
+    - iface: Network interface name.
+    - src_ip: IPv4 address used as ARP sender address. By default it is the
+      first IPv4 address of the interface.
+    - bpf_filter: BPF program attached to the socket. By default only ARP
+      replies are accepted.
+    """
+
+    self.iface = iface
+    # Socket of protocol 0 receives nothing until it is bound, so no frame is
+    # queued before the filter is attached.
+    self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+    try:
+      # Replies of a whole sweep are queued while requests are being sent.
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+      self._filter = attach_filter(self.sock, bpf_filter)
+      self.sock.bind((iface, ETH_P_ARP))
+    except:
+      self.sock.close()
+      raise
+
+    self.mac = self.sock.getsockname()[4][:6]
+    if src_ip is None:
+      src_ip = get_iface_ipv4(iface)
+    self.src_ip = src_ip
+
+    # Everything but the target protocol address is the same for all
+    # requests sent on this interface.
+    self._prefix = ARP_FRAME.pack(BROADCAST_MAC, self.mac, ETH_P_ARP, 1, ETH_P_IP, 6, 4,
+                                  ARP_REQUEST, self.mac, socket.inet_aton(src_ip),
+                                  ZERO_MAC, b'\x00' * 4)[:-4]
+    self._frames = {}
+
+
+  def fileno(self):
+    return self.sock.fileno()
+
+
+  def close(self):
+    self.sock.close()
+
+
+  def request_frame(self, ip_addr):
+    """
+    Method returns ARP request frame for the given IPv4 address. Frames are
+    built once and cached.
+    """
+
+    frame = self._frames.get(ip_addr)
+    if frame is None:
+      frame = self._prefix + socket.inet_aton(ip_addr)
+      self._frames[ip_addr] = frame
+
+    return frame
+
+
+  def send_request(self, ip_addr):
+    self.sock.send(self.request_frame(ip_addr))
+
+
+  def send_requests(self, ip_list, packet_rate = 0, budget = None):
+    """
+    Method sends ARP requests for given IPv4 addresses.
+
+    Arguments:
+    - ip_list: A list of IPv4 addresses.
+    - packet_rate: Maximum number of requests per second. If it is 0 or None
+      requests are sent as fast as possible.
+    - budget: Rate limiter with take(count) method (e.g., a governor budget),
+      which every request waits for, or None.
+
+    Returns number of sent requests.
+    """
+
+    inter = 0
+    if packet_rate:
+      inter = 1.0 / float(packet_rate)
+
+    start = time.time()
+    sent = 0
+    for ip_addr in ip_list:
+      while budget is not None and not budget.take(1):
+        time.sleep(BUDGET_WAIT)
+
+      try:
+        self.send_request(ip_addr)
+        sent += 1
+      except BlockingIOError:
+        pass
+
+      if inter:
+        # Pace against the start time, so sleep granularity does not add up.
+        delay = start + sent * inter - time.time()
+        if delay > 0:
+          time.sleep(delay)
+
+    return sent
+
+
+  def recv_reply(self, timeout = None):
+    """
+    Method waits for one ARP packet.
+
+    Arguments:
+    - timeout: Timeout (s). If it is None method blocks.
+
+    Returns Tuple (opcode, sender IPv4, sender MAC, target IPv4), None if
+    received frame is not a valid ARP packet, or raises socket.timeout.
+    """
+
+    self.sock.settimeout(timeout)
+    frame, address = self.sock.recvfrom(2048)
+
+    # Packet socket sees our own outgoing requests as well.
+    if address[2] == socket.PACKET_OUTGOING:
+      return None
+
+    return parse_arp_frame(frame)
+
+
+  def collect_replies(self, ip_set, timeout):
+    """
+    Method collects ARP replies for the given IPv4 addresses until timeout
+    expires or every address replied.
+
+    Arguments:
+    - ip_set: A set of requested IPv4 addresses.
+    - timeout: Time (s) to wait for replies.
+
+    Returns a set of (IPv4 address, MAC address) tuples.
+    """
+
+    live_devices = set()
+    answered = set()
+    deadline = time.time() + timeout
+
+    while len(answered) < len(ip_set):
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+
+      try:
+        reply = self.recv_reply(remaining)
+      except socket.timeout:
+        break
+
+      if not reply or reply[0] != ARP_REPLY:
+        continue
+
+      ip_addr = reply[1]
+      if ip_addr in ip_set:
+        answered.add(ip_addr)
+        live_devices.add((ip_addr, reply[2]))
+
+    return live_devices
+
+
+  def sweep(self, ip_list, timeout = 3, packet_rate = 0, budget = None):
+    """
+    Method sends ARP requests for all given IPv4 addresses and collects the
+    replies.
+
+    Arguments:
+    - ip_list: A list of IPv4 addresses.
+    - timeout: Time (s) to wait for replies after the last request was sent.
+    - packet_rate: Maximum number of requests per second.
+    - budget: See send_requests method.
+
+    Returns a set of (IPv4 address, MAC address) tuples.
+    """
+
+    self.drain()
+    self.send_requests(ip_list, packet_rate, budget)
+    return self.collect_replies(set(ip_list), timeout)
+
+
+  def recv_pending(self, limit = 1024):
+    """
+    Method reads ARP packets which are already queued on the socket, without
+    blocking.
+
+    Arguments:
+    - limit: Maximum number of frames read in one call.
+
+    Returns a list of (opcode, sender IPv4, sender MAC, target IPv4) tuples.
+    """
+
+    packets = []
+    self.sock.setblocking(False)
+    try:
+      for i in range(limit):
+        frame, address = self.sock.recvfrom(2048)
+        if address[2] == socket.PACKET_OUTGOING:
+          continue
+        packet = parse_arp_frame(frame)
+        if packet:
+          packets.append(packet)
+    except (BlockingIOError, socket.timeout):
+      pass
+
+    return packets
+
+
+  def drain(self):
+    """
+    Method discards replies which are already queued on the socket.
+    """
+
+    self.sock.setblocking(False)
+    try:
+      while 1:
+        self.sock.recv(2048)
+    except (BlockingIOError, socket.timeout):
+      pass
+    finally:
+      self.sock.setblocking(True)
+
+
+
+
+
+def get_iface_ipv4(iface):
+  """
+  Function returns the first IPv4 address of given network interface.
+  """
+
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    ifreq = struct.pack('256s', iface.encode()[:15])
+    res = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, ifreq)
+  finally:
+    sock.close()
+
+  return socket.inet_ntoa(res[20:24])
+
+
+
+
+
+def get_arp_socket(iface):
+  """
+  Function returns cached ArpSocket of given network interface. It opens a new
+  one if there is no cached socket.
+  """
+
+  arp_socket = arp_sockets.get(iface)
+  if arp_socket is None:
+    arp_socket = ArpSocket(iface)
+    arp_sockets[iface] = arp_socket
+
+  return arp_socket
+
+
+
+
+
+def close_arp_socket(iface):
+  """
+  Function closes and forgets cached ArpSocket of given network interface.
+  """
+
+  arp_socket = arp_sockets.pop(iface, None)
+  if arp_socket is not None:
+    arp_socket.close()
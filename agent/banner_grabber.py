@@ -0,0 +1,287 @@
+"""
+Module Name:
+  banner_grabber.py
+
+
+Description:
+  Module provides a service banner grabber for open TCP ports. It connects to
+  ports with bounded concurrency, reads the first bytes the service sends
+  (or answers to an HTTP request, if the service waits for the client) and
+  matches them against a compiled signature set. Fingerprints are cached in
+  the open_ports table per (MAC address, port), see db module, so every
+  service is fingerprinted once and again only after its port closed and
+  reopened or the device's IPv4 address changed. Ports, which fail to
+  connect, are retried with growing delay and cached as SERVICE_UNKNOWN
+  after GRAB_ATTEMPTS failures.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import asyncio
+import re
+import time
+import traceback
+from datetime import datetime
+
+import db
+import governor
+
+
+# Service of a port, which sent data not matching any signature or nothing.
+SERVICE_UNKNOWN = 'unknown'
+
+# Request sent to services, which wait for the client to speak first.
+HTTP_PROBE = b'GET / HTTP/1.0\r\n\r\n'
+
+# Packets and bytes charged to the governor per port: handshake, request,
+# reply and teardown.
+GRAB_PACKETS = 6
+GRAB_PACKET_SIZE = 120
+
+# Maximum number of characters of stored banner.
+BANNER_LENGTH = 128
+
+# Number of failed connections after which a port is cached as
+# SERVICE_UNKNOWN, and delay (s) before the first retry, doubled after every
+# further failure.
+GRAB_ATTEMPTS = 3
+GRAB_RETRY = 60.0
+
+# Signatures as (service, pattern). Patterns are matched at the beginning of
+# received data in this order and the first group, if any, is the product.
+SIGNATURES = [
+  ('ssh', rb'SSH-[\d.]+-([^\r\n ]+)'),
+  ('http', rb'HTTP/1\.[01] \d{3}(?s:.*?)\r\n(?i:server): *([^\r\n]+)'),
+  ('http', rb'HTTP/1\.[01] \d{3}'),
+  ('rtsp', rb'RTSP/1\.0 \d{3}'),
+  ('ftp', rb'220[ -][^\r\n]*(?i:ftp)'),
+  ('smtp', rb'220[ -][^\r\n]*(?i:smtp|mail)'),
+  ('pop3', rb'\+OK'),
+  ('imap', rb'\* OK'),
+  ('vnc', rb'RFB (\d{3}\.\d{3})'),
+  ('mysql', rb'(?s:.{4})\x0a(\d[\w.-]*)\x00'),
+  ('telnet', rb'\xff[\xfb-\xfe]'),
+  ('tls', rb'\x15\x03[\x00-\x04]'),
+  ('redis', rb'-(?:ERR|NOAUTH|DENIED) '),
+]
+
+# One alternation of all signatures, so data is matched in a single pass.
+# Group s<index> tells which signature matched.
+SIGNATURE_RE = re.compile(b'|'.join(b'(?P<s%d>%s)' % (i, pattern) for i, (service, pattern) in enumerate(SIGNATURES)))
+SIGNATURE_PATTERNS = [re.compile(pattern) for service, pattern in SIGNATURES]
+
+# Failed ports as (MAC address, IPv4 address, port): (failures, monotonic time
+# of the next attempt).
+grab_failures = {}
+
+
+
+
+
+def identify(data):
+  """
+  Function matches received data against signatures.
+
+  Returns a tuple (service, product). Product is None if signature does not
+  tell it.
+  """
+
+  match = SIGNATURE_RE.match(data)
+  if match is None:
+    return (SERVICE_UNKNOWN, None)
+
+  index = int(match.lastgroup[1:])
+  product = None
+  groups = SIGNATURE_PATTERNS[index].match(data).groups()
+  if groups:
+    product = groups[0].decode('latin-1').strip()
+
+  return (SIGNATURES[index][0], product)
+
+
+
+
+
+def banner_text(data):
+  """
+  Function returns printable first line of received data.
+  """
+
+  line = data.split(b'\n', 1)[0].decode('latin-1')
+  return ''.join(c if ' ' <= c <= '~' else '.' for c in line.rstrip('\r'))[:BANNER_LENGTH]
+
+
+
+
+
+class BannerGrabber(object):
+  """
+  Asynchronous TCP banner grabber.
+  """
+
+  def __init__(self, concurrency = 32, timeout = 3.0, read_bytes = 512):
+    """
+    Arguments:
+    - concurrency: Maximum number of connections in flight.
+    - timeout: Time (s) given to one port. The first half is spent waiting
+      for the service to send a banner, the rest waiting for a reply to
+      HTTP_PROBE.
+    - read_bytes: Maximum number of bytes read from one port.
+    """
+
+    self.concurrency = max(1, int(concurrency))
+    self.timeout = float(timeout)
+    self.read_bytes = int(read_bytes)
+    # Agent-wide packet rate governor (see governor module) or None.
+    self.governor = governor.get_governor()
+    self.gate = None
+    self.stats = {'ports': 0, 'identified': 0, 'unknown': 0, 'failed': 0}
+
+
+  async def read(self, reader, timeout):
+    try:
+      return await asyncio.wait_for(reader.read(self.read_bytes), timeout)
+    except (asyncio.TimeoutError, OSError):
+      return b''
+
+
+  async def grab(self, ip_addr, port):
+    """
+    Method reads the first bytes of a service.
+
+    Returns received data (possibly empty) or None if connection failed.
+    """
+
+    try:
+      reader, writer = await asyncio.wait_for(asyncio.open_connection(ip_addr, port), self.timeout)
+    except (asyncio.TimeoutError, OSError):
+      return None
+
+    try:
+      data = await self.read(reader, self.timeout / 2)
+      if not data and not reader.at_eof():
+        writer.write(HTTP_PROBE)
+        data = await self.read(reader, self.timeout / 2)
+    except OSError:
+      data = b''
+    finally:
+      writer.close()
+
+    return data
+
+
+  async def scan(self, targets, on_result, on_failure = None):
+    """
+    Method fingerprints given ports.
+
+    Arguments:
+    - targets: A list of (MAC address, IPv4 address, port) tuples.
+    - on_result: Function called with (MAC address, IPv4 address, port,
+      service, banner) of every port, which accepted connection.
+    - on_failure: Function called with (MAC address, IPv4 address, port) of
+      every port, which failed to connect, or None.
+    """
+
+    pending = iter(targets)
+    self.gate = asyncio.Lock()
+
+    async def worker():
+      for device_mac, device_ip, port in pending:
+        try:
+          if self.governor is not None:
+            async with self.gate:
+              await self.governor.wait(self.governor.get_iface(device_ip), GRAB_PACKETS,
+                                       GRAB_PACKET_SIZE, governor.PRIORITY_FINGERPRINT)
+          data = await self.grab(device_ip, port)
+          self.stats['ports'] += 1
+          if data is None:
+            self.stats['failed'] += 1
+            if on_failure is not None:
+              on_failure(device_mac, device_ip, port)
+            continue
+
+          service, product = identify(data)
+          self.stats['unknown' if service == SERVICE_UNKNOWN else 'identified'] += 1
+          on_result(device_mac, device_ip, port, service, product or banner_text(data))
+        except Exception:
+          traceback.print_exc()
+
+    await asyncio.gather(*[worker() for i in range(min(self.concurrency, len(targets)))])
+
+
+  def run(self, targets, on_result, on_failure = None):
+    """
+    Method runs scan on a new event loop in the calling thread and returns
+    when all ports are fingerprinted.
+    """
+
+    loop = asyncio.new_event_loop()
+    try:
+      asyncio.set_event_loop(loop)
+      loop.run_until_complete(self.scan(list(targets), on_result, on_failure))
+    finally:
+      asyncio.set_event_loop(None)
+      loop.close()
+
+
+
+
+
+def grab_devices(db_connection, options = None):
+  """
+  Function fingerprints open TCP ports, which are not in the cache yet (see
+  db.get_unidentified_ports function), and stores results on the database.
+  Ports, which failed to connect, are tried again after GRAB_RETRY seconds,
+  doubled after every failure, and stored as SERVICE_UNKNOWN after
+  GRAB_ATTEMPTS failures, so a filtered service does not cost a connection
+  every round.
+
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - options: A dictionary (e.g., command line data). Used keys are
+    banner_concurrency and banner_timeout.
+
+  Returns the grabber or None if there was nothing to fingerprint.
+  """
+
+  now = time.monotonic()
+  unidentified = db.get_unidentified_ports(db_connection, 'tcp')
+
+  # Forget failures of ports, which closed, got identified or moved to
+  # another IPv4 address.
+  for target in set(grab_failures) - set(unidentified):
+    del grab_failures[target]
+
+  targets = [target for target in unidentified if target not in grab_failures or grab_failures[target][1] <= now]
+  if not targets:
+    return None
+
+  options = options or {}
+  grabber = BannerGrabber(options.get('banner_concurrency') or 32,
+                          options.get('banner_timeout') or 3.0)
+
+  results = []
+  def store(device_mac, device_ip, port, service, banner):
+    results.append((device_mac, device_ip, port, service, banner))
+
+  def fail(device_mac, device_ip, port):
+    target = (device_mac, device_ip, port)
+    failures = grab_failures.get(target, (0, now))[0] + 1
+    if failures >= GRAB_ATTEMPTS:
+      grab_failures.pop(target, None)
+      results.append((device_mac, device_ip, port, SERVICE_UNKNOWN, None))
+    else:
+      grab_failures[target] = (failures, time.monotonic() + GRAB_RETRY * 2 ** (failures - 1))
+
+  grabber.run(targets, store, fail)
+  db.set_port_services(db_connection, 'tcp', results)
+
+  utc_time_now = str(datetime.utcnow())
+  print('[' + utc_time_now + '] ' + 'Fingerprinted %d TCP ports (%d identified, %d unknown, %d failed)' %
+        (grabber.stats['ports'], grabber.stats['identified'], grabber.stats['unknown'], grabber.stats['failed']))
+
+  return grabber
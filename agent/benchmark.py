@@ -0,0 +1,720 @@
+#!/usr/bin/env python3
+
+"""
+Module name:
+  benchmark.py
+
+
+Description:
+  Module provides benchmarks of the Agent's probe engines. Benchmarks build
+  their own test bed (veth pairs and network namespaces), so they must be run
+  as root on Linux and must not be run on a production interface.
+
+  Usage:
+    sudo python3 benchmark.py arp --hosts 200 --rounds 5
+    python3 benchmark.py scheduler --prefix 16 --duration 600
+    python3 benchmark.py tcp --hosts 200 --ports 1-512 --open 5
+    sudo python3 benchmark.py syn --hosts 200 --ports 1-512 --open 5 --rate 0
+    python3 benchmark.py flows --packets 1000000 --flows 5000
+    sudo python3 benchmark.py capture --workers 0,1,2,4 --senders 4 --backends socket,ring
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import sys
+import time
+import random
+import argparse
+import resource
+import tracemalloc
+import subprocess
+import socket
+import struct
+import os
+import tempfile
+
+import arp_engine
+import db
+import fanout_capture
+import flow_capture
+import heavy_hitters
+import ip_traffic
+import pcap
+import prefix_classifier
+import probe_scheduler
+import tcp_scanner
+import syn_scanner
+import tpacket_ring
+
+
+BENCH_NETNS = 'netmon-bench'
+BENCH_IFACE = 'nmbench0'
+BENCH_PEER_IFACE = 'nmbench1'
+BENCH_SUBNET = '10.213.0.'
+# Loopback network of the TCP listener farm.
+BENCH_LOOPBACK = '127.213.'
+
+
+
+
+
+def run_cmd(cmd, stdin = None):
+  """
+  Function runs given command and raises an exception if it fails.
+  """
+  subprocess.run(cmd, shell = True, check = True, input = stdin, stdout = subprocess.DEVNULL)
+
+
+
+
+
+def setup_veth_testbed(hosts):
+  """
+  Function creates a veth pair. One end stays in the current namespace and has
+  <BENCH_SUBNET>1/24 address, the other end is moved into a separate network
+  namespace and answers ARP requests for <hosts> addresses.
+
+  Arguments:
+  - hosts: Number of addresses behind the peer interface (at most 253).
+
+  Returns a list of IPv4 addresses which are up.
+  """
+
+  teardown_veth_testbed()
+  hosts = min(int(hosts), 253)
+
+  run_cmd('ip netns add %s' % BENCH_NETNS)
+  run_cmd('ip link add %s type veth peer name %s' % (BENCH_IFACE, BENCH_PEER_IFACE))
+  run_cmd('ip link set %s netns %s' % (BENCH_PEER_IFACE, BENCH_NETNS))
+  run_cmd('ip addr add %s1/24 dev %s' % (BENCH_SUBNET, BENCH_IFACE))
+  run_cmd('ip link set %s up' % BENCH_IFACE)
+
+  ip_list = [BENCH_SUBNET + str(i) for i in range(2, hosts + 2)]
+  batch = ''.join('addr add %s/24 dev %s\n' % (ip, BENCH_PEER_IFACE) for ip in ip_list)
+  batch += 'link set %s up\n' % BENCH_PEER_IFACE
+  run_cmd('ip -n %s -batch -' % BENCH_NETNS, stdin = batch.encode())
+
+  # Give link some time to come up.
+  time.sleep(1)
+
+  return ip_list
+
+
+
+
+
+def teardown_veth_testbed():
+  subprocess.run('ip link del %s' % BENCH_IFACE, shell = True, stderr = subprocess.DEVNULL)
+  subprocess.run('ip netns del %s' % BENCH_NETNS, shell = True, stderr = subprocess.DEVNULL)
+
+
+
+
+
+def measure(func, *args):
+  """
+  Function calls func(*args) and measures wall clock and CPU time.
+
+  Returns Tuple (result, wall time (s), CPU time (s)).
+  """
+
+  usage_start = resource.getrusage(resource.RUSAGE_SELF)
+  start = time.perf_counter()
+  result = func(*args)
+  wall = time.perf_counter() - start
+  usage_end = resource.getrusage(resource.RUSAGE_SELF)
+  cpu = ((usage_end.ru_utime - usage_start.ru_utime) +
+         (usage_end.ru_stime - usage_start.ru_stime))
+
+  return result, wall, cpu
+
+
+
+
+
+def print_result(name, packets, found, wall, cpu):
+  pps = packets / wall if wall else 0
+  cpu_pct = 100.0 * cpu / wall if wall else 0
+  print('%-10s packets: %6d  found: %5d  wall: %7.3f s  pps: %10.1f  cpu: %6.3f s (%5.1f %%)' %
+        (name, packets, found, wall, pps, cpu, cpu_pct))
+
+
+
+
+
+def sweep_native(ip_list, timeout):
+  arp_socket = arp_engine.ArpSocket(BENCH_IFACE)
+  try:
+    return arp_socket.sweep(ip_list, timeout)
+  finally:
+    arp_socket.close()
+
+
+
+
+
+def sweep_scapy(ip_list, timeout):
+  from scapy.all import srp, Ether, ARP
+
+  answered, unanswered = srp(Ether(dst = "ff:ff:ff:ff:ff:ff") / ARP(pdst = ip_list),
+                             iface = BENCH_IFACE, timeout = timeout, verbose = False)
+  return set((r.sprintf(r"%ARP.psrc%"), r.sprintf(r"%Ether.src%")) for s, r in answered)
+
+
+
+
+
+def benchmark_arp(args):
+  """
+  Function compares native (AF_PACKET) and Scapy ARP backends. Both backends
+  sweep the same addresses and wait at most args.timeout seconds for replies.
+  """
+
+  ip_list = setup_veth_testbed(args.hosts)
+  # Add some addresses which never answer.
+  ip_list += [BENCH_SUBNET + str(i) for i in range(len(ip_list) + 2, 255)]
+
+  backends = [('native', sweep_native), ('scapy', sweep_scapy)]
+  try:
+    for name, sweep in backends:
+      try:
+        for i in range(args.rounds):
+          found, wall, cpu = measure(sweep, ip_list, args.timeout)
+          print_result(name, len(ip_list), len(found), wall, cpu)
+      except ImportError:
+        print('%-10s skipped, backend is not installed' % name)
+  finally:
+    teardown_veth_testbed()
+
+
+
+
+
+def benchmark_scheduler(args):
+  """
+  Function runs ProbeScheduler on a simulated clock over a 10.0.0.0/<prefix>
+  network, where args.live percent of addresses answer every probe, and reports
+  setup time, CPU time per simulated second, probe rate, time needed to find
+  all live hosts and peak memory.
+  """
+
+  subnet = '10.0.0.0/%d' % args.prefix
+  now = 1000.0
+  budget = probe_scheduler.TokenBucket(args.rate, args.rate * args.tick)
+  budget.last = now
+
+  tracemalloc.start()
+  scheduler, setup_wall, setup_cpu = measure(probe_scheduler.ProbeScheduler, subnet, (), 2.5, 60, 600, args.tick, budget, now)
+
+  random.seed(1)
+  live = set(random.sample(range(scheduler.size), int(scheduler.size * args.live / 100.0)))
+  live = set(scheduler.address(index) for index in live)
+  found = set()
+  all_found_at = None
+
+  def run():
+    nonlocal now, all_found_at
+    probes = 0
+    end = now + args.duration
+    while now < end:
+      now += args.tick
+      due = scheduler.due(now)
+      probes += len(due)
+      for ip_addr in due:
+        if ip_addr in live:
+          scheduler.mark_seen(ip_addr, now)
+          found.add(ip_addr)
+      if all_found_at is None and len(found) == len(live):
+        all_found_at = now - 1000.0
+    return probes
+
+  probes, wall, cpu = measure(run)
+  current, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  print('prefix:            /%d (%d addresses, %d live)' % (args.prefix, scheduler.size, len(live)))
+  print('setup:             %.3f s wall, %.3f s cpu' % (setup_wall, setup_cpu))
+  print('simulated:         %d s, %.3f s wall, %.3f s cpu (%.2f ms cpu per simulated s)' %
+        (args.duration, wall, cpu, 1000.0 * cpu / args.duration))
+  print('probes:            %d (%.1f pps, budget %.1f pps)' % (probes, probes / float(args.duration), args.rate))
+  print('all live found:    %s' % ('after %.1f s' % all_found_at if all_found_at is not None else 'no'))
+  print('memory:            %.2f MB current, %.2f MB peak' % (current / 1048576.0, peak / 1048576.0))
+
+
+
+
+
+def start_listener_farm(hosts, ports, open_count):
+  """
+  Function starts a listener farm on loopback addresses <BENCH_LOOPBACK>x.y.
+  Every host listens on open_count ports randomly chosen from ports, all other
+  ports are closed. Kernel completes handshakes, so nothing has to accept
+  connections.
+
+  Returns Tuple (list of (MAC, IPv4) devices, dictionary of open ports by
+  IPv4, list of listening sockets).
+  """
+
+  random.seed(1)
+  devices = []
+  expected = {}
+  sockets = []
+  for i in range(hosts):
+    ip_addr = BENCH_LOOPBACK + '%d.%d' % (i // 250, i % 250 + 1)
+    mac_addr = '02:00:00:00:%02x:%02x' % (i // 256, i % 256)
+    devices.append((mac_addr, ip_addr))
+    expected[ip_addr] = sorted(random.sample(ports, min(open_count, len(ports))))
+    for port in expected[ip_addr]:
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      sock.bind((ip_addr, port))
+      sock.listen(1024)
+      sockets.append(sock)
+
+  return devices, expected, sockets
+
+
+
+
+
+def scan_nmap(devices, port_spec):
+  import port_scanner
+
+  if port_scanner.nmap_port_scan is None:
+    raise ImportError('nmap')
+
+  return dict((ip_addr, sorted(port_scanner.scan_tcp_range(ip_addr, port_spec))) for mac_addr, ip_addr in devices)
+
+
+
+
+
+def benchmark_tcp(args):
+  """
+  Function measures full-fleet TCP port scan time of the native asyncio
+  scanner against a loopback listener farm and, if args.nmap_hosts is set and
+  nmap is installed, per-device nmap scans of the first args.nmap_hosts devices
+  (extrapolated to the whole fleet).
+  """
+
+  # Every listening socket and connection attempt needs a file descriptor.
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+  ports = tcp_scanner.parse_ports(args.ports)
+  devices, expected, sockets = start_listener_farm(args.hosts, ports, args.open)
+  probes = len(devices) * len(ports)
+
+  try:
+    for i in range(args.rounds):
+      found = {}
+      scanner = tcp_scanner.TcpScanner(args.concurrency, args.host_concurrency, args.timeout)
+      result, wall, cpu = measure(scanner.run, devices, ports,
+                                  lambda mac_addr, ip_addr, open_ports: found.__setitem__(ip_addr, open_ports))
+      print_result('native', probes, sum(len(p) for p in found.values()), wall, cpu)
+      if found != expected:
+        print('native     result differs from expected open ports')
+
+    if args.nmap_hosts:
+      subset = devices[:args.nmap_hosts]
+      try:
+        found, wall, cpu = measure(scan_nmap, subset, args.ports)
+        print_result('nmap', len(subset) * len(ports), sum(len(p) for p in found.values()), wall, cpu)
+        print('nmap       extrapolated to %d hosts: %.1f s' % (len(devices), wall * len(devices) / len(subset)))
+      except ImportError:
+        print('%-10s skipped, backend is not installed' % 'nmap')
+  finally:
+    for sock in sockets:
+      sock.close()
+
+
+
+
+
+# Listener farm run inside the test bed network namespace. It reads
+# "<IPv4> <port>" lines from stdin, listens on them, prints "ready" and sleeps
+# until stdin is closed.
+NETNS_LISTENER = """
+import socket, sys
+socks = []
+for line in sys.stdin:
+  if not line.strip():
+    break
+  ip, port = line.split()
+  s = socket.socket()
+  s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  s.bind((ip, int(port)))
+  s.listen(1024)
+  socks.append(s)
+print('ready', flush = True)
+sys.stdin.read()
+"""
+
+
+
+
+
+def start_netns_listeners(ip_list, ports, open_count):
+  """
+  Function starts listeners on open_count randomly chosen ports of every
+  address in the test bed network namespace.
+
+  Returns Tuple (listener process, dictionary of open ports by IPv4).
+  """
+
+  random.seed(1)
+  expected = {}
+  lines = []
+  for ip_addr in ip_list:
+    expected[ip_addr] = sorted(random.sample(ports, min(open_count, len(ports))))
+    lines.extend('%s %d\n' % (ip_addr, port) for port in expected[ip_addr])
+
+  process = subprocess.Popen(['ip', 'netns', 'exec', BENCH_NETNS, sys.executable, '-c', NETNS_LISTENER],
+                             stdin = subprocess.PIPE, stdout = subprocess.PIPE, universal_newlines = True)
+  process.stdin.write(''.join(lines) + '\n')
+  process.stdin.flush()
+  process.stdout.readline()
+
+  return process, expected
+
+
+
+
+
+def benchmark_syn(args):
+  """
+  Function measures SYN scanner throughput (ports per second, including the
+  wait for late replies) on a veth/netns test bed, and the asyncio connect
+  scanner on the same test bed for comparison.
+  """
+
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+  ports = tcp_scanner.parse_ports(args.ports)
+  ip_list = setup_veth_testbed(args.hosts)
+  process, expected = start_netns_listeners(ip_list, ports, args.open)
+  probes = len(ip_list) * len(ports)
+
+  try:
+    for i in range(args.rounds):
+      found = dict((ip_addr, set()) for ip_addr in ip_list)
+
+      def on_reply(ip_addr, port, is_open):
+        if is_open:
+          found[ip_addr].add(port)
+
+      scanner = syn_scanner.SynScanner(args.rate, args.wait)
+      try:
+        result, wall, cpu = measure(scanner.scan, ip_list, ports, on_reply)
+      finally:
+        scanner.close()
+      found = dict((ip_addr, sorted(p)) for ip_addr, p in found.items())
+      print_result('syn', probes, sum(len(p) for p in found.values()), wall, cpu)
+      print('syn        replies: %d open, %d closed, %d invalid' %
+            (scanner.stats['open'], scanner.stats['closed'], scanner.stats['invalid']))
+      if found != expected:
+        print('syn        result differs from expected open ports')
+
+    found = {}
+    devices = [('', ip_addr) for ip_addr in ip_list]
+    scanner = tcp_scanner.TcpScanner(args.concurrency, args.host_concurrency, args.wait)
+    result, wall, cpu = measure(scanner.run, devices, ports,
+                                lambda mac_addr, ip_addr, open_ports: found.__setitem__(ip_addr, open_ports))
+    print_result('connect', probes, sum(len(p) for p in found.values()), wall, cpu)
+  finally:
+    process.stdin.close()
+    process.wait()
+    teardown_veth_testbed()
+
+
+
+
+
+def build_frames(packets, flows, rate):
+  """
+  Function builds synthetic Ethernet frames of TCP and UDP flows between
+  10.213.0.0/24 hosts and external addresses. Every tenth flow is VLAN
+  tagged.
+
+  Arguments:
+  - packets: Number of frames.
+  - flows: Number of distinct flows.
+  - rate: Packets per second of frame timestamps.
+
+  Yields (timestamp (s), frame) tuples.
+  """
+
+  rng = random.Random(1)
+  templates = []
+  for i in range(flows):
+    src = socket.inet_aton(BENCH_SUBNET + str(rng.randint(2, 254)))
+    dst = struct.pack('!I', rng.randint(0x01000000, 0xdfffffff))
+    if i % 2:
+      src, dst = dst, src
+    proto = socket.IPPROTO_TCP if i % 3 else socket.IPPROTO_UDP
+    ports = struct.pack('!HH', rng.randint(1024, 65535), rng.choice((53, 80, 123, 443, 502, 8080)))
+    ethernet = b'\x02\x00\x00\x00\x00\x01\x02\x00\x00\x00\x00\x02'
+    if i % 10 == 0:
+      ethernet += struct.pack('!HH', flow_capture.ETH_P_8021Q, i % 4094 + 1)
+    ethernet += struct.pack('!H', flow_capture.ETH_P_IP)
+    templates.append((ethernet, proto, src, dst, ports))
+
+  start = time.time()
+  for i in range(packets):
+    ethernet, proto, src, dst, ports = templates[rng.randrange(flows)]
+    length = rng.choice((40, 52, 64, 576, 1400))
+    header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + length, i & 0xffff, 0, 64, proto, 0, src, dst)
+    yield (start + i / float(rate), ethernet + header + ports + bytes(length - 4))
+
+
+
+
+
+def benchmark_flows(args):
+  """
+  Function replays a pcap file (a synthetic one, if args.pcap is not given)
+  through the flow capture pipeline: frame parsing, flow table, local/not
+  local classification, top talkers and batched database writes every
+  args.interval seconds of capture time (see ip_traffic.store_flows
+  function). Storing every
+  packet with its own INSERT and commit is measured on the first
+  args.baseline packets for comparison.
+  """
+
+  work_dir = tempfile.mkdtemp(prefix = 'netmon-bench-')
+  path = args.pcap
+  if not path:
+    path = os.path.join(work_dir, 'flows.pcap')
+    pcap.write_pcap(path, build_frames(args.packets, args.flows, args.rate))
+
+  db_connection = db.init_database(os.path.join(work_dir, 'flows.db'))
+
+  def read():
+    count = 0
+    for ts, length, frame in pcap.read_pcap(path):
+      count += 1
+    return count
+
+  def parse():
+    count = 0
+    for ts, length, frame in pcap.read_pcap(path):
+      if flow_capture.parse_frame(frame) is not None:
+        count += 1
+    return count
+
+  # Rows of old captures are kept.
+  retention = time.time()
+  classifier = prefix_classifier.PrefixClassifier()
+  classifier.set_interfaces(args.local.split(','))
+
+  def pipeline():
+    table = flow_capture.FlowTable()
+    talkers = heavy_hitters.HeavyHitters()
+    parse_frame = flow_capture.parse_frame
+    count = 0
+    flushes = 0
+    deadline = None
+    for ts, length, frame in pcap.read_pcap(path):
+      count += 1
+      if deadline is None:
+        deadline = ts + args.interval
+      elif ts >= deadline:
+        ip_traffic.store_flows(db_connection, table.drain(), classifier, retention, talkers, ts)
+        flushes += 1
+        deadline = ts + args.interval
+      key = parse_frame(frame)
+      if key is not None:
+        table.add(key, length, ts)
+    ip_traffic.store_flows(db_connection, table.drain(), classifier, retention, talkers, ts)
+    return (count, flushes + 1)
+
+  def per_packet():
+    count = 0
+    for ts, length, frame in pcap.read_pcap(path):
+      if count >= args.baseline:
+        break
+      key = flow_capture.parse_frame(frame)
+      if key is not None:
+        db.insert_ip_traffic_data(db_connection, {'ts': int(ts * 1000), 'src': socket.inet_ntoa(key[0]),
+                                                  'dst': socket.inet_ntoa(key[1]), 'not_local_ip': ''})
+      count += 1
+    return count
+
+  try:
+    packets, wall, cpu = measure(read)
+    print_result('read', packets, packets, wall, cpu)
+    parsed, wall, cpu = measure(parse)
+    print_result('parse', packets, parsed, wall, cpu)
+
+    (packets, flushes), wall, cpu = measure(pipeline)
+    rows = db_connection.execute('SELECT COUNT(*) FROM flow_data').fetchone()[0]
+    print_result('pipeline', packets, rows, wall, cpu)
+    print('pipeline   flushes: %d  flow rows: %d  max RSS: %.2f MB' %
+          (flushes, rows, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+    if args.baseline:
+      packets, wall, cpu = measure(per_packet)
+      print_result('per-packet', packets, packets, wall, cpu)
+  finally:
+    db_connection.close()
+    for name in os.listdir(work_dir):
+      os.remove(os.path.join(work_dir, name))
+    os.rmdir(work_dir)
+
+
+
+
+
+NETNS_SENDER = """
+import socket, sys, time
+duration, flows, dst = float(sys.argv[1]), int(sys.argv[2]), sys.argv[3]
+socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in range(flows)]
+payload = bytes(18)
+sent = 0
+end = time.monotonic() + duration
+while time.monotonic() < end:
+  for s in socks:
+    for i in range(64):
+      s.sendto(payload, (dst, 9))
+  sent += 64 * flows
+print(sent, flush = True)
+"""
+
+
+
+
+
+def benchmark_capture(args):
+  """
+  Function measures capture throughput on a veth pair with args.senders
+  processes in the test bed namespace sending small UDP datagrams as fast as
+  they can, captured by the Agent process (0 workers) and by N fanout
+  workers for every N in args.workers, with every backend in args.backends
+  (plain socket and memory-mapped ring). Captured packets are counted from
+  the flow table, so the result includes parsing and aggregation.
+  """
+
+  setup_veth_testbed(1)
+  dst = BENCH_SUBNET + '1'
+  ring = {'block_size': tpacket_ring.BLOCK_SIZE, 'frame_count': tpacket_ring.FRAME_COUNT,
+          'retire_timeout': tpacket_ring.RETIRE_TIMEOUT}
+  rounds = [(backend, int(workers)) for backend in args.backends.split(',')
+            for workers in args.workers.split(',')]
+  try:
+    for backend, workers in rounds:
+      if workers:
+        capture = fanout_capture.FanoutCapture([BENCH_IFACE], [dst], workers,
+                                               ring = ring if backend == 'ring' else None)
+      elif backend == 'ring':
+        capture = tpacket_ring.RingCapture([BENCH_IFACE], [dst], **ring)
+      else:
+        capture = flow_capture.FlowCapture([BENCH_IFACE], [dst])
+      capture.open()
+      usage_start = resource.getrusage(resource.RUSAGE_SELF)
+
+      senders = [subprocess.Popen(['ip', 'netns', 'exec', BENCH_NETNS, sys.executable, '-c', NETNS_SENDER,
+                                   str(args.duration), str(args.flows), dst],
+                                  stdout = subprocess.PIPE, universal_newlines = True)
+                 for i in range(args.senders)]
+
+      start = time.perf_counter()
+      while any(process.poll() is None for process in senders):
+        capture.poll(0.1)
+      wall = time.perf_counter() - start
+      usage_end = resource.getrusage(resource.RUSAGE_SELF)
+      # Workers send their flow tables every second.
+      end = time.monotonic() + (fanout_capture.WORKER_INTERVAL + 0.5 if workers else 0.2)
+      while time.monotonic() < end:
+        capture.poll(0.1)
+      capture.close()
+
+      sent = sum(int(process.stdout.read() or 0) for process in senders)
+      captured = sum(entry[1] for key, entry in capture.table.flows.items() if key[4] == 9)
+      cpu = ((usage_end.ru_utime - usage_start.ru_utime) +
+             (usage_end.ru_stime - usage_start.ru_stime))
+      print('%-6s workers: %d  sent: %9d  captured: %9d (%5.1f %%)  wall: %7.3f s  captured pps: %10.1f  agent cpu: %6.3f s' %
+            (backend, workers, sent, captured, 100.0 * captured / sent if sent else 0,
+             wall, captured / wall, cpu))
+  finally:
+    teardown_veth_testbed()
+
+
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Agent probe engines benchmarks')
+  subparsers = parser.add_subparsers(dest = 'benchmark')
+
+  arp_parser = subparsers.add_parser('arp', help = 'Native vs Scapy ARP sweep over a veth pair')
+  arp_parser.add_argument('--hosts', type = int, default = 200, help = 'Number of live hosts')
+  arp_parser.add_argument('--rounds', type = int, default = 5, help = 'Number of sweeps per backend')
+  arp_parser.add_argument('--timeout', type = float, default = 1, help = 'Reply timeout (s)')
+  arp_parser.set_defaults(func = benchmark_arp)
+
+  scheduler_parser = subparsers.add_parser('scheduler', help = 'Adaptive probe scheduler on a simulated clock')
+  scheduler_parser.add_argument('--prefix', type = int, default = 16, help = 'Prefix length of simulated network')
+  scheduler_parser.add_argument('--live', type = float, default = 2, help = 'Percent of live hosts')
+  scheduler_parser.add_argument('--rate', type = float, default = 1000, help = 'Probe budget (pps)')
+  scheduler_parser.add_argument('--tick', type = float, default = 0.25, help = 'Scheduler round (s)')
+  scheduler_parser.add_argument('--duration', type = int, default = 600, help = 'Simulated time (s)')
+  scheduler_parser.set_defaults(func = benchmark_scheduler)
+
+  tcp_parser = subparsers.add_parser('tcp', help = 'Asyncio TCP connect scanner against a loopback listener farm')
+  tcp_parser.add_argument('--hosts', type = int, default = 200, help = 'Number of devices')
+  tcp_parser.add_argument('--ports', type = str, default = '1-512', help = 'Port set')
+  tcp_parser.add_argument('--open', type = int, default = 5, help = 'Number of open ports per device')
+  tcp_parser.add_argument('--rounds', type = int, default = 3, help = 'Number of full-fleet scans')
+  tcp_parser.add_argument('--concurrency', type = int, default = 512, help = 'Connection attempts in flight')
+  tcp_parser.add_argument('--host_concurrency', type = int, default = 32, help = 'Connection attempts in flight per device')
+  tcp_parser.add_argument('--timeout', type = float, default = 1, help = 'Connection attempt timeout (s)')
+  tcp_parser.add_argument('--nmap_hosts', type = int, default = 0, help = 'Number of devices scanned with nmap')
+  tcp_parser.set_defaults(func = benchmark_tcp)
+
+  syn_parser = subparsers.add_parser('syn', help = 'Raw SYN scanner over a veth pair')
+  syn_parser.add_argument('--hosts', type = int, default = 200, help = 'Number of devices')
+  syn_parser.add_argument('--ports', type = str, default = '1-512', help = 'Port set')
+  syn_parser.add_argument('--open', type = int, default = 5, help = 'Number of open ports per device')
+  syn_parser.add_argument('--rounds', type = int, default = 3, help = 'Number of full-fleet scans')
+  syn_parser.add_argument('--rate', type = float, default = 0, help = 'SYN packets per second, 0 is unlimited')
+  syn_parser.add_argument('--wait', type = float, default = 1, help = 'Wait for late replies (s)')
+  syn_parser.add_argument('--concurrency', type = int, default = 512, help = 'Connect scanner attempts in flight')
+  syn_parser.add_argument('--host_concurrency', type = int, default = 32, help = 'Connect scanner attempts in flight per device')
+  syn_parser.set_defaults(func = benchmark_syn)
+
+  flows_parser = subparsers.add_parser('flows', help = 'Flow capture pipeline replaying a pcap file')
+  flows_parser.add_argument('--pcap', type = str, default = '', help = 'Pcap file, a synthetic one is built by default')
+  flows_parser.add_argument('--packets', type = int, default = 1000000, help = 'Number of synthetic packets')
+  flows_parser.add_argument('--flows', type = int, default = 5000, help = 'Number of synthetic flows')
+  flows_parser.add_argument('--rate', type = float, default = 100000, help = 'Packets per second of synthetic capture')
+  flows_parser.add_argument('--interval', type = float, default = 1, help = 'Flush interval (s) of capture time')
+  flows_parser.add_argument('--local', type = str, default = BENCH_SUBNET + '1/24',
+                            help = 'Comma separated local networks of the capture')
+  flows_parser.add_argument('--baseline', type = int, default = 20000, help = 'Number of packets stored one by one')
+  flows_parser.set_defaults(func = benchmark_flows)
+
+  capture_parser = subparsers.add_parser('capture', help = 'Packet capture with and without fanout workers over a veth pair')
+  capture_parser.add_argument('--workers', type = str, default = '0,1,2,4', help = 'Comma separated numbers of capture workers')
+  capture_parser.add_argument('--backends', type = str, default = 'socket,ring', help = 'Comma separated capture backends')
+  capture_parser.add_argument('--senders', type = int, default = 4, help = 'Number of sender processes')
+  capture_parser.add_argument('--flows', type = int, default = 64, help = 'Number of UDP flows per sender')
+  capture_parser.add_argument('--duration', type = float, default = 5, help = 'Sending time (s) per round')
+  capture_parser.set_defaults(func = benchmark_capture)
+
+  args = parser.parse_args(sys.argv[1:])
+  if not getattr(args, 'func', None):
+    parser.print_help()
+    sys.exit(1)
+
+  args.func(args)
+
+
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,9 @@ import json
 import argparse
 
 import utils
+import prefix_classifier
+import tcp_scanner
+import udp_scanner
 
 
 
@@ -47,6 +50,106 @@ def ParseArguments():
     Use repeatedly.
   --uuid: (optional) If this is provided then as a unique ID of device will be UUID,
     otherwise value of SHA1(hostname).
+  --sweep_interval: (optional) Interval (s) between two ARP sweeps of the same
+    subnet. By default it is set 2.5.
+  --arp_rate: (optional) Maximum number of ARP requests per second sent in one
+    sweep. By default it is set 200.
+  --arp_backend: (optional) ARP engine, 'native' (AF_PACKET raw socket) or
+    'scapy'. By default it is set 'native'.
+  --discovery_mode: (optional) 'active' sweeps whole subnet every round,
+    'passive' learns devices from ARP traffic and kernel neighbor table and
+    probes only stale addresses, 'adaptive' learns devices passively and
+    probes them with an adaptive scheduler, which scales to large prefixes.
+    Prefixes shorter than /24 always use adaptive mode. By default it is set
+    'active'.
+  --staleness: (optional) Time (s) after which a silent address is probed in
+    passive discovery mode, and first back-off interval of silent addresses
+    in adaptive mode. By default it is set 60.
+  --dead_max: (optional) Maximum back-off interval (s) of silent addresses in
+    adaptive discovery mode. By default it is set 600.
+  --probe_pps: (optional) Maximum number of probe packets per second sent by
+    all probe engines (device discovery, port scanners, banner grabber)
+    together. By default it is set 0 (unlimited).
+  --probe_bps: (optional) Maximum number of probe bytes per second sent by
+    all probe engines together. By default it is set 0 (unlimited).
+  --iface_pps: (optional) Maximum number of probe packets per second sent on
+    one network interface. By default it is set 0 (unlimited).
+  --iface_bps: (optional) Maximum number of probe bytes per second sent on
+    one network interface. By default it is set 0 (unlimited).
+  --name_resolution: (optional) Comma separated list of device name resolution
+    methods, tried in given order: 'dns' (reverse DNS), 'mdns' and 'netbios'.
+    By default it is set 'dns'.
+  --resolver_concurrency: (optional) Maximum number of devices resolved at the
+    same time. By default it is set 16.
+  --hostname_ttl: (optional) Time (s) a resolved device name is cached. By
+    default it is set 3600.
+  --negative_hostname_ttl: (optional) Time (s) a failed name resolution is
+    cached. By default it is set 300.
+  --scan_ports: (optional) Enable periodic port scanning of discovered devices.
+  --port_backend: (optional) TCP port scanner, 'native' (asyncio connect
+    scanner), 'syn' (raw SYN scanner, needs root) or 'nmap'. By default it is
+    set 'native'.
+  --tcp_ports: (optional) TCP port set to be scanned, e.g., '1-1024,8080'. By
+    default it is set '1-512'.
+  --scan_concurrency: (optional) Maximum number of TCP connection attempts in
+    flight. By default it is set 512.
+  --scan_host_concurrency: (optional) Maximum number of TCP connection attempts
+    in flight to a single device. By default it is set 32.
+  --scan_timeout: (optional) Time (s) after which an unanswered connection
+    attempt is considered filtered. By default it is set 1.
+  --syn_rate: (optional) Maximum number of SYN packets per second sent by the
+    SYN scanner. By default it is set 2000.
+  --rescan_interval: (optional) Interval (s) between two port scans of a
+    stable device. New devices and devices whose IP address changed are
+    scanned first. By default it is set 3600.
+  --scan_stale: (optional) Devices not seen for more than scan_stale seconds
+    are not port scanned and not accounted. By default it is set 480.
+  --udp_ports: (optional) UDP port set to be probed. Ports with a known
+    protocol (DNS, NTP, SNMP, Modbus, ...) get a protocol specific payload.
+    An empty string disables UDP scanning. By default it is set to all ports
+    with a known payload.
+  --udp_concurrency: (optional) Maximum number of UDP probes in flight. By
+    default it is set 256.
+  --udp_host_rate: (optional) Maximum number of UDP probes per second sent to
+    one device. By default it is set 10.
+  --udp_timeout: (optional) Time (s) to wait for a reply to a UDP probe. By
+    default it is set 2.
+  --udp_retries: (optional) Number of retransmissions of unanswered UDP
+    probes. By default it is set 1.
+  --grab_banners: (optional) Fingerprint services of open TCP ports by their
+    banners. Every port is fingerprinted once, until it closes or the
+    device's IP address changes.
+  --banner_concurrency: (optional) Maximum number of banner grabbing
+    connections in flight. By default it is set 32.
+  --banner_timeout: (optional) Time (s) given to one port by the banner
+    grabber. By default it is set 3.
+  --flow_interval: (optional) Interval (s) between two batched writes of
+    aggregated IP traffic flows. By default it is set 10.
+  --flow_retention: (optional) Time (s) flow records are kept on the
+    database. By default it is set 3600.
+  --capture_workers: (optional) Number of packet capture worker processes.
+    Workers share network interfaces' packets by flow hash (PACKET_FANOUT),
+    so capture scales with CPU cores. By default it is set 0, packets are
+    captured by the Agent process.
+  --capture_backend: (optional) Packet capture backend, 'socket' (one
+    recvfrom call per packet) or 'ring' (TPACKET_V3 memory-mapped ring, no
+    system call or copy per packet). By default it is set 'socket'.
+  --ring_block_size: (optional) Block size (bytes) of capture rings. By
+    default it is set 1048576.
+  --ring_frames: (optional) Number of 2 KiB frame slots of a capture ring. By
+    default it is set 8192.
+  --ring_retire_timeout: (optional) Time (ms) after which a capture ring
+    block, which is not full, is handed over. By default it is set 60.
+  --top_talkers: (optional) Number of top external talkers reported to the
+    server. By default it is set 10.
+  --talkers_half_life: (optional) Time (s) after which traffic counted for a
+    talker is halved. By default it is set 300.
+  --site_prefixes: (optional) Comma separated prefixes of local networks
+    besides subnets of the monitored interfaces, e.g., '10.0.0.0/8'. By
+    default there are none.
+  --ignore_prefixes: (optional) Comma separated prefixes, whose traffic is
+    not monitored, in addition to unspecified, loopback, multicast and
+    broadcast addresses. By default there are none.
 
   Returns:
     A dictionary that contains provided arguments.
@@ -64,6 +167,48 @@ def ParseArguments():
   parser.add_argument("--external_timeout", required = False, help = "Maximum time (s) an external command is allowed to run", default = None)
   parser.add_argument("--external_command", required = False, help = "Periodically invoke given command to gather external data. Use repeatedly.", action = 'append', default = [])
   parser.add_argument("--uuid", required = False, help = "To get UUID or hostname (set by default) as an unique ID.", action = 'store_true')
+  parser.add_argument("--sweep_interval", required = False, help = "Interval (s) between two ARP sweeps of the same subnet", default = None)
+  parser.add_argument("--arp_rate", required = False, help = "Maximum number of ARP requests per second", default = None)
+  parser.add_argument("--arp_backend", required = False, help = "ARP engine", choices = ['native', 'scapy'], default = None)
+  parser.add_argument("--discovery_mode", required = False, help = "Device discovery mode", choices = ['active', 'passive', 'adaptive'], default = None)
+  parser.add_argument("--staleness", required = False, help = "Time (s) after which a silent address is probed in passive mode", default = None)
+  parser.add_argument("--dead_max", required = False, help = "Maximum back-off interval (s) of silent addresses in adaptive mode", default = None)
+  parser.add_argument("--probe_pps", required = False, help = "Maximum number of probe packets per second of all probe engines", default = None)
+  parser.add_argument("--probe_bps", required = False, help = "Maximum number of probe bytes per second of all probe engines", default = None)
+  parser.add_argument("--iface_pps", required = False, help = "Maximum number of probe packets per second on one network interface", default = None)
+  parser.add_argument("--iface_bps", required = False, help = "Maximum number of probe bytes per second on one network interface", default = None)
+  parser.add_argument("--name_resolution", required = False, help = "Device name resolution methods, e.g., 'dns, mdns, netbios'", type = str, default = None)
+  parser.add_argument("--resolver_concurrency", required = False, help = "Maximum number of devices resolved at the same time", default = None)
+  parser.add_argument("--hostname_ttl", required = False, help = "Time (s) a resolved device name is cached", default = None)
+  parser.add_argument("--negative_hostname_ttl", required = False, help = "Time (s) a failed name resolution is cached", default = None)
+  parser.add_argument("--scan_ports", required = False, help = "Enable periodic port scanning of discovered devices", action = 'store_true')
+  parser.add_argument("--port_backend", required = False, help = "TCP port scanner", choices = ['native', 'syn', 'nmap'], default = None)
+  parser.add_argument("--tcp_ports", required = False, help = "TCP port set to be scanned, e.g., '1-1024,8080'", type = str, default = None)
+  parser.add_argument("--scan_concurrency", required = False, help = "Maximum number of TCP connection attempts in flight", default = None)
+  parser.add_argument("--scan_host_concurrency", required = False, help = "Maximum number of TCP connection attempts in flight to a single device", default = None)
+  parser.add_argument("--scan_timeout", required = False, help = "TCP connection attempt timeout (s)", default = None)
+  parser.add_argument("--syn_rate", required = False, help = "Maximum number of SYN packets per second", default = None)
+  parser.add_argument("--rescan_interval", required = False, help = "Interval (s) between two port scans of a stable device", default = None)
+  parser.add_argument("--scan_stale", required = False, help = "Devices not seen for more than given time (s) are not port scanned", default = None)
+  parser.add_argument("--udp_ports", required = False, help = "UDP port set to be probed, e.g., '53,123,161'", type = str, default = None)
+  parser.add_argument("--udp_concurrency", required = False, help = "Maximum number of UDP probes in flight", default = None)
+  parser.add_argument("--udp_host_rate", required = False, help = "Maximum number of UDP probes per second sent to one device", default = None)
+  parser.add_argument("--udp_timeout", required = False, help = "Time (s) to wait for a reply to a UDP probe", default = None)
+  parser.add_argument("--udp_retries", required = False, help = "Number of retransmissions of unanswered UDP probes", default = None)
+  parser.add_argument("--grab_banners", required = False, help = "Fingerprint services of open TCP ports by their banners", action = 'store_true')
+  parser.add_argument("--banner_concurrency", required = False, help = "Maximum number of banner grabbing connections in flight", default = None)
+  parser.add_argument("--banner_timeout", required = False, help = "Time (s) given to one port by the banner grabber", default = None)
+  parser.add_argument("--flow_interval", required = False, help = "Interval (s) between two batched writes of IP traffic flows", default = None)
+  parser.add_argument("--flow_retention", required = False, help = "Time (s) flow records are kept on the database", default = None)
+  parser.add_argument("--capture_workers", required = False, help = "Number of packet capture worker processes", default = None)
+  parser.add_argument("--capture_backend", required = False, help = "Packet capture backend", choices = ['socket', 'ring'], default = None)
+  parser.add_argument("--ring_block_size", required = False, help = "Block size (bytes) of capture rings", default = None)
+  parser.add_argument("--ring_frames", required = False, help = "Number of frame slots of a capture ring", default = None)
+  parser.add_argument("--ring_retire_timeout", required = False, help = "Time (ms) after which a capture ring block is handed over", default = None)
+  parser.add_argument("--top_talkers", required = False, help = "Number of top external talkers reported to the server", default = None)
+  parser.add_argument("--talkers_half_life", required = False, help = "Time (s) after which traffic counted for a talker is halved", default = None)
+  parser.add_argument("--site_prefixes", required = False, help = "Comma separated prefixes of local networks, e.g., '10.0.0.0/8'", type = str, default = None)
+  parser.add_argument("--ignore_prefixes", required = False, help = "Comma separated prefixes, whose traffic is not monitored", type = str, default = None)
 
   argv = parser.parse_args(sys.argv[1:])
 
@@ -102,6 +247,182 @@ def ParseArguments():
   config_data['substation_name'] = argv.substation_name
   config_data['uuid'] = argv.uuid
 
+  if argv.sweep_interval is not None:
+    config_data['sweep_interval'] = argv.sweep_interval
+  config_data['sweep_interval'] = float(config_data.get('sweep_interval', 2.5))
+
+  if argv.arp_rate is not None:
+    config_data['arp_rate'] = argv.arp_rate
+  config_data['arp_rate'] = float(config_data.get('arp_rate', 200))
+
+  if argv.arp_backend is not None:
+    config_data['arp_backend'] = argv.arp_backend
+  config_data['arp_backend'] = config_data.get('arp_backend', 'native')
+
+  if argv.discovery_mode is not None:
+    config_data['discovery_mode'] = argv.discovery_mode
+  config_data['discovery_mode'] = config_data.get('discovery_mode', 'active')
+
+  if argv.staleness is not None:
+    config_data['staleness'] = argv.staleness
+  config_data['staleness'] = float(config_data.get('staleness', 60))
+
+  if argv.dead_max is not None:
+    config_data['dead_max'] = argv.dead_max
+  config_data['dead_max'] = float(config_data.get('dead_max', 600))
+
+  for key in ['probe_pps', 'probe_bps', 'iface_pps', 'iface_bps']:
+    if getattr(argv, key) is not None:
+      config_data[key] = getattr(argv, key)
+    config_data[key] = float(config_data.get(key, 0))
+
+  methods = argv.name_resolution or config_data.get('name_resolution', ['dns'])
+  if isinstance(methods, str):
+    methods = methods.split(',')
+  methods = [method.strip() for method in methods if method.strip()]
+  for method in methods:
+    if method not in ['dns', 'mdns', 'netbios']:
+      print('Error: unknown name resolution method %s' % method)
+      sys.exit()
+  config_data['name_resolution'] = methods
+
+  if argv.resolver_concurrency is not None:
+    config_data['resolver_concurrency'] = argv.resolver_concurrency
+  config_data['resolver_concurrency'] = int(config_data.get('resolver_concurrency', 16))
+
+  if argv.hostname_ttl is not None:
+    config_data['hostname_ttl'] = argv.hostname_ttl
+  config_data['hostname_ttl'] = float(config_data.get('hostname_ttl', 3600))
+
+  if argv.negative_hostname_ttl is not None:
+    config_data['negative_hostname_ttl'] = argv.negative_hostname_ttl
+  config_data['negative_hostname_ttl'] = float(config_data.get('negative_hostname_ttl', 300))
+
+  config_data['scan_ports'] = argv.scan_ports or config_data.get('scan_ports', False)
+
+  if argv.port_backend is not None:
+    config_data['port_backend'] = argv.port_backend
+  config_data['port_backend'] = config_data.get('port_backend', 'native')
+
+  if argv.tcp_ports is not None:
+    config_data['tcp_ports'] = argv.tcp_ports
+  config_data['tcp_ports'] = str(config_data.get('tcp_ports', '1-512'))
+  try:
+    tcp_scanner.parse_ports(config_data['tcp_ports'])
+  except ValueError:
+    print('Error: invalid TCP port set %s' % config_data['tcp_ports'])
+    sys.exit()
+
+  if argv.scan_concurrency is not None:
+    config_data['scan_concurrency'] = argv.scan_concurrency
+  config_data['scan_concurrency'] = int(config_data.get('scan_concurrency', 512))
+
+  if argv.scan_host_concurrency is not None:
+    config_data['scan_host_concurrency'] = argv.scan_host_concurrency
+  config_data['scan_host_concurrency'] = int(config_data.get('scan_host_concurrency', 32))
+
+  if argv.scan_timeout is not None:
+    config_data['scan_timeout'] = argv.scan_timeout
+  config_data['scan_timeout'] = float(config_data.get('scan_timeout', 1))
+
+  if argv.syn_rate is not None:
+    config_data['syn_rate'] = argv.syn_rate
+  config_data['syn_rate'] = float(config_data.get('syn_rate', 2000))
+
+  if argv.rescan_interval is not None:
+    config_data['rescan_interval'] = argv.rescan_interval
+  config_data['rescan_interval'] = float(config_data.get('rescan_interval', 3600))
+
+  if argv.scan_stale is not None:
+    config_data['scan_stale'] = argv.scan_stale
+  config_data['scan_stale'] = float(config_data.get('scan_stale', 480))
+
+  if argv.udp_ports is not None:
+    config_data['udp_ports'] = argv.udp_ports
+  config_data['udp_ports'] = str(config_data.get('udp_ports', udp_scanner.DEFAULT_PORTS))
+  try:
+    tcp_scanner.parse_ports(config_data['udp_ports'])
+  except ValueError:
+    print('Error: invalid UDP port set %s' % config_data['udp_ports'])
+    sys.exit()
+
+  if argv.udp_concurrency is not None:
+    config_data['udp_concurrency'] = argv.udp_concurrency
+  config_data['udp_concurrency'] = int(config_data.get('udp_concurrency', 256))
+
+  if argv.udp_host_rate is not None:
+    config_data['udp_host_rate'] = argv.udp_host_rate
+  config_data['udp_host_rate'] = float(config_data.get('udp_host_rate', 10))
+
+  if argv.udp_timeout is not None:
+    config_data['udp_timeout'] = argv.udp_timeout
+  config_data['udp_timeout'] = float(config_data.get('udp_timeout', 2))
+
+  if argv.udp_retries is not None:
+    config_data['udp_retries'] = argv.udp_retries
+  config_data['udp_retries'] = int(config_data.get('udp_retries', 1))
+
+  config_data['grab_banners'] = argv.grab_banners or config_data.get('grab_banners', False)
+
+  if argv.banner_concurrency is not None:
+    config_data['banner_concurrency'] = argv.banner_concurrency
+  config_data['banner_concurrency'] = int(config_data.get('banner_concurrency', 32))
+
+  if argv.banner_timeout is not None:
+    config_data['banner_timeout'] = argv.banner_timeout
+  config_data['banner_timeout'] = float(config_data.get('banner_timeout', 3))
+
+  if argv.flow_interval is not None:
+    config_data['flow_interval'] = argv.flow_interval
+  config_data['flow_interval'] = float(config_data.get('flow_interval', 10))
+
+  if argv.flow_retention is not None:
+    config_data['flow_retention'] = argv.flow_retention
+  config_data['flow_retention'] = float(config_data.get('flow_retention', 3600))
+
+  if argv.capture_workers is not None:
+    config_data['capture_workers'] = argv.capture_workers
+  config_data['capture_workers'] = int(config_data.get('capture_workers', 0))
+
+  if argv.capture_backend is not None:
+    config_data['capture_backend'] = argv.capture_backend
+  config_data['capture_backend'] = str(config_data.get('capture_backend', 'socket'))
+  if config_data['capture_backend'] not in ['socket', 'ring']:
+    print('Error: invalid capture backend %s' % config_data['capture_backend'])
+    sys.exit(1)
+
+  if argv.ring_block_size is not None:
+    config_data['ring_block_size'] = argv.ring_block_size
+  config_data['ring_block_size'] = int(config_data.get('ring_block_size', 1048576))
+
+  if argv.ring_frames is not None:
+    config_data['ring_frames'] = argv.ring_frames
+  config_data['ring_frames'] = int(config_data.get('ring_frames', 8192))
+
+  if argv.ring_retire_timeout is not None:
+    config_data['ring_retire_timeout'] = argv.ring_retire_timeout
+  config_data['ring_retire_timeout'] = int(config_data.get('ring_retire_timeout', 60))
+
+  if argv.top_talkers is not None:
+    config_data['top_talkers'] = argv.top_talkers
+  config_data['top_talkers'] = int(config_data.get('top_talkers', 10))
+
+  if argv.talkers_half_life is not None:
+    config_data['talkers_half_life'] = argv.talkers_half_life
+  config_data['talkers_half_life'] = float(config_data.get('talkers_half_life', 300))
+
+  for key in ['site_prefixes', 'ignore_prefixes']:
+    prefixes = getattr(argv, key) or config_data.get(key, [])
+    if isinstance(prefixes, str):
+      prefixes = prefixes.split(',')
+    prefixes = [prefix.strip() for prefix in prefixes if prefix.strip()]
+    try:
+      prefix_classifier.parse_prefixes(prefixes)
+    except ValueError:
+      print('Error: invalid prefix in %s %s' % (key, prefixes))
+      sys.exit()
+    config_data[key] = prefixes
+
   if argv.db_file_path == '':
     if not config_data['db_file_path']:
       config_data['db_file_path'] = '/var/local/agent_sqlite3.db'
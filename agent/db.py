@@ -14,16 +14,51 @@ Authors:
 """
 
 
+import collections
 import sqlite3
+import threading
+import time
+import heavy_hitters
 import utils
+from datetime import datetime
+
+
+# Interval (s) between two batched flushes of devices' last_update.
+DEVICE_FLUSH_INTERVAL = 10
+
+# Interval (s) between two reports of device write statistics.
+DEVICE_STATS_INTERVAL = 300
+
+# Last written (ip, iface, hostname) of devices, key is MAC address. Device row
+# is written only if one of them changes.
+device_state = {}
+
+# last_update values waiting for the next batched flush, key is MAC address.
+pending_last_update = {}
+
+device_write_stats = {'writes': 0, 'avoided': 0, 'flushes': 0, 'flushed_rows': 0}
+device_flush_ts = {'flush': 0, 'stats': 0}
+device_lock = threading.RLock()
+
+# Maximum number of port change events waiting to be sent to the server. The
+# oldest events are dropped first.
+PORT_EVENTS_MAX = 10000
+
+# Port change events, which have not been sent to the server yet.
+port_events = collections.deque(maxlen = PORT_EVENTS_MAX)
+port_lock = threading.RLock()
+
+# Error counters of network interfaces stored next to byte, packet and drop
+# counters, in order of columns of the net_interface_data table.
+IFACE_ERROR_COUNTERS = ('tx_errors', 'tx_fifo_errors', 'rx_errors', 'rx_fifo_errors')
 
 
 
 def init_database(db_filename = "/var/local/monitoring_sqlite3.db"):
   """
   Function establishes connection with sqlite3 database and creates
-  agent_devices, ip_traffic_data, agent_iface_stats, node_log and node_id
-  tables if one of them does not exist.
+  agent_devices, open_ports, ip_traffic_data, flow_data, agent_iface_stats,
+  node_log and node_id tables if one of them does not exist.
 
   Arguments:
   - db_filename: SQLite database file's absolute path. By default it is set
@@ -39,6 +74,9 @@ def init_database(db_filename = "/var/local/monitoring_sqlite3.db"):
 
     # Cleanup database.
     cleanup_db(connection)
+    with device_lock:
+      device_state.clear()
+      pending_last_update.clear()
 
     connection.execute("""
     CREATE TABLE IF NOT EXISTS agent_devices (
@@ -57,6 +95,30 @@ def init_database(db_filename = "/var/local/monitoring_sqlite3.db"):
     """)
 
 
+    # One row per open port of a device, so "which devices expose port X" is
+    # an index lookup and a rescan touches only ports which opened or closed.
+    # service and banner cache the port's fingerprint (see banner_grabber
+    # module) taken at service_ip, so it is dropped with the row when the port
+    # closes and is stale when the device's IP changes.
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS open_ports (
+        mac         TEXT,
+        proto       TEXT,
+        port        INTEGER,
+        first_seen  REAL,
+        last_seen   REAL,
+        service     TEXT,
+        banner      TEXT,
+        service_ip  TEXT,
+        PRIMARY KEY (mac, proto, port)
+    )
+    """)
+
+    connection.execute("""
+    CREATE INDEX IF NOT EXISTS open_ports_port ON open_ports (proto, port)
+    """)
+
+
     connection.execute("""
     CREATE TABLE IF NOT EXISTS ip_traffic_data (
         source_ip      TEXT,
@@ -66,6 +128,26 @@ def init_database(db_filename = "/var/local/monitoring_sqlite3.db"):
     )
     """)
 
+    # Aggregated unidirectional flows, one row per flow and flush interval,
+    # see flow_capture module. Timestamps are Unix epoch milliseconds.
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS flow_data (
+        source_ip      TEXT,
+        destination_ip TEXT,
+        proto          INTEGER,
+        source_port    INTEGER,
+        dest_port      INTEGER,
+        bytes          INTEGER,
+        packets        INTEGER,
+        first_seen     REAL,
+        last_seen      REAL
+    )
+    """)
+
+    connection.execute("""
+    CREATE INDEX IF NOT EXISTS flow_data_last_seen ON flow_data (last_seen)
+    """)
+
     connection.execute("""
     CREATE TABLE IF NOT EXISTS net_interface_data (
         iface       TEXT PRIMARY KEY,
@@ -77,10 +159,21 @@ def init_database(db_filename = "/var/local/monitoring_sqlite3.db"):
         rx_bytes    INTEGER,
         rx_packets  INTEGER,
         rx_dropped  INTEGER,
-        last_update REAL
+        last_update REAL,
+        tx_errors       INTEGER,
+        tx_fifo_errors  INTEGER,
+        rx_errors       INTEGER,
+        rx_fifo_errors  INTEGER
     )
     """)
 
+    # Error counters were added later, so database files of older agents
+    # get the columns here.
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(net_interface_data)')]
+    for column in IFACE_ERROR_COUNTERS:
+      if column not in columns:
+        connection.execute('ALTER TABLE net_interface_data ADD COLUMN %s INTEGER' % column)
+
     connection.execute("""
     CREATE TABLE IF NOT EXISTS node_log (
         year   INTEGER,
@@ -196,12 +289,50 @@ def update_device_data(db_connection, data):
   Function stores or updates visible (discovered) devices data into the database,
   particularly in the agent_devices table.
 
+  Device row is written only if device is new or its IP, network interface or
+  hostname changed. Otherwise only last_update is kept in memory and written
+  by flush_device_updates function in one batched transaction every
+  DEVICE_FLUSH_INTERVAL seconds, which saves an UPDATE and a commit per device
+  and sweep.
+
   Arguments:
   - db_connection: sqlite3 database connection.
   - data: Data is a dictionary and format is
     {'mac': <MAC>, 'ip': <IP>, hostname: <hostname>, 'iface': <iface name>, 'last_update': <unix epoch time>}
   """
 
+  mac = data['mac']
+  state = (data['ip'], data['iface'], data['hostname'])
+
+  with device_lock:
+    if device_state.get(mac) == state:
+      pending_last_update[mac] = data['last_update']
+      device_write_stats['avoided'] += 1
+    else:
+      # State is remembered only after a successful write, so a failed row
+      # is written again with the next update of the device.
+      if write_device_data(db_connection, data):
+        device_state[mac] = state
+        pending_last_update.pop(mac, None)
+        device_write_stats['writes'] += 1
+      else:
+        device_state.pop(mac, None)
+
+    if time.monotonic() - device_flush_ts['flush'] >= DEVICE_FLUSH_INTERVAL:
+      flush_device_updates(db_connection)
+
+
+
+
+
+def write_device_data(db_connection, data):
+  """
+  Function writes device data into the agent_devices table. See
+  update_device_data function for arguments.
+
+  Returns True if the data was written, False otherwise.
+  """
+
   cursor = db_connection.cursor()
 
   try:
@@ -226,9 +357,70 @@ def update_device_data(db_connection, data):
 
 
     db_connection.commit()
+    return True
 
   except sqlite3.OperationalError:
     print(sqlite3.OperationalError, 'INSERT failed with Operational error')
+    db_connection.rollback()
+    return False
+
+
+
+
+
+def flush_device_updates(db_connection):
+  """
+  Function writes pending devices' last_update values, see update_device_data
+  function, in one transaction.
+
+  Arguments:
+  - db_connection: sqlite3 database connection.
+  """
+
+  with device_lock:
+    now = time.monotonic()
+    device_flush_ts['flush'] = now
+    if pending_last_update:
+      rows = [(value, key) for key, value in pending_last_update.items()]
+      try:
+        db_connection.executemany("""
+          UPDATE agent_devices
+          SET
+            last_update = ?
+          WHERE mac = ?
+          """, rows)
+
+        db_connection.commit()
+        pending_last_update.clear()
+        device_write_stats['flushes'] += 1
+        device_write_stats['flushed_rows'] += len(rows)
+
+      except sqlite3.OperationalError:
+        print(sqlite3.OperationalError, 'UPDATE failed with Operational error')
+
+    if now - device_flush_ts['stats'] >= DEVICE_STATS_INTERVAL:
+      device_flush_ts['stats'] = now
+      stats = get_device_write_stats()
+      print('[' + str(datetime.utcnow()) + '] ' + 'Device writes: %d row writes, %d batched flushes (%d rows), %d writes avoided' %
+            (stats['writes'], stats['flushes'], stats['flushed_rows'], stats['avoided']))
+
+
+
+
+
+def get_device_write_stats():
+  """
+  Function returns a copy of device write statistics. Format is
+    {
+     'writes': <number of device row writes>,
+     'avoided': <number of unchanged device updates, which were not written>,
+     'flushes': <number of batched last_update transactions>,
+     'flushed_rows': <number of last_update values written in batches>
+    }
+  """
+
+  with device_lock:
+    return dict(device_write_stats)
 
 
 
@@ -280,8 +472,12 @@ def updated_devices_bandwidth(db_connection, bandwidth, agent_bandwidth):
 
 def insert_port_data(db_connection, device_mac, device_ip, open_ports, port_type):
   """
-  Function stores TCP/UDP open ports into the database, particularly in the
-  agent_devices table.
+  Function stores TCP/UDP open ports into the database. Only the difference to
+  the previous scan is written: newly opened ports are inserted into the
+  open_ports table, closed ports are deleted from it and a port change event
+  is queued for each of them (see get_port_events function). Open ports list
+  and scan time in the agent_devices table are updated only if the set of
+  open ports changed, so an unchanged device is not sent to the server again.
 
   Arguments:
   - db_connection: sqlite3 database connection.
@@ -289,35 +485,201 @@ def insert_port_data(db_connection, device_mac, device_ip, open_ports, port_type
   - device_ip: An IPv4 address of scanning device.
   - open_ports: A list of open port numbers.
   - port_type: It must be 'tcp' or 'udp'.
+
+  Returns a tuple (opened ports, closed ports) of sorted lists.
   """
 
+  if port_type == 'tcp':
+    columns = ('open_tcp_ports', 'last_tcp_update')
+  elif port_type == 'udp':
+    columns = ('open_udp_ports', 'last_udp_update')
+  else:
+    raise ValueError('Invalid port type ' + str(port_type))
+
   utc_time_now = utils.get_unix_epoch_milliseconds()
-  open_ports_str = ','.join(str(i) for i in open_ports)
+  current = set(int(port) for port in open_ports)
 
-  if port_type == 'tcp':
+  with port_lock:
     try:
+      cursor = db_connection.execute("""
+        SELECT port FROM open_ports WHERE mac = ? AND proto = ?
+        """, (device_mac, port_type))
+      previous = set(row[0] for row in cursor.fetchall())
+
+      opened = sorted(current - previous)
+      closed = sorted(previous - current)
+
+      if opened:
+        db_connection.executemany("""
+          INSERT OR REPLACE INTO open_ports (mac, proto, port, first_seen, last_seen)
+          VALUES (?, ?, ?, ?, ?)
+          """, [(device_mac, port_type, port, utc_time_now, utc_time_now) for port in opened])
+
+      if closed:
+        db_connection.executemany("""
+          DELETE FROM open_ports WHERE mac = ? AND proto = ? AND port = ?
+          """, [(device_mac, port_type, port) for port in closed])
+
+      # Ports, which are still open, are confirmed by one statement.
       db_connection.execute("""
-        UPDATE agent_devices
+        UPDATE open_ports
         SET
-          open_tcp_ports = ?,
-          last_tcp_update = ?
-        WHERE mac = ? AND ip = ?
-        """, (open_ports_str, utc_time_now, device_mac, device_ip))
+          last_seen = ?
+        WHERE mac = ? AND proto = ? AND last_seen < ?
+        """, (utc_time_now, device_mac, port_type, utc_time_now))
+
+      # A device, which has not been scanned yet, has no scan time.
+      cursor = db_connection.execute(
+        'SELECT ' + columns[1] + ' FROM agent_devices WHERE mac = ? AND ip = ?',
+        (device_mac, device_ip))
+      row = cursor.fetchone()
+      if opened or closed or (row is not None and row[0] is None):
+        db_connection.execute(
+          'UPDATE agent_devices SET ' + columns[0] + ' = ?, ' + columns[1] + ' = ? WHERE mac = ? AND ip = ?',
+          (','.join(str(i) for i in sorted(current)), utc_time_now, device_mac, device_ip))
 
       db_connection.commit()
 
     except sqlite3.OperationalError:
       print(sqlite3.OperationalError, 'UPDATE failed with Operational error')
+      return ([], [])
 
-  elif port_type == 'udp':
+    for state, ports in (('open', opened), ('closed', closed)):
+      for port in ports:
+        port_events.append({'mac': device_mac, 'ip': device_ip, 'proto': port_type,
+                            'port': port, 'state': state, 'ts': utc_time_now})
+
+  return (opened, closed)
+
+
+
+
+
+def get_port_events():
+  """
+  Function removes and returns all queued port change events. Event is a
+  dictionary and format is
+  {'mac': <MAC>, 'ip': <IPv4>, 'proto': <'tcp' or 'udp'>, 'port': <port>,
+   'state': <'open' or 'closed'>, 'ts': <unix epoch time in milliseconds>}
+  """
+
+  with port_lock:
+    events = list(port_events)
+    port_events.clear()
+
+  return events
+
+
+
+
+
+def requeue_port_events(events):
+  """
+  Function puts back port change events, which could not be sent, in front of
+  the queue.
+  """
+
+  with port_lock:
+    pending = list(port_events)
+    port_events.clear()
+    port_events.extend(events)
+    port_events.extend(pending)
+
+
+
+
+
+def get_devices_with_port(db_connection, proto, port):
+  """
+  Function queries devices, which expose given port.
+
+  Arguments:
+  - db_connection: sqlite3 database connection.
+  - proto: It must be 'tcp' or 'udp'.
+  - port: Port number.
+
+  Returns a list of dictionaries with mac, ip, hostname, first_seen,
+  last_seen and service keys.
+  """
+
+  ret_list = []
+  try:
+    cursor = db_connection.execute("""
+      SELECT open_ports.mac, agent_devices.ip, agent_devices.hostname,
+             open_ports.first_seen, open_ports.last_seen, open_ports.service
+      FROM open_ports
+      LEFT JOIN agent_devices ON agent_devices.mac = open_ports.mac
+      WHERE open_ports.proto = ? AND open_ports.port = ?
+      """, (proto, int(port)))
+
+    for row in cursor.fetchall():
+      ret_list.append({'mac': row[0], 'ip': row[1], 'hostname': row[2],
+                       'first_seen': row[3], 'last_seen': row[4], 'service': row[5]})
+
+  except sqlite3.OperationalError:
+    print(sqlite3.OperationalError, 'Query: statement failed with Operational error')
+
+  return ret_list
+
+
+
+
+
+def get_unidentified_ports(db_connection, proto = 'tcp'):
+  """
+  Function queries open ports, which have not been fingerprinted yet or whose
+  fingerprint was taken at another IPv4 address of the device.
+
+  Arguments:
+  - db_connection: sqlite3 database connection.
+  - proto: It must be 'tcp' or 'udp'.
+
+  Returns a list of (MAC address, IPv4 address, port) tuples.
+  """
+
+  try:
+    cursor = db_connection.execute("""
+      SELECT open_ports.mac, agent_devices.ip, open_ports.port
+      FROM open_ports
+      JOIN agent_devices ON agent_devices.mac = open_ports.mac
+      WHERE open_ports.proto = ?
+        AND (open_ports.service_ip IS NULL OR open_ports.service_ip != agent_devices.ip)
+      """, (proto,))
+
+    return cursor.fetchall()
+
+  except sqlite3.OperationalError:
+    print(sqlite3.OperationalError, 'Query: statement failed with Operational error')
+
+  return []
+
+
+
+
+
+def set_port_services(db_connection, proto, services):
+  """
+  Function stores fingerprints of open ports. Ports, which closed in the
+  meantime, are not stored again.
+
+  Arguments:
+  - db_connection: sqlite3 database connection.
+  - proto: It must be 'tcp' or 'udp'.
+  - services: A list of (MAC address, IPv4 address, port, service, banner)
+    tuples.
+  """
+
+  with port_lock:
     try:
-      db_connection.execute("""
-        UPDATE agent_devices
+      db_connection.executemany("""
+        UPDATE open_ports
         SET
-          open_udp_ports = ?,
-          last_udp_update = ?
-        WHERE mac = ? AND ip = ?
-        """, (open_ports_str, utc_time_now, device_mac, device_ip))
+          service = ?,
+          banner = ?,
+          service_ip = ?
+        WHERE mac = ? AND proto = ? AND port = ?
+        """, [(service, banner, ip_addr, mac_addr, proto, port)
+              for mac_addr, ip_addr, port, service, banner in services])
 
       db_connection.commit()
 
@@ -356,6 +718,40 @@ def insert_ip_traffic_data(db_connection, data):
 
 
 
+def insert_flow_records(db_connection, records, retention = 3600):
+  """
+  Function stores aggregated flow records of one flush interval in one
+  transaction and deletes rows older than retention.
+
+  Arguments:
+  - db_connection: sqlite3 database connection.
+  - records: A list of (source IP, destination IP, protocol, source port,
+    destination port, bytes, packets, first seen, last seen) tuples, see
+    ip_traffic.store_flows function.
+  - retention: Time (s) flow rows are kept.
+  """
+
+  oldest = int((time.time() - retention) * 1000)
+
+  try:
+    db_connection.executemany("""
+      INSERT INTO flow_data
+        (source_ip, destination_ip, proto, source_port, dest_port, bytes, packets, first_seen, last_seen)
+      VALUES
+        (?, ?, ?, ?, ?, ?, ?, ?, ?)
+      """, records)
+
+    db_connection.execute("""DELETE FROM flow_data WHERE last_seen < ?""", (oldest,))
+
+    db_connection.commit()
+
+  except sqlite3.OperationalError:
+    print(sqlite3.OperationalError, 'INSERT statement failed with Operational error')
+
+
+
+
+
 def insert_iface_data(db_connection, iface_data):
   """
   Function stores network interface's statistics data into the database,
@@ -363,10 +759,12 @@ def insert_iface_data(db_connection, iface_data):
 
   Arguments:
   - db_connection: sqlite3 database connection.
-  - iface_data: A dictionary, which contains network interface data.
+  - iface_data: A dictionary, which contains network interface data. Error
+    counters (see IFACE_ERROR_COUNTERS), which are missing, are stored as 0.
   """
 
   cursor = db_connection.cursor()
+  errors = tuple(iface_data.get(column, 0) for column in IFACE_ERROR_COUNTERS)
 
   try:
     cursor.execute("""
@@ -380,22 +778,28 @@ def insert_iface_data(db_connection, iface_data):
         rx_bytes = ?,
         rx_packets = ?,
         rx_dropped = ?,
-        last_update = ?
+        last_update = ?,
+        tx_errors = ?,
+        tx_fifo_errors = ?,
+        rx_errors = ?,
+        rx_fifo_errors = ?
       WHERE iface = ?
       """, (iface_data['mac'], iface_data['ip'], iface_data['tx_bytes'],
             iface_data['tx_packets'], iface_data['tx_dropped'], iface_data['rx_bytes'] ,
-            iface_data['rx_packets'], iface_data['rx_dropped'], iface_data['last_update'], iface_data['iface']))
+            iface_data['rx_packets'], iface_data['rx_dropped'], iface_data['last_update']) +
+           errors + (iface_data['iface'],))
 
 
     if cursor.rowcount < 1:
       db_connection.execute("""
         INSERT INTO net_interface_data
-          (iface, mac, ip, tx_bytes, tx_packets, tx_dropped, rx_bytes, rx_packets, rx_dropped, last_update)
+          (iface, mac, ip, tx_bytes, tx_packets, tx_dropped, rx_bytes, rx_packets, rx_dropped, last_update,
+           tx_errors, tx_fifo_errors, rx_errors, rx_fifo_errors)
         VALUES
-          (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+          (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, (iface_data['iface'], iface_data['mac'], iface_data['ip'], iface_data['tx_bytes'],
               iface_data['tx_packets'], iface_data['tx_dropped'], iface_data['rx_bytes'] ,
-              iface_data['rx_packets'], iface_data['rx_dropped'], iface_data['last_update']))
+              iface_data['rx_packets'], iface_data['rx_dropped'], iface_data['last_update']) + errors)
 
 
     db_connection.commit()
@@ -448,6 +852,11 @@ def insert_devices_hostname(db_connection, hostnames):
 
   for key, value in hostnames.items():
     if value:
+      with device_lock:
+        state = device_state.get(key)
+        if state:
+          device_state[key] = (state[0], state[1], value)
+
       try:
         db_connection.execute("""
           UPDATE agent_devices
@@ -672,20 +1081,19 @@ def get_ids_data(db_connection):
 
 def get_ip_traffic_data(db_connection):
   """
-  Function queries data from the database, particularly from ip_traffic_data
-  table.
+  Function returns the top external talkers. They are kept in memory by the
+  heavy_hitters module, fed by IP traffic monitoring, so no packet or flow
+  rows are queried.
 
   Arguments:
   - db_connection: sqlite3 database connection
 
-  Returns a dictionary of queried data.
+  Returns a dictionary with by_bytes and by_packets lists, see
+  heavy_hitters.get_top_talkers function, or an empty dictionary if there is
+  no external traffic.
   """
 
-  ret_json = {}
-
-  #TODO Implement
-
-  return ret_json
+  return heavy_hitters.get_top_talkers()
 
 
 
@@ -722,7 +1130,11 @@ def get_iface_data(db_connection):
   # [6] rx_bytes    INTEGER,
   # [7] rx_packets  INTEGER,
   # [8] rx_dropped  INTEGER,
-  # [9] last_update REAL
+  # [9] last_update REAL,
+  # [10] tx_errors       INTEGER,
+  # [11] tx_fifo_errors  INTEGER,
+  # [12] rx_errors       INTEGER,
+  # [13] rx_fifo_errors  INTEGER
 
   for row in query:
    iface = str(row[0])
@@ -736,7 +1148,11 @@ def get_iface_data(db_connection):
            'rx_bytes': row[6],
            'rx_packets': row[7],
            'rx_dropped': row[8],
-           'last_update': row[9]
+           'last_update': row[9],
+           'tx_errors': row[10],
+           'tx_fifo_errors': row[11],
+           'rx_errors': row[12],
+           'rx_fifo_errors': row[13]
           }
 
    ret_json[iface] = data
@@ -794,7 +1210,9 @@ def cleanup_db(db_connection):
 
   try:
     db_connection.execute("""DROP TABLE IF EXISTS agent_devices""")
+    db_connection.execute("""DROP TABLE IF EXISTS open_ports""")
     db_connection.execute("""DROP TABLE IF EXISTS ip_traffic_data""")
+    db_connection.execute("""DROP TABLE IF EXISTS flow_data""")
     db_connection.execute("""DROP TABLE IF EXISTS net_interface_data""")
     db_connection.execute("""DROP TABLE IF EXISTS node_log""")
     db_connection.execute("""DROP TABLE IF EXISTS ids_data""")
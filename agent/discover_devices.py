@@ -14,14 +14,9 @@ Authors:
 """
 
 
-import gevent
 import random
 import time
 import sys
-import ipaddress
-import re
-import subprocess
-import netifaces
 import traceback
 import threading
 
@@ -30,18 +25,80 @@ from datetime import datetime
 
 import db
 import utils
+import arp_engine
+import neighbors
+import resolver
+import discovery_engine
+import governor
 
 
 
-def search_network_devices(db_connection, net_interfaces):
+# Default discovery options. See search_network_devices function.
+DEFAULT_OPTIONS = {
+  'discovery_mode': 'active',
+  'sweep_interval': 2.5,
+  'arp_rate': 200,
+  'arp_backend': 'native',
+  'staleness': 60,
+  'dead_max': 600
+}
+
+
+
+
+
+def get_options(options):
+  """
+  Function returns discovery options, where missing keys are set to
+  DEFAULT_OPTIONS values.
+
+  Arguments:
+  - options: A dictionary (e.g., command line data) or None.
+  """
+
+  ret = dict(DEFAULT_OPTIONS)
+  if options:
+    for key in list(DEFAULT_OPTIONS) + ['budget']:
+      if options.get(key) is not None:
+        ret[key] = options[key]
+
+  return ret
+
+
+
+
+
+def search_network_devices(db_connection, net_interfaces, options = None):
   """
   Function searches devices in the given network and stores/updates devices'
   data on the SQLite3 database.
 
+  With the native ARP backend all interfaces are served by one discovery
+  engine (see discovery_engine module) in the calling thread. With the Scapy
+  backend, or if no raw socket can be opened, every interface is swept by its
+  own thread in active mode.
+
   Arguments:
   - db_connection: SQLite3 database connection.
   - net_interfaces: A list of network interfaces' data. Every single element of
     list is dictionary and format is {'ip': <ip addr>, 'iface': <iface name>}.
+  - options: A dictionary of discovery options, keys are
+    - discovery_mode: 'active' probes every address every sweep_interval,
+      'passive' learns devices from ARP traffic and kernel neighbor table and
+      probes only addresses which are silent longer than staleness, 'adaptive'
+      learns devices passively, probes live hosts every sweep_interval and
+      silent addresses with an exponential back-off from staleness to
+      dead_max. Prefixes shorter than /24 are always discovered in adaptive
+      mode.
+    - sweep_interval: Interval (s) between two ARP sweeps of the same subnet.
+    - arp_rate: Maximum number of ARP requests per second, shared by all
+      interfaces.
+    - arp_backend: ARP backend, 'native' or 'scapy'. See arp_sweep function.
+    - staleness: Time (s) after which a silent address is probed in passive
+      mode, and first back-off interval of silent addresses in adaptive mode.
+    - dead_max: Maximum back-off interval (s) of silent addresses in adaptive
+      mode.
+    Missing keys are set to DEFAULT_OPTIONS values.
   """
 
   if not net_interfaces:
@@ -52,14 +109,23 @@ def search_network_devices(db_connection, net_interfaces):
     utils.print_error('SQLite3 database is not connected')
     sys.exit()
 
+  options = get_options(options)
 
-  try:
-    utc_time_now = str(datetime.utcnow())
-    print('[' + utc_time_now + '] ' + 'Start searching devices in local network .........')
-    start = datetime.now()
+  utc_time_now = str(datetime.utcnow())
+  print('[' + utc_time_now + '] ' + 'Start searching devices in local network .........')
 
+  if options['arp_backend'] == 'native':
+    engine = discovery_engine.DiscoveryEngine([data['iface'] for data in net_interfaces], options,
+                                             options.get('budget'))
+    if engine.states:
+      run_discovery_engine(db_connection, engine)
+      return
+
+    utils.print_error('Native ARP engine is not available, falling back to Scapy')
+
+  try:
     for iface_data in net_interfaces:
-      iface_thr = threading.Thread(target = discover_devices, args = (db_connection, iface_data))
+      iface_thr = threading.Thread(target = discover_devices, args = (db_connection, iface_data, options))
       iface_thr.start()
 
   except:
@@ -70,112 +136,261 @@ def search_network_devices(db_connection, net_interfaces):
 
 
 
-def discover_devices(db_connection, iface_data):
+def run_discovery_engine(db_connection, engine):
   """
+  Function runs discovery engine forever. Devices seen during a sweep interval
+  are stored and/or updated on the database once per interval.
+
   Arguments:
   - db_connection: SQLite3 database connection.
-  - iface_data: A network interface data.
+  - engine: discovery_engine.DiscoveryEngine.
   """
 
-  cfg = netifaces.ifaddresses(iface_data['iface'])[netifaces.AF_INET][0]
-  my_ip = cfg['addr']
-  subnet = ipaddress.IPv4Network('%s/%s' % (my_ip, cfg['netmask']), strict=False)
+  # Devices seen during current interval, key is (iface, IPv4) and value is MAC.
+  seen_devices = {}
 
-  if subnet.prefixlen >= 24 and subnet.prefixlen < 32:
-    # Get a list of all IP addresses that belong to the IP subnet on
-    # the interface, sans the IP address of our own network
-    # interface.
-    devices = [str(ip) for ip in subnet.hosts() if str(ip) != my_ip]
-    search_devices(db_connection, devices, iface_data['iface'])
+  def on_event(event):
+    seen_devices[(event['iface'], event['ip'])] = event['mac']
 
-  else:
-    utils.print_error('Error: currently system supports only /24 <= X < /32 IPv4 prefixes')
+  def on_interval():
+    utc_time_now = utils.get_unix_epoch_milliseconds()
+    for (iface, ip_addr), mac_addr in seen_devices.items():
+      store_device(db_connection, ip_addr, mac_addr, iface, utc_time_now)
+    seen_devices.clear()
 
+  engine.run(on_event, on_interval)
 
 
 
 
-def search_devices(db_connection, ip_list, iface):
+
+def get_subnet(iface):
   """
-  Function constructs full IPv4 address (x.x.x concatenates with last byte),
-  searches devices in given IPv4 interval using gevent, which allows to makes
-  non-blocking requests.
+  Function returns Tuple (IPv4 address, ipaddress.IPv4Network) of given network
+  interface.
 
   Arguments:
-  - db_connection: SQLite3 database connection.
-  - reserved_ip_addresses: A list contains IPv4 addresses, which does not make
-    sense to do request.
-  - ip_list: A list of IPv4 addresses to be requested parallel (non-blocking)
   - iface: Network interface name.
   """
 
-  threads = []
-  for ip_addr in ip_list:
-    ip_addr = str(ip_addr)
-    threads.append(gevent.spawn(request, db_connection, iface, ip_addr))
+  return utils.get_iface_subnet(iface)
 
-  gevent.joinall(threads)
 
 
 
 
+def get_subnet_hosts(iface):
+  """
+  Function returns IPv4 address of given network interface and a list of all
+  IP addresses that belong to the IP subnet on the interface, sans the IP
+  address of our own network interface.
 
-def request(db_connection, iface, ip_addr):
+  Arguments:
+  - iface: Network interface name.
+
+  Returns Tuple (IPv4 address, list of IPv4 addresses) or None if prefix is
+  not supported.
+  """
+
+  my_ip, subnet = get_subnet(iface)
+
+  if subnet.prefixlen >= 24 and subnet.prefixlen < 32:
+    return (my_ip, [str(ip) for ip in subnet.hosts() if str(ip) != my_ip])
+
+  utils.print_error('Error: only /24 <= X < /32 IPv4 prefixes can be swept as a whole')
+  return None
+
+
+
+
+
+def discover_devices(db_connection, iface_data, options = None):
   """
-  Function does ARP request for given IPv4 address, constructs device data
-  (MAC, IPv4, network interface name and timestamp) based on ARP response and
-  stores and/or updates on the database.
+  Function sweeps the subnet of given network interface in active mode. It is
+  used if the discovery engine is not available.
+
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - iface_data: A network interface data.
+  - options: Discovery options. See search_network_devices function.
+  """
+
+  hosts = get_subnet_hosts(iface_data['iface'])
+  if hosts:
+    search_devices(db_connection, hosts[1], iface_data['iface'], options)
+
+
+
+
+
+def search_devices(db_connection, ip_list, iface, options = None):
+  """
+  Function periodically sweeps given IPv4 addresses with ARP requests and
+  stores and/or updates visible devices' data (MAC, IPv4, hostname, network
+  interface name and timestamp) on the database.
+
+  Every round sends ARP requests for the whole list in one batch and collects
+  all replies on a single socket, see arp_sweep function.
 
   Arguments:
   - db_connection: SQLite3 database connection.
+  - ip_list: A list of IPv4 addresses to be swept.
   - iface: Network interface name.
-  - ip_addr: IPv4 address.
+  - options: Discovery options. See search_network_devices function.
   """
 
-  hostname = ''
+  options = get_options(options)
+  ip_list = [str(ip_addr) for ip_addr in ip_list]
 
   while 1:
+    start = time.time()
     try:
-      result = arp_request(ip_addr, iface)
-      if result:
-        ip_addr = result[0]
-        mac_addr = result[1]
-        utc_time_now = utils.get_unix_epoch_milliseconds()
-        # The idea is NOT to call get_device_hostname() function if we already
-        # got hostname.
-        if not hostname:
-          hostname = get_device_hostname(mac_addr)
-
-        data = {'mac': mac_addr, 'ip': ip_addr, 'hostname': hostname, 'iface': iface, 'last_update': utc_time_now}
-        db.update_device_data(db_connection, data)
+      live_devices = arp_sweep(ip_list, iface, packet_rate = options['arp_rate'], backend = options['arp_backend'])
+      utc_time_now = utils.get_unix_epoch_milliseconds()
+      for ip_addr, mac_addr in live_devices:
+        store_device(db_connection, ip_addr, mac_addr, iface, utc_time_now)
     except:
-      pass
+      utils.print_error('An exception occurred in ARP sweep on ' + str(iface))
+      traceback.print_exc()
 
+    sleep_rest_of_interval(start, options['sweep_interval'])
 
-    # Just random sleep 2 seconds, plus random milliseconds in [2, 500] interval,
-    # before starting next round.
-    wait_millisecond = float(random.randint(2, 501)) / float(1000)
-    wait_millisecond = float(2) + wait_millisecond
-    time.sleep(wait_millisecond)
 
 
 
 
+def store_device(db_connection, ip_addr, mac_addr, iface, utc_time_now):
+  """
+  Function stores and/or updates device data on the database.
 
-def arp_request(ip_addr, iface, timeout = 3):
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - ip_addr: IPv4 address of device.
+  - mac_addr: MAC address of device.
+  - iface: Network interface name.
+  - utc_time_now: Unix Epoch time in milliseconds.
   """
-  Function does ARP request to check if given IPv4 is up or down.
 
-  The fastest way to discover hosts on a local Ethernet network is to use
-  the Scapy's ARP Ping method.
+  hostname = get_device_hostname(mac_addr, ip_addr)
+  data = {'mac': mac_addr, 'ip': ip_addr, 'hostname': hostname, 'iface': iface, 'last_update': utc_time_now}
+  db.update_device_data(db_connection, data)
+
+
+
+
+
+def sleep_rest_of_interval(start, interval):
+  """
+  Function sleeps the rest of interval, which started at start (s), plus random
+  milliseconds in [2, 500] interval, before starting next round.
+  """
+
+  wait_millisecond = float(random.randint(2, 501)) / float(1000)
+  elapsed = time.time() - start
+  time.sleep(max(interval - elapsed, 0) + wait_millisecond)
+
+
+
+
+
+def arp_sweep(ip_list, iface, timeout = 3, packet_rate = 200, backend = 'native'):
+  """
+  Function sends ARP requests for all given IPv4 addresses in one batch and
+  collects replies on a single socket.
+
+  Arguments:
+  - ip_list: A list of IPv4 addresses.
+  - iface: Network interface name.
+  - timeout: The time (s) to wait for replies after the last request has been
+    sent.
+  - packet_rate: Maximum number of ARP requests per second. If it is 0 or
+    None requests are sent as fast as possible.
+  - backend: 'native' uses AF_PACKET socket (see arp_engine module), 'scapy'
+    uses Scapy's srp function. If native backend cannot be used (e.g., no raw
+    socket support) it falls back to Scapy.
+
+  Returns a set of (IPv4 address, MAC address) tuples of devices which replied.
+  """
+
+  if not ip_list:
+    return set()
+
+  # Requests are charged to the Agent-wide governor, if there is one.
+  limiter = governor.get_governor()
+  budget = None
+  if limiter is not None:
+    budget = limiter.budget(iface, governor.PRIORITY_DISCOVERY, governor.ARP_PACKET_SIZE)
+
+  if backend == 'native':
+    try:
+      arp_socket = arp_engine.get_arp_socket(iface)
+    except OSError:
+      utils.print_error('Native ARP engine is not available on ' + str(iface) + ', falling back to Scapy')
+      traceback.print_exc()
+    else:
+      try:
+        return arp_socket.sweep(ip_list, timeout, packet_rate, budget)
+      except OSError:
+        # Interface may have gone down or changed, reopen socket next time.
+        arp_engine.close_arp_socket(iface)
+        raise
+
+  if limiter is not None:
+    # Scapy sends all requests in one call, so their budget is taken up front.
+    limiter.acquire(iface, len(ip_list), governor.ARP_PACKET_SIZE, governor.PRIORITY_DISCOVERY)
+
+  return arp_sweep_scapy(ip_list, iface, timeout, packet_rate)
+
+
+
+
+
+def arp_sweep_scapy(ip_list, iface, timeout = 3, packet_rate = 200):
+  """
+  Function does the same as arp_sweep function, but using Scapy's srp
+  function.
+
+  Arguments:
+  - ip_list: A list of IPv4 addresses.
+  - iface: Network interface name.
+  - timeout: The time (s) to wait for replies after the last request has been
+    sent.
+  - packet_rate: Maximum number of ARP requests per second.
+
+  Returns a set of (IPv4 address, MAC address) tuples of devices which replied.
+  """
+
+  live_devices = set()
+
+  inter = 0
+  if packet_rate:
+    inter = 1.0 / float(packet_rate)
+
+  requests = Ether(dst = "ff:ff:ff:ff:ff:ff") / ARP(pdst = list(ip_list))
+  answered, unanswered = srp(requests, iface = iface, timeout = timeout, inter = inter, verbose = False)
+  for send, receive in answered:
+    mac_address = receive.sprintf(r"%Ether.src%")
+    ip_address = receive.sprintf(r"%ARP.psrc%")
+    if mac_address and ip_address:
+      live_devices.add((ip_address, mac_address))
+
+  return live_devices
+
+
+
+
+
+def arp_request(ip_addr, iface, timeout = 3, backend = 'native'):
+  """
+  Function does ARP request to check if given IPv4 is up or down.
 
   Arguments:
   - ip_addr: An IPv4 address. If given argument is empty string or undefined
     it returns empty Tuple.
   - iface: Network interface name.
-  - timeout: The timeout parameter of srp function specifies the time to wait
-    after the last packet has been sent. If there is, no response a None value
-    will be assigned instead when the timeout is reached.
+  - timeout: The time (s) to wait for the reply. If there is no response
+    when the timeout is reached an empty Tuple is returned.
+  - backend: 'native' or 'scapy', see arp_sweep function.
 
 
   Returns Tuple (IPv4 address, MAC address) if IPv4 is up and response contains
@@ -185,14 +400,8 @@ def arp_request(ip_addr, iface, timeout = 3):
   if not ip_addr:
     return tuple()
 
-  # TODO We may need to implement our own ARP request instead of using Scapy.
-  answered, unanswered = srp(Ether(dst = "ff:ff:ff:ff:ff:ff") / ARP(pdst = ip_addr), iface = iface, timeout = timeout, verbose = False)
-  if answered:
-    for send, receive in answered:
-      mac_address = receive.sprintf(r"%Ether.src%")
-      ip_address = receive.sprintf(r"%ARP.psrc%")
-      if mac_address and ip_address:
-        return (ip_address, mac_address)
+  for result in arp_sweep([ip_addr], iface, timeout, 0, backend):
+    return result
 
   return tuple()
 
@@ -200,39 +409,30 @@ def arp_request(ip_addr, iface, timeout = 3):
 
 
 
-def get_device_hostname(dev_mac):
+def get_device_hostname(dev_mac, dev_ip = None):
   """
-  Function runs arp command, filters hostnames by MAC addresses, and returns
-  hostname if it finds, otherwise returns an empty string.
+  Function returns hostname of device if it is known, otherwise returns an
+  empty string.
+
+  If the shared resolver is running (see resolver module) the function never
+  blocks: it returns a cached name and unknown devices are resolved in the
+  background, which stores the name on the database. Otherwise hostname is
+  looked up in the neighbor cache shared by discovery workers (see neighbors
+  module).
 
   Arguments:
   - dev_mac: MAC address of device.
+  - dev_ip: IPv4 address of device. If it is not given it is looked up in the
+    kernel neighbor table by MAC address.
   """
 
-  completed = subprocess.run("arp", shell = True, stdout = subprocess.PIPE)
-  arp_table = (completed.stdout).splitlines()
-  list_length = len(arp_table)
-
-  # First element is just description.
-  if list_length < 2:
-    return;
-
-  # Skip first line as it contains Address, HWtype, HWaddres, Flags Mask
-  # and Iface.
-  for i in range(1, list_length):
-    arp_table[i] = arp_table[i].decode("utf-8")
-    arp_table_dev_data = re.split(r'\s{2,}', arp_table[i])
-    # Make sure that it was parsed correct. After parsing a list should contain
-    # following data:
-    # list = ['192.168.1.174', 'ether', 'b0:e1:7e:c2:8c:8f', 'C', 'enp0s3']
-    # list[0] is Address
-    # list[1] is HWtype
-    # list[2] is HWaddres
-    # list[3] is Flags
-    # list[4] is Iface
-    if arp_table_dev_data and len(arp_table_dev_data) == 5:
-      if dev_mac == arp_table_dev_data[2]:
-        return arp_table_dev_data[0]
-
-  return ''
+  if not dev_ip:
+    neighbor = neighbors.cache.lookup_mac(dev_mac)
+    if not neighbor:
+      return ''
+    dev_ip = neighbor[0]
+
+  if resolver.resolver is not None:
+    return resolver.resolver.lookup(dev_mac, dev_ip)
 
+  return neighbors.cache.hostname(dev_ip)
@@ -0,0 +1,325 @@
+"""
+Module Name:
+  discovery_engine.py
+
+
+Description:
+  Module provides a device discovery engine, which serves all monitored
+  network interfaces from one event loop. Every interface has one ARP socket
+  (see arp_engine module) registered with a selector and a probe scheduler
+  (see probe_scheduler module), all probes draw from one global rate limiter,
+  and results come out as a single stream of neighbor events tagged with the
+  network interface.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import selectors
+import time
+import traceback
+
+import arp_engine
+import governor
+import iface_watcher
+import neighbors
+import probe_scheduler
+import utils
+
+
+# Interval (s) between two scheduler rounds.
+PROBE_TICK = 0.25
+
+
+
+
+
+def get_schedule(options, subnet):
+  """
+  Function returns probe schedule (live_interval, dead_min, dead_max) of given
+  discovery mode.
+
+  - active: every address is probed every sweep_interval.
+  - passive: an address is probed only after it has been silent for staleness
+    seconds.
+  - adaptive: live hosts are probed every sweep_interval, silent addresses
+    back off exponentially from staleness to dead_max seconds.
+
+  Prefixes shorter than /24 are always probed in adaptive mode.
+
+  Arguments:
+  - options: Discovery options, see discover_devices.search_network_devices.
+  - subnet: ipaddress.IPv4Network of the interface.
+  """
+
+  mode = options['discovery_mode']
+  if subnet.prefixlen < 24:
+    mode = 'adaptive'
+
+  if mode == 'active':
+    return (options['sweep_interval'], options['sweep_interval'], options['sweep_interval'])
+
+  if mode == 'passive':
+    return (options['staleness'], options['staleness'], options['staleness'])
+
+  return (options['sweep_interval'], options['staleness'], options['dead_max'])
+
+
+
+
+
+class InterfaceState(object):
+  """
+  ARP socket and probe scheduler of one network interface.
+  """
+
+  def __init__(self, iface, my_ip, subnet, sock, scheduler):
+    self.iface = iface
+    self.my_ip = my_ip
+    self.subnet = subnet
+    self.sock = sock
+    self.scheduler = scheduler
+
+
+
+
+
+class DiscoveryEngine(object):
+  """
+  Single event loop device discovery across network interfaces.
+  """
+
+  def __init__(self, ifaces, options, budget = None):
+    """
+    Arguments:
+    - ifaces: A list of network interface names.
+    - options: Discovery options, see discover_devices.search_network_devices.
+    - budget: Global probe rate limiter (TokenBucket). By default it allows
+      options['arp_rate'] probes per second.
+    """
+
+    self.ifaces = list(ifaces)
+    self.options = options
+    if budget is None:
+      rate = float(options['arp_rate'])
+      budget = probe_scheduler.TokenBucket(rate, max(1, rate * PROBE_TICK))
+    self.budget = budget
+
+    self.selector = selectors.DefaultSelector()
+    self.states = {}
+    # Round-robin offset, so one interface cannot use up the budget.
+    self.turn = 0
+    self.reconfigure = False
+
+    for iface in self.ifaces:
+      self.open_interface(iface)
+
+    table = iface_watcher.get_table()
+    if table is not None:
+      table.add_listener(self.interfaces_changed)
+
+
+  def open_interface(self, iface):
+    """
+    Method opens ARP socket and creates probe scheduler of given network
+    interface.
+
+    Returns True on success.
+    """
+
+    try:
+      my_ip, subnet = utils.get_iface_subnet(iface)
+    except Exception:
+      utils.print_error('Unable to get IPv4 subnet of ' + str(iface))
+      return False
+
+    if subnet.prefixlen >= 32:
+      utils.print_error('Error: ' + str(iface) + ' is a point-to-point network interface')
+      return False
+
+    try:
+      sock = arp_engine.ArpSocket(iface, my_ip, arp_engine.ARP_ANY_FILTER)
+    except OSError:
+      utils.print_error('Unable to open ARP socket on ' + str(iface))
+      traceback.print_exc()
+      return False
+
+    # Probes are limited by the discovery budget and, if there is one, by the
+    # Agent-wide governor, where discovery has the highest priority.
+    budget = self.budget
+    limiter = governor.get_governor()
+    if limiter is not None:
+      budget = limiter.budget(iface, governor.PRIORITY_DISCOVERY, governor.ARP_PACKET_SIZE, self.budget)
+
+    live_interval, dead_min, dead_max = get_schedule(self.options, subnet)
+    scheduler = probe_scheduler.ProbeScheduler(subnet, exclude = [my_ip],
+                                               live_interval = live_interval,
+                                               dead_min = dead_min,
+                                               dead_max = dead_max,
+                                               resolution = PROBE_TICK,
+                                               budget = budget)
+
+    state = InterfaceState(iface, my_ip, subnet, sock, scheduler)
+    sock.sock.setblocking(False)
+    self.selector.register(sock, selectors.EVENT_READ, state)
+    self.states[iface] = state
+
+    return True
+
+
+  def close_interface(self, iface):
+    state = self.states.pop(iface, None)
+    if state is None:
+      return
+
+    try:
+      self.selector.unregister(state.sock)
+    except (KeyError, ValueError):
+      pass
+    state.sock.close()
+
+
+  def interfaces_changed(self, table):
+    # Called from the interface watcher thread, the loop re-checks addresses.
+    self.reconfigure = True
+
+
+  def check_interfaces(self):
+    """
+    Method re-opens interfaces, which went away or whose address changed.
+    """
+
+    self.reconfigure = False
+    for iface in self.ifaces:
+      state = self.states.get(iface)
+      try:
+        current = utils.get_iface_subnet(iface)
+      except Exception:
+        current = None
+
+      if state is not None and current == (state.my_ip, state.subnet):
+        continue
+
+      self.close_interface(iface)
+      if current is not None:
+        self.open_interface(iface)
+
+
+  def send_probes(self, now):
+    """
+    Method sends ARP requests of due addresses. Interfaces take turns in
+    drawing from the global budget.
+
+    Returns number of sent requests.
+    """
+
+    states = list(self.states.values())
+    if not states:
+      return 0
+
+    self.turn = (self.turn + 1) % len(states)
+    sent = 0
+    for state in states[self.turn:] + states[:self.turn]:
+      ip_list = state.scheduler.due(now)
+      for i, ip_addr in enumerate(ip_list):
+        try:
+          state.sock.send_request(ip_addr)
+          sent += 1
+        except OSError as e:
+          if not isinstance(e, BlockingIOError):
+            self.reconfigure = True
+          # Unsent addresses must not count as unanswered probes.
+          state.scheduler.requeue(ip_list[i:])
+          break
+
+    return sent
+
+
+  def poll_neighbors(self, now, on_event):
+    """
+    Method reads the kernel neighbor table once for all interfaces. Only
+    neighbors in REACHABLE, DELAY or PROBE state count as seen, a STALE entry
+    of a host which has left must not postpone its probes.
+    """
+
+    for ip_addr, mac_addr, iface in neighbors.cache.get_entries(live_only = True):
+      state = self.states.get(iface)
+      if state is not None and state.scheduler.mark_seen(ip_addr, now):
+        self.emit(on_event, iface, ip_addr, mac_addr, 'neighbor')
+
+
+  def receive(self, timeout, on_event):
+    """
+    Method waits at most timeout seconds for ARP packets and emits events of
+    senders, which belong to monitored subnets. Requests, replies and
+    gratuitous ARP all announce the sender's (IPv4, MAC) pair.
+    """
+
+    for key, mask in self.selector.select(timeout):
+      state = key.data
+      try:
+        packets = state.sock.recv_pending()
+      except OSError:
+        self.reconfigure = True
+        continue
+
+      now = time.monotonic()
+      for opcode, ip_addr, mac_addr, target_ip in packets:
+        if state.scheduler.mark_seen(ip_addr, now):
+          self.emit(on_event, state.iface, ip_addr, mac_addr, 'arp')
+
+
+  def emit(self, on_event, iface, ip_addr, mac_addr, source):
+    on_event({'iface': iface, 'ip': ip_addr, 'mac': mac_addr, 'source': source,
+              'last_update': utils.get_unix_epoch_milliseconds()})
+
+
+  def run(self, on_event, on_interval = None):
+    """
+    Method runs discovery loop forever.
+
+    Arguments:
+    - on_event: Function called with every neighbor event. Event is a
+      dictionary and format is
+      {'iface': <iface name>, 'ip': <IPv4>, 'mac': <MAC>, 'source': <'arp' or 'neighbor'>,
+       'last_update': <unix epoch time in milliseconds>}
+    - on_interval: Function called every sweep_interval seconds, e.g., to store
+      devices seen during the interval.
+    """
+
+    interval = self.options['sweep_interval']
+    next_interval = time.monotonic()
+
+    while 1:
+      now = time.monotonic()
+
+      try:
+        if now >= next_interval:
+          if self.reconfigure:
+            self.check_interfaces()
+          self.poll_neighbors(now, on_event)
+          if on_interval is not None:
+            on_interval()
+          next_interval = now + interval
+
+        self.send_probes(now)
+
+        # Wait for ARP packets until next scheduler round. Selector needs at
+        # least one registered socket.
+        deadline = now + PROBE_TICK
+        while 1:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            break
+          if not self.states:
+            time.sleep(remaining)
+            break
+          self.receive(remaining, on_event)
+
+      except Exception:
+        utils.print_error('An exception occurred in discovery engine')
+        traceback.print_exc()
+        time.sleep(PROBE_TICK)
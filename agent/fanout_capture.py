@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+"""
+Module Name:
+  fanout_capture.py
+
+
+Description:
+  Module provides multi-core packet capture for IP traffic monitoring. The
+  Agent starts N capture worker processes (this script run with --worker).
+  Every worker opens an AF_PACKET socket per interface and joins the
+  interface's PACKET_FANOUT group, so the kernel spreads packets among the
+  workers by a symmetric flow hash and every flow is counted by one worker.
+
+  Workers aggregate packets into their own flow table (see flow_capture
+  module) and send it to the Agent every WORKER_INTERVAL seconds over their
+  standard output in a compact binary format: a MESSAGE_HEADER followed by
+  one FLOW_RECORD per flow. The Agent merges them into its flow table, which
+  is flushed like the flow table of single-process capture.
+
+  Workers are separate interpreters, not forked from the Agent, so they do
+  not share the GIL and do not inherit the gevent patched runtime.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import argparse
+import os
+import select
+import struct
+import subprocess
+import sys
+import time
+
+import flow_capture
+import tpacket_ring
+
+
+# Interval (s) between two flow tables sent by a worker.
+WORKER_INTERVAL = 1.0
+
+# Time (s) a worker is given to open its sockets.
+START_TIMEOUT = 5.0
+
+# Message header: magic, number of flow records, frames and IPv4 packets read
+# since the previous message.
+MESSAGE_MAGIC = b'NMFL'
+MESSAGE_HEADER = struct.Struct('!4sIII')
+
+# Flow record: source and destination IPv4 address, protocol, source and
+# destination port, bytes, packets, first and last seen (Unix time (s)).
+FLOW_RECORD = struct.Struct('!4s4sBHHQQdd')
+
+# Maximum number of bytes read from a worker's pipe at once.
+READ_SIZE = 1 << 20
+
+# PACKET_FANOUT group IDs of the Agent's interfaces start here. Group IDs are
+# shared by all processes of a network namespace.
+FANOUT_GROUP_BASE = 0x4e00
+
+
+
+
+
+def encode_flows(flows, frames = 0, packets = 0):
+  """
+  Function encodes flows of a drained flow table as one message.
+  """
+
+  parts = [MESSAGE_HEADER.pack(MESSAGE_MAGIC, len(flows), frames, packets)]
+  pack = FLOW_RECORD.pack
+  for (src, dst, proto, sport, dport), (octets, count, first, last) in flows.items():
+    parts.append(pack(src, dst, proto, sport, dport, octets, count, first, last))
+
+  return b''.join(parts)
+
+
+
+
+
+def decode_messages(buffer, table):
+  """
+  Function merges all complete messages at the beginning of buffer into
+  given flow table and removes them from buffer.
+
+  Arguments:
+  - buffer: bytearray of received data.
+  - table: flow_capture.FlowTable.
+
+  Returns Tuple (number of messages, frames, IPv4 packets). Raises
+  ValueError if data is corrupted.
+  """
+
+  messages = frames = packets = 0
+  offset = 0
+  while len(buffer) - offset >= MESSAGE_HEADER.size:
+    magic, count, message_frames, message_packets = MESSAGE_HEADER.unpack_from(buffer, offset)
+    if magic != MESSAGE_MAGIC:
+      raise ValueError('Corrupted capture worker message')
+
+    end = offset + MESSAGE_HEADER.size + count * FLOW_RECORD.size
+    if len(buffer) < end:
+      break
+
+    for src, dst, proto, sport, dport, octets, flow_packets, first, last in FLOW_RECORD.iter_unpack(
+        memoryview(buffer)[offset + MESSAGE_HEADER.size:end]):
+      table.merge((src, dst, proto, sport, dport), octets, flow_packets, first, last)
+
+    messages += 1
+    frames += message_frames
+    packets += message_packets
+    offset = end
+
+  del buffer[:offset]
+  return (messages, frames, packets)
+
+
+
+
+
+class FanoutCapture(object):
+  """
+  Packet capture by worker processes sharing PACKET_FANOUT groups. It has
+  the same interface as flow_capture.FlowCapture.
+  """
+
+  def __init__(self, ifaces, local_ips = (), workers = 2, interval = flow_capture.FLUSH_INTERVAL,
+               max_flows = flow_capture.MAX_FLOWS, ring = None):
+    """
+    Arguments:
+    - ifaces: A list of network interface names.
+    - local_ips: IPv4 addresses of the Agent, see flow_capture.FlowCapture.
+    - workers: Number of worker processes.
+    - interval: Interval (s) between two flushes of the merged flow table.
+    - max_flows: Maximum number of flows in the merged table.
+    - ring: A dictionary with block_size, frame_count and retire_timeout
+      keys, if workers capture with memory-mapped rings (see tpacket_ring
+      module), or None.
+    """
+
+    self.ifaces = list(ifaces)
+    self.local_ips = list(local_ips)
+    self.workers = max(1, int(workers))
+    self.interval = float(interval)
+    self.max_flows = int(max_flows)
+    self.ring = ring
+    self.table = flow_capture.FlowTable()
+    self.processes = []
+    self.buffers = {}
+    self.stats = {'frames': 0, 'ipv4': 0, 'messages': 0, 'flushes': 0, 'flows': 0}
+
+
+  def open(self):
+    """
+    Method starts worker processes and waits until all of them opened their
+    sockets. Raises OSError if a worker fails (e.g., the Agent is not root).
+    """
+
+    self.close()
+    group = FANOUT_GROUP_BASE + (os.getpid() % 64) * 16
+    cmd = [sys.executable, os.path.abspath(__file__), '--worker',
+           '--ifaces', ','.join(self.ifaces), '--local_ips', ','.join(self.local_ips),
+           '--group', str(group), '--interval', str(WORKER_INTERVAL)]
+    if self.ring is not None:
+      cmd += ['--ring_block_size', str(self.ring['block_size']),
+              '--ring_frames', str(self.ring['frame_count']),
+              '--ring_retire_timeout', str(self.ring['retire_timeout'])]
+
+    try:
+      for i in range(self.workers):
+        process = subprocess.Popen(cmd, stdin = subprocess.DEVNULL, stdout = subprocess.PIPE)
+        self.processes.append(process)
+        self.buffers[process.stdout.fileno()] = bytearray()
+
+      # Every worker sends an empty message when its sockets are open.
+      deadline = time.monotonic() + START_TIMEOUT
+      ready = set()
+      while len(ready) < len(self.processes):
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+          raise OSError('Capture workers did not start')
+        for process in self.poll(timeout):
+          ready.add(process.pid)
+    except (OSError, ValueError):
+      self.close()
+      raise
+
+
+  def close(self):
+    for process in self.processes:
+      process.terminate()
+    for process in self.processes:
+      try:
+        process.wait(START_TIMEOUT)
+      except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+      process.stdout.close()
+
+    self.processes = []
+    self.buffers = {}
+
+
+  def poll(self, timeout):
+    """
+    Method waits up to timeout seconds for worker messages and merges them
+    into the flow table. Raises OSError if a worker exited.
+
+    Returns a list of processes, whose message was received.
+    """
+
+    pipes = dict((process.stdout.fileno(), process) for process in self.processes)
+    readable, writable, errors = select.select(list(pipes), [], [], timeout)
+
+    received = []
+    for fd in readable:
+      data = os.read(fd, READ_SIZE)
+      if not data:
+        raise OSError('Capture worker %d exited with %s' % (pipes[fd].pid, pipes[fd].poll()))
+
+      buffer = self.buffers[fd]
+      buffer += data
+      messages, frames, packets = decode_messages(buffer, self.table)
+      if messages:
+        received.append(pipes[fd])
+        self.stats['messages'] += messages
+        self.stats['frames'] += frames
+        self.stats['ipv4'] += packets
+
+    return received
+
+
+  def flush(self, on_flush):
+    flows = self.table.drain()
+    self.stats['flushes'] += 1
+    self.stats['flows'] += len(flows)
+    on_flush(flows)
+
+
+  def run(self, on_flush):
+    """
+    Method merges flow tables of workers until an exception is raised. The
+    merged flow table is handed over every interval seconds, or earlier if it
+    is full.
+
+    Arguments:
+    - on_flush: Function called with drained flows, see
+      flow_capture.FlowTable.drain method.
+    """
+
+    if not self.processes:
+      self.open()
+
+    deadline = time.monotonic() + self.interval
+    try:
+      while 1:
+        self.poll(max(0, deadline - time.monotonic()))
+        if time.monotonic() >= deadline or len(self.table) >= self.max_flows:
+          self.flush(on_flush)
+          deadline = time.monotonic() + self.interval
+    finally:
+      self.close()
+
+
+
+
+
+def run_worker(ifaces, local_ips, group, interval, ring = None):
+  """
+  Function runs a capture worker, which sends its flow table to standard
+  output every interval seconds. It returns when the Agent closes the pipe.
+  """
+
+  out = sys.stdout.buffer
+  if ring is not None:
+    capture = tpacket_ring.RingCapture(ifaces, local_ips, interval, fanout = group, **ring)
+  else:
+    capture = flow_capture.FlowCapture(ifaces, local_ips, interval, fanout = group)
+  capture.open()
+
+  sent = {'frames': 0, 'ipv4': 0}
+  def send(flows):
+    frames = capture.stats['frames'] - sent['frames']
+    packets = capture.stats['ipv4'] - sent['ipv4']
+    sent['frames'] = capture.stats['frames']
+    sent['ipv4'] = capture.stats['ipv4']
+    out.write(encode_flows(flows, frames, packets))
+    out.flush()
+
+  send({})
+  try:
+    capture.run(send)
+  except (BrokenPipeError, KeyboardInterrupt):
+    pass
+
+
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Agent packet capture worker')
+  parser.add_argument('--worker', action = 'store_true', help = 'Run as capture worker')
+  parser.add_argument('--ifaces', type = str, required = True, help = 'Comma separated network interfaces')
+  parser.add_argument('--local_ips', type = str, default = '', help = 'Comma separated IPv4 addresses of the Agent')
+  parser.add_argument('--group', type = int, required = True, help = 'PACKET_FANOUT group ID of the first interface')
+  parser.add_argument('--interval', type = float, default = WORKER_INTERVAL, help = 'Interval (s) between two flow tables sent')
+  parser.add_argument('--ring_block_size', type = int, default = 0, help = 'Capture with memory-mapped rings of given block size')
+  parser.add_argument('--ring_frames', type = int, default = tpacket_ring.FRAME_COUNT, help = 'Number of ring frame slots')
+  parser.add_argument('--ring_retire_timeout', type = int, default = tpacket_ring.RETIRE_TIMEOUT, help = 'Ring block retire timeout (ms)')
+  args = parser.parse_args(sys.argv[1:])
+
+  ifaces = [iface for iface in args.ifaces.split(',') if iface]
+  local_ips = [ip_addr for ip_addr in args.local_ips.split(',') if ip_addr]
+  ring = None
+  if args.ring_block_size:
+    ring = {'block_size': args.ring_block_size, 'frame_count': args.ring_frames,
+            'retire_timeout': args.ring_retire_timeout}
+  try:
+    run_worker(ifaces, local_ips, args.group, args.interval, ring)
+  except OSError as e:
+    sys.stderr.write('Capture worker failed: %s\n' % e)
+    sys.exit(1)
+
+
+
+
+if __name__ == '__main__':
+  main()
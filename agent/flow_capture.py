@@ -0,0 +1,311 @@
+"""
+Module Name:
+  flow_capture.py
+
+
+Description:
+  Module provides the flow-aggregating packet capture pipeline of IP traffic
+  monitoring. Frames are read from AF_PACKET sockets, only the first bytes of
+  every frame are copied, and only the fields needed for a 5-tuple (IPv4
+  source and destination, protocol, TCP/UDP ports) are unpacked with struct,
+  without dissecting the packet. Packets are added to an in-memory flow
+  table, which is handed over as aggregated flow records (bytes, packets,
+  first and last seen) every few seconds, so the database is written in one
+  batched transaction per interval instead of once per packet.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import select
+import socket
+import struct
+import time
+
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+ETH_P_8021Q = 0x8100
+ETH_P_8021AD = 0x88a8
+
+# Packet type of frames sent by this host, see packet(7).
+PACKET_OUTGOING = 4
+
+# Fanout options from <linux/if_packet.h>. Hash mode spreads packets by a
+# symmetric flow hash, so both directions of a flow go to the same socket.
+SOL_PACKET = 263
+PACKET_FANOUT = 18
+PACKET_FANOUT_HASH = 0
+PACKET_FANOUT_FLAG_DEFRAG = 0x8000
+
+# IP protocols with ports in the first 4 bytes of their header.
+PORT_PROTOCOLS = (socket.IPPROTO_TCP, socket.IPPROTO_UDP, 132)
+
+# Bytes copied of every frame: Ethernet and VLAN headers, IPv4 header with
+# options and ports.
+SNAP_LEN = 96
+
+# Interval (s) between two flushes of the flow table.
+FLUSH_INTERVAL = 10
+
+# Maximum number of flows in the table. A full table is flushed early.
+MAX_FLOWS = 65536
+
+# Maximum number of frames read from one socket at once.
+READ_BATCH = 256
+
+# Receive buffer (bytes) of capture sockets.
+RCVBUF_SIZE = 4 * 1024 * 1024
+
+ETHERTYPE = struct.Struct('!H')
+# Version and header length, fragment offset, protocol, source and destination.
+IPV4_HEADER = struct.Struct('!B5xHxB2x4s4s')
+PORTS = struct.Struct('!HH')
+
+
+
+
+
+def parse_frame(frame, start = 0):
+  """
+  Function unpacks flow key of an Ethernet frame.
+
+  Arguments:
+  - frame: Frame (bytes, bytearray, memoryview or mmap), at least its first
+    SNAP_LEN bytes.
+  - start: Offset of the frame in given buffer, so frames in a shared buffer
+    are parsed without copying them.
+
+  Returns Tuple (source IPv4 address, destination IPv4 address, protocol,
+  source port, destination port) or None if frame is not an IPv4 packet.
+  Addresses are 4 bytes long in network order. Ports are 0 if protocol has
+  none or packet is a non-first fragment.
+  """
+
+  try:
+    ethertype = ETHERTYPE.unpack_from(frame, start + 12)[0]
+    offset = start + 14
+    if ethertype == ETH_P_8021Q or ethertype == ETH_P_8021AD:
+      ethertype = ETHERTYPE.unpack_from(frame, start + 16)[0]
+      offset = start + 18
+    if ethertype != ETH_P_IP:
+      return None
+
+    version, fragment, proto, src, dst = IPV4_HEADER.unpack_from(frame, offset)
+    if version >> 4 != 4:
+      return None
+
+    if proto in PORT_PROTOCOLS and not fragment & 0x1fff:
+      sport, dport = PORTS.unpack_from(frame, offset + (version & 0x0f) * 4)
+      return (src, dst, proto, sport, dport)
+
+    return (src, dst, proto, 0, 0)
+  except struct.error:
+    return None
+
+
+
+
+
+class FlowTable(object):
+  """
+  Unidirectional 5-tuple flow table.
+  """
+
+  def __init__(self):
+    # Key is flow key (see parse_frame function) and value is a list [bytes,
+    # packets, first seen, last seen].
+    self.flows = {}
+
+
+  def add(self, key, length, ts):
+    """
+    Method counts a packet of length bytes seen at ts (Unix time (s)).
+    """
+
+    entry = self.flows.get(key)
+    if entry is None:
+      self.flows[key] = [length, 1, ts, ts]
+    else:
+      entry[0] += length
+      entry[1] += 1
+      entry[3] = ts
+
+
+  def merge(self, key, octets, packets, first, last):
+    """
+    Method adds an aggregated flow, e.g., of another flow table.
+    """
+
+    entry = self.flows.get(key)
+    if entry is None:
+      self.flows[key] = [octets, packets, first, last]
+    else:
+      entry[0] += octets
+      entry[1] += packets
+      entry[2] = min(entry[2], first)
+      entry[3] = max(entry[3], last)
+
+
+  def drain(self):
+    """
+    Method returns all flows and empties the table.
+    """
+
+    flows = self.flows
+    self.flows = {}
+    return flows
+
+
+  def __len__(self):
+    return len(self.flows)
+
+
+
+
+
+class FlowCapture(object):
+  """
+  AF_PACKET capture of IPv4 traffic into a flow table.
+  """
+
+  def __init__(self, ifaces, local_ips = (), interval = FLUSH_INTERVAL, max_flows = MAX_FLOWS, fanout = None):
+    """
+    Arguments:
+    - ifaces: A list of network interface names.
+    - local_ips: IPv4 addresses of the Agent. Frames sent by this host are
+      counted only if their source is one of them, so packets forwarded
+      between two monitored interfaces are not counted twice.
+    - interval: Interval (s) between two flushes of the flow table.
+    - max_flows: Maximum number of flows in the table.
+    - fanout: PACKET_FANOUT group ID of the first interface, next interfaces
+      use the following IDs. Sockets of all captures with the same group
+      share the interface's packets, hashed by flow. None disables fanout.
+    """
+
+    self.ifaces = list(ifaces)
+    self.local_ips = set(socket.inet_aton(ip_addr) for ip_addr in local_ips)
+    self.interval = float(interval)
+    self.max_flows = int(max_flows)
+    self.fanout = fanout
+    self.table = FlowTable()
+    self.socks = []
+    self.buffer = bytearray(SNAP_LEN)
+    self.stats = {'frames': 0, 'ipv4': 0, 'bytes': 0, 'flushes': 0, 'flows': 0}
+
+
+  def open(self):
+    """
+    Method opens a capture socket on every interface. Raises OSError (e.g.,
+    PermissionError if the Agent is not root).
+    """
+
+    self.close()
+    try:
+      for index, iface in enumerate(self.ifaces):
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        self.socks.append(sock)
+        self.setup_socket(sock)
+        sock.bind((iface, ETH_P_ALL))
+        if self.fanout is not None:
+          mode = PACKET_FANOUT_HASH | PACKET_FANOUT_FLAG_DEFRAG
+          # Defrag flag sets the sign bit, so option is passed as unsigned.
+          value = ((self.fanout + index) & 0xffff) | (mode << 16)
+          sock.setsockopt(SOL_PACKET, PACKET_FANOUT, struct.pack('=I', value))
+        sock.setblocking(False)
+    except OSError:
+      self.close()
+      raise
+
+
+  def setup_socket(self, sock):
+    """
+    Method sets options of a new capture socket before it is bound.
+    """
+
+    try:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+    except OSError:
+      pass
+
+
+  def close(self):
+    for sock in self.socks:
+      sock.close()
+    self.socks = []
+
+
+  def read(self, sock, now):
+    """
+    Method adds up to READ_BATCH frames waiting on given socket to the flow
+    table. Only SNAP_LEN bytes of a frame are copied, MSG_TRUNC tells its
+    real length.
+    """
+
+    buffer = self.buffer
+    table = self.table
+    local_ips = self.local_ips
+    stats = self.stats
+
+    for i in range(READ_BATCH):
+      try:
+        length, address = sock.recvfrom_into(buffer, SNAP_LEN, socket.MSG_TRUNC)
+      except (BlockingIOError, InterruptedError):
+        return
+
+      stats['frames'] += 1
+      key = parse_frame(buffer)
+      if key is None:
+        continue
+      if address[2] == PACKET_OUTGOING and key[0] not in local_ips:
+        continue
+
+      stats['ipv4'] += 1
+      stats['bytes'] += length
+      table.add(key, length, now)
+
+
+  def poll(self, timeout):
+    """
+    Method waits up to timeout seconds for frames and adds them to the flow
+    table.
+    """
+
+    readable, writable, errors = select.select(self.socks, [], [], timeout)
+    now = time.time()
+    for sock in readable:
+      self.read(sock, now)
+
+
+  def flush(self, on_flush):
+    flows = self.table.drain()
+    self.stats['flushes'] += 1
+    self.stats['flows'] += len(flows)
+    on_flush(flows)
+
+
+  def run(self, on_flush):
+    """
+    Method captures traffic until an exception is raised. Flow table is
+    handed over every interval seconds, or earlier if it is full.
+
+    Arguments:
+    - on_flush: Function called with drained flows, see FlowTable.drain
+      method.
+    """
+
+    if not self.socks:
+      self.open()
+
+    deadline = time.monotonic() + self.interval
+    try:
+      while 1:
+        self.poll(max(0, deadline - time.monotonic()))
+        if time.monotonic() >= deadline or len(self.table) >= self.max_flows:
+          self.flush(on_flush)
+          deadline = time.monotonic() + self.interval
+    finally:
+      self.close()
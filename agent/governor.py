@@ -0,0 +1,365 @@
+"""
+Module Name:
+  governor.py
+
+
+Description:
+  Module provides the Agent-wide packet rate governor. All probe engines
+  (device discovery, TCP, SYN and UDP port scanners and the banner grabber)
+  draw packets from it, so the Agent's total probe traffic stays within a
+  global and a per-interface budget of packets per second and bytes per
+  second, e.g., on low bandwidth radio links.
+
+  Budgets are token buckets. When the budget is tight higher priorities win:
+  a lower priority may use only the upper part of a bucket, and gets nothing
+  at all for a short time after a higher priority has been refused, so device
+  discovery is not starved by port scanning.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import asyncio
+import ipaddress
+import threading
+import time
+import traceback
+
+import iface_watcher
+import probe_scheduler
+import utils
+
+
+# Priorities, lower wins.
+PRIORITY_DISCOVERY = 0
+PRIORITY_SCAN = 1
+PRIORITY_FINGERPRINT = 2
+
+# Share of every bucket, which a priority may not use.
+RESERVE = {PRIORITY_DISCOVERY: 0.0, PRIORITY_SCAN: 0.5, PRIORITY_FINGERPRINT: 0.75}
+
+# Time (s) after a priority was refused, during which lower priorities get no
+# tokens of the same budget.
+YIELD_TIME = 0.5
+
+# Bucket size as seconds worth of tokens.
+BURST_TIME = 0.25
+
+# Minimum bucket sizes, so a bucket always holds a few packets above the
+# largest reserve.
+MIN_BURST_PACKETS = 4
+MIN_BURST_BYTES = 4 * 1518
+
+# Interval (s) between two attempts of a waiting caller.
+WAIT_INTERVAL = 0.01
+
+# Probe sizes (bytes) on the wire, including Ethernet header.
+ARP_PACKET_SIZE = 60
+SYN_PACKET_SIZE = 74
+UDP_HEADERS_SIZE = 42
+
+# Agent-wide governor, see configure function. None means unlimited.
+governor = None
+
+
+
+
+
+class Governor(object):
+  """
+  Global and per-interface packet and byte rate limiter with priorities.
+  """
+
+  def __init__(self, pps = 0, bps = 0, iface_pps = 0, iface_bps = 0, iface_limits = None):
+    """
+    Arguments:
+    - pps: Global packets per second. 0 or None is unlimited.
+    - bps: Global bytes per second. 0 or None is unlimited.
+    - iface_pps: Packets per second of every network interface.
+    - iface_bps: Bytes per second of every network interface.
+    - iface_limits: A dictionary, which overrides per-interface budget of
+      some interfaces, e.g., {'wlan0': {'pps': 50, 'bps': 8000}}.
+    """
+
+    self.iface_pps = float(iface_pps or 0)
+    self.iface_bps = float(iface_bps or 0)
+    self.iface_limits = iface_limits or {}
+
+    # Key is network interface name (None is the global budget) and value is
+    # a tuple (packet bucket, byte bucket).
+    self.buckets = {None: self.new_buckets(pps, bps)}
+    # Key is (network interface name or None, priority) and value is the last
+    # time (monotonic) the priority was refused by that budget.
+    self.refused = {}
+    # A list of (IPv4 network, network interface name), see get_iface method.
+    self.subnets = []
+    self.lock = threading.Lock()
+
+    self.stats = dict((priority, {'packets': 0, 'bytes': 0, 'refused': 0}) for priority in RESERVE)
+
+
+  def new_buckets(self, pps, bps):
+    pps = float(pps or 0)
+    bps = float(bps or 0)
+    return (probe_scheduler.TokenBucket(pps, max(MIN_BURST_PACKETS, pps * BURST_TIME)),
+            probe_scheduler.TokenBucket(bps, max(MIN_BURST_BYTES, bps * BURST_TIME)))
+
+
+  def get_buckets(self, iface):
+    buckets = self.buckets.get(iface)
+    if buckets is None:
+      limits = self.iface_limits.get(iface, {})
+      buckets = self.new_buckets(limits.get('pps', self.iface_pps), limits.get('bps', self.iface_bps))
+      self.buckets[iface] = buckets
+
+    return buckets
+
+
+  def set_interfaces(self, ifaces):
+    """
+    Method sets monitored network interfaces, so probes can be charged to
+    the interface of their destination, see get_iface method.
+    """
+
+    subnets = []
+    for iface in ifaces:
+      try:
+        my_ip, subnet = utils.get_iface_subnet(iface)
+        subnets.append((subnet, iface))
+      except Exception:
+        continue
+
+    # Longest prefix first.
+    subnets.sort(key = lambda item: item[0].prefixlen, reverse = True)
+    self.subnets = subnets
+
+
+  def get_iface(self, ip_addr):
+    """
+    Method returns monitored network interface whose subnet contains given
+    IPv4 address, or None.
+    """
+
+    try:
+      address = ipaddress.IPv4Address(ip_addr)
+    except ValueError:
+      return None
+
+    for subnet, iface in self.subnets:
+      if address in subnet:
+        return iface
+
+    return None
+
+
+  def take(self, iface, count = 1, size = 0, priority = PRIORITY_SCAN, now = None):
+    """
+    Method takes budget of up to count packets of given size.
+
+    Arguments:
+    - iface: Network interface name or None, if it is not known. Then only
+      the global budget applies.
+    - count: Number of packets.
+    - size: Size (bytes) of one packet.
+    - priority: PRIORITY_DISCOVERY, PRIORITY_SCAN or PRIORITY_FINGERPRINT.
+    - now: Current monotonic time (s).
+
+    Returns number of packets, which may be sent.
+    """
+
+    if now is None:
+      now = time.monotonic()
+
+    levels = [None]
+    if iface is not None:
+      levels.append(iface)
+
+    with self.lock:
+      for level in levels:
+        for higher in range(priority):
+          if now - self.refused.get((level, higher), -YIELD_TIME) < YIELD_TIME:
+            self.stats[priority]['refused'] += 1
+            return 0
+
+      allowed = count
+      limiting = None
+      for level in levels:
+        for bucket, cost in zip(self.get_buckets(level), (1, size)):
+          if not bucket.rate or not cost:
+            continue
+          bucket.refill(now)
+          available = int((bucket.tokens - RESERVE[priority] * bucket.burst) / cost)
+          if available < allowed:
+            allowed = max(0, available)
+            limiting = level
+
+      if allowed < count:
+        self.refused[(limiting, priority)] = now
+        self.stats[priority]['refused'] += 1
+
+      if allowed:
+        for level in levels:
+          packets, octets = self.get_buckets(level)
+          if packets.rate:
+            packets.tokens -= allowed
+          if octets.rate:
+            octets.tokens -= allowed * size
+        self.stats[priority]['packets'] += allowed
+        self.stats[priority]['bytes'] += allowed * size
+
+    return allowed
+
+
+  def acquire(self, iface, count = 1, size = 0, priority = PRIORITY_SCAN):
+    """
+    Method blocks until budget of count packets is taken. See take method
+    for arguments.
+    """
+
+    while 1:
+      count -= self.take(iface, count, size, priority)
+      if count <= 0:
+        return
+      time.sleep(WAIT_INTERVAL)
+
+
+  async def wait(self, iface, count = 1, size = 0, priority = PRIORITY_SCAN):
+    """
+    Method does the same as acquire method, but it waits on the asyncio
+    event loop.
+    """
+
+    while 1:
+      count -= self.take(iface, count, size, priority)
+      if count <= 0:
+        return
+      await asyncio.sleep(WAIT_INTERVAL)
+
+
+  def budget(self, iface, priority, size, limit = None):
+    """
+    Method returns a view of this governor for one interface and priority
+    with take(count, now) method of TokenBucket, e.g., to be used as budget of
+    probe_scheduler.ProbeScheduler.
+
+    Arguments:
+    - iface: Network interface name.
+    - priority: Priority of probes.
+    - size: Size (bytes) of one probe.
+    - limit: TokenBucket, which limits probes as well.
+    """
+
+    return GovernorBudget(self, iface, priority, size, limit)
+
+
+  def get_stats(self):
+    """
+    Method returns a dictionary, where key is priority and value is a
+    dictionary of granted packets and bytes and number of refusals.
+    """
+
+    with self.lock:
+      return dict((priority, dict(stats)) for priority, stats in self.stats.items())
+
+
+
+
+
+class GovernorBudget(object):
+  """
+  Governor budget of one network interface and priority, see Governor.budget
+  method.
+  """
+
+  def __init__(self, governor, iface, priority, size, limit = None):
+    self.governor = governor
+    self.iface = iface
+    self.priority = priority
+    self.size = size
+    self.limit = limit
+
+
+  @property
+  def rate(self):
+    """
+    Packets per second allowed by the tightest budget, 0 if unlimited.
+    """
+
+    rates = []
+    if self.limit is not None and self.limit.rate:
+      rates.append(self.limit.rate)
+    for level in (None, self.iface):
+      with self.governor.lock:
+        packets, octets = self.governor.get_buckets(level)
+      if packets.rate:
+        rates.append(packets.rate)
+      if octets.rate and self.size:
+        rates.append(octets.rate / self.size)
+
+    return min(rates) if rates else 0
+
+
+  def take(self, count, now = None):
+    if self.limit is not None:
+      count = self.limit.take(count, now)
+      if not count:
+        return 0
+
+    taken = self.governor.take(self.iface, count, self.size, self.priority, now)
+    if self.limit is not None and taken < count:
+      self.limit.put(count - taken)
+
+    return taken
+
+
+
+
+
+def configure(options, ifaces = ()):
+  """
+  Function creates the Agent-wide governor if any budget is set. Interfaces'
+  subnets are refreshed whenever the interface table changes.
+
+  Arguments:
+  - options: A dictionary (e.g., command line data). Used keys are probe_pps,
+    probe_bps, iface_pps, iface_bps and iface_limits.
+  - ifaces: A list of monitored network interface names.
+
+  Returns the governor or None if there is no budget.
+  """
+
+  global governor
+
+  keys = ['probe_pps', 'probe_bps', 'iface_pps', 'iface_bps']
+  if not any(options.get(key) for key in keys) and not options.get('iface_limits'):
+    governor = None
+    return None
+
+  new_governor = Governor(options.get('probe_pps'), options.get('probe_bps'),
+                          options.get('iface_pps'), options.get('iface_bps'),
+                          options.get('iface_limits'))
+  ifaces = list(ifaces)
+  try:
+    new_governor.set_interfaces(ifaces)
+    table = iface_watcher.get_table()
+    if table is not None:
+      table.add_listener(lambda table: new_governor.set_interfaces(ifaces))
+  except Exception:
+    traceback.print_exc()
+
+  governor = new_governor
+  return governor
+
+
+
+
+
+def get_governor():
+  """
+  Function returns the Agent-wide governor or None if probes are not limited.
+  """
+
+  return governor
@@ -0,0 +1,323 @@
+"""
+Module Name:
+  heavy_hitters.py
+
+
+Description:
+  Module keeps track of the top external talkers (not local IPv4 addresses
+  exchanging the most traffic with local networks) in fixed memory. Two
+  Space-Saving summaries, one weighted by bytes and one by packets, hold at
+  most capacity addresses each; an address, which is not tracked yet,
+  replaces the smallest one and inherits its count as error bound.
+
+  Counts decay exponentially with a configurable half-life, so the summaries
+  tell who is talking now rather than since the Agent started. Decay uses
+  forward decay: new weights are scaled up by exp((t - landmark) / tau)
+  instead of scaling all counts down on every tick, which keeps updates O(log
+  capacity) and the order of counts intact.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import heapq
+import math
+import threading
+import time
+
+
+# Maximum number of addresses tracked by one summary.
+CAPACITY = 256
+
+# Time (s) after which a count is halved.
+HALF_LIFE = 300
+
+# Number of addresses reported, see get_top_talkers function.
+TOP_COUNT = 10
+
+# Decay exponent at which counts are rescaled to a new landmark, so scaled
+# weights stay far from float overflow.
+RESCALE_EXPONENT = 64
+
+# Shared top talkers tracker, see configure function.
+talkers = None
+
+
+
+
+
+class SpaceSaving(object):
+  """
+  Space-Saving summary of weighted items with forward exponential decay.
+  """
+
+  def __init__(self, capacity = CAPACITY, half_life = HALF_LIFE, now = None):
+    """
+    Arguments:
+    - capacity: Maximum number of tracked items.
+    - half_life: Time (s) after which a count is halved. 0 or None disables
+      decay.
+    - now: Monotonic time (s) of the landmark.
+    """
+
+    self.capacity = max(1, int(capacity))
+    self.tau = float(half_life) / math.log(2) if half_life else 0.0
+    self.landmark = time.monotonic() if now is None else now
+    # Key is item and value is a list [scaled count, scaled error].
+    self.counts = {}
+    # Min-heap of (scaled count, item), one entry per tracked item. Entries
+    # of grown items are stale until they reach the top.
+    self.heap = []
+    self.stats = {'updates': 0, 'evictions': 0, 'rescales': 0}
+
+
+  def scale(self, now):
+    """
+    Method returns factor of weights added at now, relative to the landmark.
+    """
+
+    if not self.tau:
+      return 1.0
+
+    exponent = (now - self.landmark) / self.tau
+    if exponent > RESCALE_EXPONENT:
+      self.rescale(now)
+      exponent = 0.0
+
+    return math.exp(exponent)
+
+
+  def rescale(self, now):
+    """
+    Method moves the landmark to now. All counts are multiplied by the same
+    factor, so the heap stays ordered.
+    """
+
+    factor = math.exp(-(now - self.landmark) / self.tau)
+    for entry in self.counts.values():
+      entry[0] *= factor
+      entry[1] *= factor
+    self.heap = [(count * factor, item) for count, item in self.heap]
+    self.landmark = now
+    self.stats['rescales'] += 1
+
+
+  def add(self, item, weight, now = None):
+    """
+    Method adds weight to item's count.
+    """
+
+    if now is None:
+      now = time.monotonic()
+
+    weight *= self.scale(now)
+    self.stats['updates'] += 1
+
+    entry = self.counts.get(item)
+    if entry is not None:
+      entry[0] += weight
+      return
+
+    if len(self.counts) < self.capacity:
+      self.counts[item] = [weight, 0.0]
+      heapq.heappush(self.heap, (weight, item))
+      return
+
+    # Replace the smallest item, skipping stale heap entries.
+    while 1:
+      count, smallest = self.heap[0]
+      current = self.counts[smallest][0]
+      if current != count:
+        heapq.heapreplace(self.heap, (current, smallest))
+        continue
+
+      del self.counts[smallest]
+      self.counts[item] = [count + weight, count]
+      heapq.heapreplace(self.heap, (count + weight, item))
+      self.stats['evictions'] += 1
+      return
+
+
+  def get(self, item, now = None):
+    """
+    Method returns Tuple (decayed count, decayed error) of item or None if it
+    is not tracked. True count lies between count - error and count.
+    """
+
+    entry = self.counts.get(item)
+    if entry is None:
+      return None
+
+    factor = self.decay(now)
+    return (entry[0] * factor, entry[1] * factor)
+
+
+  def decay(self, now = None):
+    if not self.tau:
+      return 1.0
+
+    if now is None:
+      now = time.monotonic()
+
+    return math.exp(-(now - self.landmark) / self.tau)
+
+
+  def top(self, count, now = None):
+    """
+    Method returns a list of up to count (item, decayed count, decayed error)
+    tuples, largest count first.
+    """
+
+    factor = self.decay(now)
+    largest = heapq.nlargest(count, self.counts.items(), key = lambda item: item[1][0])
+    return [(item, entry[0] * factor, entry[1] * factor) for item, entry in largest]
+
+
+  def __len__(self):
+    return len(self.counts)
+
+
+
+
+
+class HeavyHitters(object):
+  """
+  Top talkers by bytes and by packets.
+  """
+
+  def __init__(self, capacity = CAPACITY, half_life = HALF_LIFE, top_count = TOP_COUNT):
+    """
+    Arguments:
+    - capacity: Maximum number of addresses tracked by one summary.
+    - half_life: Time (s) after which a count is halved.
+    - top_count: Number of addresses reported, see get_top_talkers function.
+    """
+
+    self.capacity = capacity
+    self.half_life = half_life
+    self.top_count = int(top_count)
+    now = time.monotonic()
+    self.bytes = SpaceSaving(capacity, half_life, now)
+    self.packets = SpaceSaving(capacity, half_life, now)
+    self.lock = threading.Lock()
+
+
+  def update(self, ip_addr, octets, packets, now = None):
+    """
+    Method counts traffic of a not local IPv4 address.
+
+    Arguments:
+    - ip_addr: IPv4 address.
+    - octets: Number of bytes.
+    - packets: Number of packets.
+    - now: Monotonic time (s).
+    """
+
+    if now is None:
+      now = time.monotonic()
+
+    with self.lock:
+      self.bytes.add(ip_addr, octets, now)
+      self.packets.add(ip_addr, packets, now)
+
+
+  def top(self, count = TOP_COUNT, key = 'bytes', now = None):
+    """
+    Method returns the top talkers.
+
+    Arguments:
+    - count: Maximum number of addresses.
+    - key: 'bytes' or 'packets', order of addresses.
+    - now: Monotonic time (s).
+
+    Returns a list of dictionaries with ip, bytes, packets, bytes_error and
+    packets_error keys, largest first. Counts are decayed sums; bytes or
+    packets are None if the address is not tracked by the other summary.
+    """
+
+    if now is None:
+      now = time.monotonic()
+
+    with self.lock:
+      ranked = self.bytes if key == 'bytes' else self.packets
+      other = self.packets if key == 'bytes' else self.bytes
+      other_key = 'packets' if key == 'bytes' else 'bytes'
+
+      result = []
+      for ip_addr, value, error in ranked.top(count, now):
+        data = {'ip': ip_addr, key: round(value, 1), key + '_error': round(error, 1),
+                other_key: None, other_key + '_error': None}
+        estimate = other.get(ip_addr, now)
+        if estimate is not None:
+          data[other_key] = round(estimate[0], 1)
+          data[other_key + '_error'] = round(estimate[1], 1)
+        result.append(data)
+
+    return result
+
+
+  def get_stats(self):
+    with self.lock:
+      return {'bytes': dict(self.bytes.stats, tracked = len(self.bytes)),
+              'packets': dict(self.packets.stats, tracked = len(self.packets))}
+
+
+
+
+
+def configure(options):
+  """
+  Function creates the shared top talkers tracker.
+
+  Arguments:
+  - options: A dictionary (e.g., command line data). Used keys are
+    talkers_half_life and top_talkers.
+
+  Returns the tracker.
+  """
+
+  global talkers
+
+  talkers = HeavyHitters(CAPACITY, options.get('talkers_half_life', HALF_LIFE),
+                         options.get('top_talkers') or TOP_COUNT)
+  return talkers
+
+
+
+
+
+def get_talkers():
+  """
+  Function returns the shared top talkers tracker, it is created with default
+  settings if configure function has not been called.
+  """
+
+  global talkers
+
+  if talkers is None:
+    talkers = HeavyHitters()
+
+  return talkers
+
+
+
+
+
+def get_top_talkers(now = None):
+  """
+  Function returns the top talkers by bytes and by packets.
+
+  Returns a dictionary with by_bytes and by_packets lists (see
+  HeavyHitters.top method), or an empty dictionary if no external traffic
+  has been seen.
+  """
+
+  tracker = get_talkers()
+  by_bytes = tracker.top(tracker.top_count, 'bytes', now)
+  if not by_bytes:
+    return {}
+
+  return {'by_bytes': by_bytes, 'by_packets': tracker.top(tracker.top_count, 'packets', now)}
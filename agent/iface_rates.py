@@ -0,0 +1,315 @@
+"""
+Module Name:
+  iface_rates.py
+
+
+Description:
+  Module keeps in-memory time series of network interfaces' traffic rates.
+  Every interface has array-backed ring buffers for its counters (RX/TX bytes,
+  packets and dropped packets) in three tiers with 1 s, 1 min and 1 h
+  resolution. Rates are computed from counter differences over monotonic
+  time, counter resets are detected, and memory footprint is fixed
+  (about 60 KB per interface), so consumers can read the last minutes or
+  hours of an interface without touching SQLite.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import threading
+import time
+from array import array
+
+
+# Counters kept for every interface.
+COUNTERS = ('rx_bytes', 'rx_packets', 'rx_dropped', 'tx_bytes', 'tx_packets', 'tx_dropped')
+
+# Tiers as (name, resolution (s), number of slots): 5 minutes of seconds,
+# 24 hours of minutes and 7 days of hours.
+TIERS = (('1s', 1, 300), ('1m', 60, 1440), ('1h', 3600, 168))
+
+# Range of 32-bit counters, which wrap around. Counters read by iface_stats
+# module (IFLA_STATS64 or /proc/net/dev) are 64-bit and do not wrap in
+# practice.
+COUNTER_32_WRAP = 1 << 32
+
+
+
+
+
+class RateTier(object):
+  """
+  Ring buffer of counter increments of one interface in fixed size time
+  slots.
+  """
+
+  def __init__(self, resolution, size, counters = COUNTERS):
+    """
+    Arguments:
+    - resolution: Slot length (s).
+    - size: Number of slots.
+    - counters: Counter names.
+    """
+
+    self.resolution = resolution
+    self.size = size
+    # Slot number (monotonic time // resolution) stored at every position,
+    # -1 if position is empty.
+    self.slots = array('i', [-1]) * size
+    # Seconds of every slot covered by samples.
+    self.covered = array('f', [0.0]) * size
+    # Counter increments in every slot.
+    self.sums = dict((counter, array('f', [0.0]) * size) for counter in counters)
+
+
+  def add(self, start, end, deltas):
+    """
+    Method spreads counter increments measured between start and end
+    (monotonic time) evenly over the slots they cover.
+    """
+
+    duration = float(end - start)
+    # Slots older than the ring are not kept anyway.
+    start = max(start, end - self.size * self.resolution)
+    slot = int(start // self.resolution)
+
+    while slot * self.resolution < end:
+      share = min(end, (slot + 1) * self.resolution) - max(start, slot * self.resolution)
+      if share > 0:
+        pos = slot % self.size
+        if self.slots[pos] != slot:
+          self.slots[pos] = slot
+          self.covered[pos] = 0.0
+          for values in self.sums.values():
+            values[pos] = 0.0
+
+        self.covered[pos] += share
+        weight = share / duration
+        for counter, delta in deltas.items():
+          self.sums[counter][pos] += delta * weight
+
+      slot += 1
+
+
+  def get(self, counter, last_slot, count):
+    """
+    Method returns rates (per second) of count slots up to last_slot, oldest
+    first. Slots without samples are None.
+    """
+
+    values = self.sums[counter]
+    rates = []
+    for slot in range(last_slot - count + 1, last_slot + 1):
+      pos = slot % self.size
+      if slot < 0 or self.slots[pos] != slot or not self.covered[pos]:
+        rates.append(None)
+      else:
+        rates.append(values[pos] / self.covered[pos])
+
+    return rates
+
+
+
+
+
+class InterfaceRates(object):
+  """
+  Rate tiers and last counter sample of one network interface.
+  """
+
+  def __init__(self, counters = COUNTERS, counter_bits = 64):
+    """
+    Arguments:
+    - counters: Counter names.
+    - counter_bits: Width of the counters source, 32 or 64. Wraps are
+      detected only for 32-bit counters.
+    """
+
+    self.counters = counters
+    self.counter_bits = counter_bits
+    self.tiers = dict((name, RateTier(resolution, size, counters)) for name, resolution, size in TIERS)
+    self.prev = None
+    self.prev_time = None
+    self.current = {}
+    self.stats = {'samples': 0, 'wraps': 0, 'resets': 0}
+
+
+  def update(self, values, now):
+    """
+    Method adds a counter sample.
+
+    A counter, which went back, was reset (e.g., interface was re-created or
+    driver reloaded) and the interval since the previous sample is left
+    empty. Only if the source is known to be 32-bit, a counter which went
+    back by more than half of the range wrapped around.
+
+    Arguments:
+    - values: A dictionary of cumulative counters, e.g., see
+      iface_stats.get_snapshot function.
+    - now: Monotonic time (s) of the sample.
+    """
+
+    prev = self.prev
+    prev_time = self.prev_time
+    self.prev = dict((counter, values[counter]) for counter in self.counters if counter in values)
+    self.prev_time = now
+    self.stats['samples'] += 1
+
+    if prev is None or now <= prev_time:
+      return
+
+    deltas = {}
+    for counter, value in self.prev.items():
+      if counter not in prev:
+        continue
+
+      delta = value - prev[counter]
+      if delta < 0:
+        if self.counter_bits == 32 and -delta > COUNTER_32_WRAP // 2:
+          delta += COUNTER_32_WRAP
+          self.stats['wraps'] += 1
+        else:
+          self.stats['resets'] += 1
+          self.current = {}
+          return
+
+      deltas[counter] = delta
+
+    duration = now - prev_time
+    self.current = dict((counter, delta / duration) for counter, delta in deltas.items())
+    for tier in self.tiers.values():
+      tier.add(prev_time, now, deltas)
+
+
+
+
+
+class RateStore(object):
+  """
+  Traffic rate time series of all network interfaces.
+  """
+
+  def __init__(self, counter_bits = 64):
+    """
+    Arguments:
+    - counter_bits: Width of the counters source, see InterfaceRates.
+    """
+
+    self.counter_bits = counter_bits
+    # Key is network interface name and value is InterfaceRates.
+    self.ifaces = {}
+    self.lock = threading.Lock()
+    # Wall clock time minus monotonic time, to timestamp slots.
+    self.offset = time.time() - time.monotonic()
+
+
+  def update(self, iface, values, now = None):
+    """
+    Method adds a counter sample of given network interface.
+
+    Arguments:
+    - iface: Network interface name.
+    - values: A dictionary of cumulative counters. An empty dictionary (e.g.,
+      counters could not be read) is ignored.
+    - now: Monotonic time (s) of the sample.
+    """
+
+    if not values:
+      return
+
+    if now is None:
+      now = time.monotonic()
+
+    with self.lock:
+      rates = self.ifaces.get(iface)
+      if rates is None:
+        rates = InterfaceRates(counter_bits = self.counter_bits)
+        self.ifaces[iface] = rates
+      rates.update(values, now)
+
+
+  def retain(self, ifaces):
+    """
+    Method forgets network interfaces, which are not in given list.
+    """
+
+    ifaces = set(ifaces)
+    with self.lock:
+      for iface in list(self.ifaces):
+        if iface not in ifaces:
+          del self.ifaces[iface]
+
+
+  def get_current(self, iface):
+    """
+    Method returns a dictionary of rates (per second) between the last two
+    samples of given interface, e.g., {'rx_bytes': 1250.0, ...}. It is empty
+    if there are not two samples yet or a counter was reset.
+    """
+
+    with self.lock:
+      rates = self.ifaces.get(iface)
+      if rates is None:
+        return {}
+      return dict(rates.current)
+
+
+  def get_series(self, iface, counter, tier = '1m', count = 60, now = None):
+    """
+    Method returns time series of given counter's rate.
+
+    Arguments:
+    - iface: Network interface name.
+    - counter: Counter name, see COUNTERS.
+    - tier: '1s', '1m' or '1h'.
+    - count: Number of slots, at most the tier's number of slots.
+    - now: Monotonic time (s). Series ends with the slot containing it.
+
+    Returns a list of (slot start as Unix time (s), rate per second or None)
+    tuples, oldest first. Rate is None if there is no sample in the slot.
+    """
+
+    if now is None:
+      now = time.monotonic()
+
+    with self.lock:
+      rates = self.ifaces.get(iface)
+      if rates is None:
+        return []
+      slot_tier = rates.tiers[tier]
+      count = min(count, slot_tier.size)
+      last_slot = int(now // slot_tier.resolution)
+      values = slot_tier.get(counter, last_slot, count)
+
+    resolution = slot_tier.resolution
+    first_slot = last_slot - count + 1
+    return [((first_slot + i) * resolution + self.offset, value) for i, value in enumerate(values)]
+
+
+  def get_last_minutes(self, iface, counter, minutes):
+    """
+    Method returns rates (per second) of given counter in each of the last
+    minutes, oldest first, see get_series method.
+    """
+
+    return [value for ts, value in self.get_series(iface, counter, '1m', minutes)]
+
+
+  def get_stats(self):
+    """
+    Method returns a dictionary of sample, wrap and reset counters by network
+    interface.
+    """
+
+    with self.lock:
+      return dict((iface, dict(rates.stats)) for iface, rates in self.ifaces.items())
+
+
+
+
+
+# Shared rate store, fed by traffic_data module.
+rates = RateStore()
@@ -0,0 +1,171 @@
+"""
+Module Name:
+  iface_stats.py
+
+
+Description:
+  Module reads statistics of all network interfaces at once. One RTM_GETLINK
+  dump on a persistent rtnetlink socket (see netlink module) returns the
+  64-bit counters (IFLA_STATS64) of every interface, instead of reading six
+  files in /sys/class/net/<iface>/statistics/ per interface. If rtnetlink is
+  not available /proc/net/dev is parsed, which is a single read as well.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import struct
+import threading
+import traceback
+
+import netlink
+
+
+# Fields of struct rtnl_link_stats64 from <linux/if_link.h> in order. Older
+# kernels send fewer fields, newer ones may send more.
+STATS64_FIELDS = (
+  'rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes',
+  'rx_errors', 'tx_errors', 'rx_dropped', 'tx_dropped',
+  'multicast', 'collisions',
+  'rx_length_errors', 'rx_over_errors', 'rx_crc_errors', 'rx_frame_errors',
+  'rx_fifo_errors', 'rx_missed_errors',
+  'tx_aborted_errors', 'tx_carrier_errors', 'tx_fifo_errors',
+  'tx_heartbeat_errors', 'tx_window_errors',
+  'rx_compressed', 'tx_compressed', 'rx_nohandler', 'rx_otherhost_dropped'
+)
+
+# Columns of /proc/net/dev in order, mapped to STATS64_FIELDS names.
+PROC_NET_DEV_FIELDS = (
+  'rx_bytes', 'rx_packets', 'rx_errors', 'rx_dropped', 'rx_fifo_errors',
+  'rx_frame_errors', 'rx_compressed', 'multicast',
+  'tx_bytes', 'tx_packets', 'tx_errors', 'tx_dropped', 'tx_fifo_errors',
+  'collisions', 'tx_carrier_errors', 'tx_compressed'
+)
+
+
+
+
+
+def parse_stats64(payload):
+  """
+  Function parses IFLA_STATS64 attribute payload.
+
+  Returns a dictionary of counters, see STATS64_FIELDS.
+  """
+
+  count = min(len(payload) // 8, len(STATS64_FIELDS))
+  values = struct.unpack_from('=%dQ' % count, payload)
+  return dict(zip(STATS64_FIELDS, values))
+
+
+
+
+
+def read_proc_net_dev(path = '/proc/net/dev'):
+  """
+  Function parses /proc/net/dev.
+
+  Returns a dictionary, key is network interface name and value is a
+  dictionary of counters, see PROC_NET_DEV_FIELDS.
+  """
+
+  stats = {}
+  with open(path, 'r') as file_:
+    for line in file_.readlines()[2:]:
+      if ':' not in line:
+        continue
+      name, data = line.split(':', 1)
+      values = [int(value) for value in data.split()]
+      stats[name.strip()] = dict(zip(PROC_NET_DEV_FIELDS, values))
+
+  return stats
+
+
+
+
+
+class StatsCollector(object):
+  """
+  Bulk reader of network interfaces' statistics.
+  """
+
+  def __init__(self):
+    self.sock = None
+    self.lock = threading.Lock()
+    # 'netlink' or 'proc', source of the last snapshot.
+    self.source = None
+
+
+  def read_netlink(self):
+    """
+    Method dumps all links and returns a dictionary of their counters by
+    network interface name.
+    """
+
+    if self.sock is None:
+      self.sock = netlink.open_socket()
+
+    stats = {}
+    for msg_type, flags, msg in netlink.dump(netlink.RTM_GETLINK, sock = self.sock):
+      if msg_type != netlink.RTM_NEWLINK:
+        continue
+      index, iface_flags, attrs = netlink.parse_link(msg)
+      if netlink.IFLA_IFNAME not in attrs or netlink.IFLA_STATS64 not in attrs:
+        continue
+      name = attrs[netlink.IFLA_IFNAME].rstrip(b'\x00').decode()
+      stats[name] = parse_stats64(attrs[netlink.IFLA_STATS64])
+
+    return stats
+
+
+  def get_snapshot(self):
+    """
+    Method returns counters of all network interfaces read at once.
+
+    Returns a dictionary, key is network interface name and value is a
+    dictionary of counters (e.g., rx_bytes, tx_packets, rx_errors,
+    rx_fifo_errors, rx_frame_errors, ...), see STATS64_FIELDS. It is empty
+    if statistics cannot be read at all.
+    """
+
+    with self.lock:
+      try:
+        stats = self.read_netlink()
+        self.source = 'netlink'
+        return stats
+      except OSError:
+        # Socket may be broken (e.g., lost messages), open a new one next time.
+        if self.sock is not None:
+          self.sock.close()
+          self.sock = None
+
+      try:
+        stats = read_proc_net_dev()
+        self.source = 'proc'
+        return stats
+      except (OSError, ValueError):
+        traceback.print_exc()
+
+    return {}
+
+
+
+
+
+# Shared collector, see get_snapshot function.
+collector = StatsCollector()
+
+
+
+
+
+def get_snapshot():
+  """
+  Function returns counters of all network interfaces, see
+  StatsCollector.get_snapshot method.
+  """
+
+  return collector.get_snapshot()
@@ -0,0 +1,269 @@
+"""
+Module Name:
+  iface_watcher.py
+
+
+Description:
+  Module keeps an in-memory table of network interfaces, their MAC addresses
+  and IPv4 addresses with prefixes. The table is loaded with one link and one
+  address dump and then kept current by an rtnetlink subscription, so
+  consumers read it instead of enumerating adapters, and hot-plugged
+  interfaces (e.g., new VLAN subinterfaces) are picked up as they appear.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import socket
+import threading
+import traceback
+from datetime import datetime
+
+import netlink
+
+
+# Shared interface table, see get_table function.
+table = None
+table_lock = threading.Lock()
+
+
+
+
+
+def format_mac(mac_bytes):
+  return ':'.join('%02x' % b for b in mac_bytes)
+
+
+
+
+
+class InterfaceTable(object):
+  """
+  Interface/address/prefix table kept current by rtnetlink events.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    # Key is interface index, value is {'name': <name>, 'mac': <MAC>, 'flags': <flags>}.
+    self.links = {}
+    # Key is interface index, value is a dictionary, key is IPv4 address and
+    # value is {'addr': <IPv4>, 'prefixlen': <prefix length>, 'peer': <peer IPv4 or None>}.
+    self.addrs = {}
+    self.by_name = {}
+    self.by_ip = {}
+    # Incremented on every change, consumers may use it to rebuild derived data.
+    self.version = 0
+    self.listeners = []
+    self.thread = None
+
+
+  def load(self):
+    """
+    Method loads the table with one link dump and one IPv4 address dump.
+    """
+
+    links = netlink.dump(netlink.RTM_GETLINK)
+    addrs = netlink.dump(netlink.RTM_GETADDR, socket.AF_INET)
+
+    with self.lock:
+      self.links.clear()
+      self.addrs.clear()
+      for msg_type, flags, msg in links:
+        self.apply_link(msg_type, msg)
+      for msg_type, flags, msg in addrs:
+        self.apply_addr(msg_type, msg)
+      self.reindex()
+
+    self.changed()
+
+
+  def apply_link(self, msg_type, msg):
+    index, flags, attrs = netlink.parse_link(msg)
+    if msg_type == netlink.RTM_DELLINK:
+      self.links.pop(index, None)
+      self.addrs.pop(index, None)
+      return
+
+    if netlink.IFLA_IFNAME not in attrs:
+      return
+
+    name = attrs[netlink.IFLA_IFNAME].rstrip(b'\x00').decode()
+    mac = ''
+    if netlink.IFLA_ADDRESS in attrs:
+      mac = format_mac(attrs[netlink.IFLA_ADDRESS])
+
+    self.links[index] = {'name': name, 'mac': mac, 'flags': flags}
+
+
+  def apply_addr(self, msg_type, msg):
+    family, prefixlen, index, attrs = netlink.parse_addr(msg)
+    if family != socket.AF_INET:
+      return
+
+    # For point-to-point interfaces IFA_LOCAL is local address and IFA_ADDRESS
+    # is the peer, otherwise they are equal.
+    local = attrs.get(netlink.IFA_LOCAL, attrs.get(netlink.IFA_ADDRESS))
+    if not local:
+      return
+    addr = socket.inet_ntoa(local)
+    peer = None
+    if netlink.IFA_ADDRESS in attrs and attrs[netlink.IFA_ADDRESS] != local:
+      peer = socket.inet_ntoa(attrs[netlink.IFA_ADDRESS])
+
+    iface_addrs = self.addrs.setdefault(index, {})
+    if msg_type == netlink.RTM_DELADDR:
+      iface_addrs.pop(addr, None)
+    else:
+      iface_addrs[addr] = {'addr': addr, 'prefixlen': prefixlen, 'peer': peer}
+
+
+  def reindex(self):
+    self.by_name = dict((link['name'], index) for index, link in self.links.items())
+    self.by_ip = {}
+    for index, iface_addrs in self.addrs.items():
+      for addr, data in iface_addrs.items():
+        self.by_ip[addr] = (index, data)
+    self.version += 1
+
+
+  def changed(self):
+    for listener in list(self.listeners):
+      try:
+        listener(self)
+      except Exception:
+        traceback.print_exc()
+
+
+  def add_listener(self, listener):
+    """
+    Method registers listener(table), which is called after every change of
+    interfaces or addresses.
+    """
+    self.listeners.append(listener)
+
+
+  def process(self, data):
+    """
+    Method applies received rtnetlink messages to the table.
+    """
+
+    with self.lock:
+      for msg_type, flags, msg in netlink.parse_messages(data):
+        if msg_type in (netlink.RTM_NEWLINK, netlink.RTM_DELLINK):
+          self.apply_link(msg_type, msg)
+        elif msg_type in (netlink.RTM_NEWADDR, netlink.RTM_DELADDR):
+          self.apply_addr(msg_type, msg)
+      self.reindex()
+
+    self.changed()
+
+
+  def watch(self, sock):
+    """
+    Method reads rtnetlink events forever. It is meant to be a thread target.
+    """
+
+    while 1:
+      try:
+        data = sock.recv(netlink.RECV_BUFFER)
+        self.process(data)
+      except OSError as e:
+        # ENOBUFS, events were lost, so reload the whole table.
+        utc_time_now = str(datetime.utcnow())
+        print('[' + utc_time_now + '] ' + 'Interface watcher: %s, reloading interface table' % e)
+        try:
+          self.load()
+        except Exception:
+          traceback.print_exc()
+
+
+  def start(self):
+    """
+    Method subscribes to link and IPv4 address events, loads the table and
+    starts a thread which keeps it current.
+    """
+
+    # Subscribe before dumping, so no change is missed in between.
+    sock = netlink.open_socket(netlink.RTMGRP_LINK | netlink.RTMGRP_IPV4_IFADDR)
+    self.load()
+    self.thread = threading.Thread(target = self.watch, args = (sock,))
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  def get_interfaces(self, skip_loopback = True):
+    """
+    Method returns a list of network interface names.
+    """
+
+    with self.lock:
+      return [link['name'] for index, link in sorted(self.links.items())
+              if not (skip_loopback and link['flags'] & netlink.IFF_LOOPBACK)]
+
+
+  def get_mac(self, iface):
+    """
+    Method returns MAC address of given network interface or an empty string.
+    """
+
+    with self.lock:
+      index = self.by_name.get(iface)
+      if index is None:
+        return ''
+      return self.links[index]['mac']
+
+
+  def get_addresses(self, iface):
+    """
+    Method returns a list of IPv4 addresses of given network interface. Every
+    element is {'addr': <IPv4>, 'prefixlen': <prefix length>, 'peer': <peer IPv4 or None>}.
+    """
+
+    with self.lock:
+      index = self.by_name.get(iface)
+      if index is None:
+        return []
+      return [dict(data) for data in self.addrs.get(index, {}).values()]
+
+
+  def get_prefix_of_ip(self, ip_addr):
+    """
+    Method returns given IPv4 address in <IP>/<network prefix> format or '0'
+    if address is not configured on any interface.
+    """
+
+    with self.lock:
+      entry = self.by_ip.get(ip_addr)
+
+    if entry is None:
+      return '0'
+
+    return '%s/%d' % (ip_addr, entry[1]['prefixlen'])
+
+
+
+
+
+def get_table():
+  """
+  Function returns the shared interface table. The table is loaded and
+  its watcher thread started on the first call. If rtnetlink is not available
+  it returns None and callers should fall back to enumerating interfaces.
+  """
+
+  global table
+
+  with table_lock:
+    if table is None:
+      new_table = InterfaceTable()
+      try:
+        new_table.start()
+      except OSError:
+        traceback.print_exc()
+        return None
+      table = new_table
+
+  return table
@@ -4,7 +4,12 @@ Module Name:
 
 
 Description:
-  Module provides functionality to monitor IP traffic.
+  Module provides functionality to monitor IP traffic. Packets are aggregated
+  into 5-tuple flows (see flow_capture module) and flow records are stored on
+  the database in one transaction every flow_interval seconds. Addresses are
+  classified as local, external or ignored by longest prefix match (see
+  prefix_classifier module); flows between a local and an external address
+  feed the top talkers tracker (see heavy_hitters module).
 
 
 Authors:
@@ -14,35 +19,85 @@ Authors:
 
 
 import random
+import socket
+import time
+import traceback
 
 import db
-import utils
-from scapy.all import sniff
+import fanout_capture
+import flow_capture
+import heavy_hitters
+import prefix_classifier
+import tpacket_ring
 from datetime import datetime
 
 
 
-def run_ip_traffic_monitor(db_connection, net_interfaces, device_id, agent_ip):
+def run_ip_traffic_monitor(db_connection, net_interfaces, device_id, agent_ip, options = None):
   """
-  Function monitors IP traffic in real time using Scapy's sniff function.
-  If an exception occurres it will run again in 5 seconds.
+  Function monitors IP traffic in real time. Frames are captured on AF_PACKET
+  sockets, or their memory-mapped rings (see tpacket_ring module), by
+  capture_workers worker processes if it is set (see fanout_capture module),
+  or with Scapy's sniff function if sockets cannot be opened (e.g., the Agent
+  is not root). If an exception occurres it will run
+  again in 5 seconds.
 
   Arguments:
   - db_connection: sqlite3 database connection.
   - net_interfaces: A list of provided network interfaces.
   - device_id: An ID (UUID) of current device.
   - agent_ip: An IPv4 address of agent.
+  - options: A dictionary (e.g., command line data). Used keys are
+    flow_interval, flow_retention, top_talkers, talkers_half_life,
+    capture_workers, capture_backend, ring_block_size, ring_frames,
+    ring_retire_timeout, site_prefixes and ignore_prefixes.
   """
 
+  options = options or {}
+  talkers = heavy_hitters.configure(options)
+  interval = options.get('flow_interval') or flow_capture.FLUSH_INTERVAL
+  retention = options.get('flow_retention') or 3600
+  workers = options.get('capture_workers') or 0
+  ring = None
+  if options.get('capture_backend') == 'ring':
+    ring = {'block_size': options.get('ring_block_size') or tpacket_ring.BLOCK_SIZE,
+            'frame_count': options.get('ring_frames') or tpacket_ring.FRAME_COUNT,
+            'retire_timeout': options.get('ring_retire_timeout') or tpacket_ring.RETIRE_TIMEOUT}
+
+  ifaces = [data['iface'] for data in net_interfaces]
+  local_ips = [data['ip'].split('/')[0] for data in net_interfaces] + [agent_ip]
+  classifier = prefix_classifier.configure(options, net_interfaces, agent_ip)
+
+  def store(flows):
+    store_flows(db_connection, flows, classifier, retention, talkers)
+
+  use_scapy = False
   while 1:
     try:
-      arp_traffic_out = sniff(prn = ip_monitoring_callback(db_connection, net_interfaces, device_id, agent_ip), filter = "ip", store = 0);
+      if not use_scapy:
+        if workers:
+          capture = fanout_capture.FanoutCapture(ifaces, local_ips, workers, interval, ring = ring)
+        elif ring is not None:
+          capture = tpacket_ring.RingCapture(ifaces, local_ips, interval, **ring)
+        else:
+          capture = flow_capture.FlowCapture(ifaces, local_ips, interval)
+        try:
+          capture.open()
+        except OSError as e:
+          utc_time_now = str(datetime.utcnow())
+          print('[' + utc_time_now + '] ' + 'Packet capture is not available (%s), using Scapy' % e)
+          use_scapy = True
+          continue
+        capture.run(store)
+      else:
+        sniff_flows(ifaces, interval, store)
     except:
       utc_time_now = str(datetime.utcnow())
-      print('[' + utc_time_now + '] ' + 'An exception in ip_monitoring_callback function')
+      print('[' + utc_time_now + '] ' + 'An exception in IP traffic monitor')
+      traceback.print_exc()
 
     # Just random sleep between 1 and 5 seconds before starting next round.
-    # This will happen if an exception occurs in ip_monitoring_callback.
+    # This will happen if an exception occurs in the capture loop.
     random_seconds = random.randint(1, 6)
     time.sleep(random_seconds)
 
@@ -50,65 +105,95 @@ def run_ip_traffic_monitor(db_connection, net_interfaces, device_id, agent_ip):
 
 
 
-def ip_monitoring_callback(db_connection, net_interfaces, device_id, host_ip):
+def store_flows(db_connection, flows, classifier, retention, talkers, now = None):
   """
-  Function monitors IP traffic in real time using Scapy's sniff function and
-  result stores in the sqlite3 database.
+  Function stores flows of a drained flow table on the database in one
+  transaction. Flows of ignored addresses are skipped. Bytes and packets of
+  flows between a local and an external address are counted by the top
+  talkers tracker.
 
   Arguments:
-  - db_connection: sqlite3 database connection
-  - net_interfaces: A list of provided network interfaces
-  - device_id: An ID (UUID) of current device
-  - host_ip: An IP address of current device
+  - db_connection: sqlite3 database connection.
+  - flows: Flows, see flow_capture.FlowTable.drain method.
+  - classifier: prefix_classifier.PrefixClassifier of local networks.
+  - retention: Time (s) rows are kept.
+  - talkers: heavy_hitters.HeavyHitters.
+  - now: Time (s) of talkers' decay, monotonic time by default. Replayed
+    flows use capture time.
   """
 
-  # For example, if 10.2.x.x talks to 10.1.x.x that is fine.
-  subnet_ip_list = []
-  for data in net_interfaces:
-    local_ip = data['ip']
-    local_ip = local_ip.split('.')
-    subnet_ip_list.append(str(local_ip[0]))
+  classify = classifier.classify_packed
+  local = prefix_classifier.LOCAL
+  external = prefix_classifier.EXTERNAL
+  ignored = prefix_classifier.IGNORED
+
+  records = []
+  for (src, dst, proto, sport, dport), (octets, packets, first, last) in flows.items():
+    src_class = classify(src)
+    dst_class = classify(dst)
+    if src_class == ignored or dst_class == ignored:
+      continue
+
+    source_ip = socket.inet_ntoa(src)
+    destination_ip = socket.inet_ntoa(dst)
+    records.append((source_ip, destination_ip, proto, sport, dport,
+                    octets, packets, int(first * 1000), int(last * 1000)))
+
+    if src_class == local and dst_class == external:
+      talkers.update(destination_ip, octets, packets, now)
+    elif src_class == external and dst_class == local:
+      talkers.update(source_ip, octets, packets, now)
+
+  db.insert_flow_records(db_connection, records, retention)
+
+
 
-  host_parts = host_ip.split('.')
-  host_parts = str(host_parts[0]) + '.' + str(host_parts[1])
-  subnet_ip_list.append(host_parts)
 
+
+def sniff_flows(ifaces, interval, on_flush):
   """
-  Note that if I want to pass parameters into the sniff's custom_action function for
-  additional control or the ability to modularize out the custom_action function,
-  I have to use a nested function.
+  Function captures IP traffic with Scapy's sniff function into a flow table
+  and hands it over every interval seconds.
+
+  Arguments:
+  - ifaces: A list of network interface names.
+  - interval: Interval (s) between two flushes of the flow table.
+  - on_flush: Function called with drained flows.
   """
-  def upload_packet(packet):
-    utc_time_now = utils.get_unix_epoch_milliseconds()
 
-    if (packet and packet[0][1].src and packet[0][1].dst and
-        str(packet[0][1].dst) != '255.255.255.255' and str(packet[0][1].src) != '255.255.255.255'):
+  # Scapy is needed only by this fallback, so the flow pipeline (e.g., replay
+  # of captures) works without it.
+  from scapy.all import sniff
 
-      source_ip = packet[0][1].src
-      destination_ip = packet[0][1].dst
+  table = flow_capture.FlowTable()
+  while 1:
+    sniff(prn = ip_monitoring_callback(table), iface = ifaces or None, filter = "ip",
+          store = 0, timeout = interval)
+    on_flush(table.drain())
 
-      # Skip localhost and multicast DNS
-      if (source_ip != '127.0.0.1' and destination_ip != '127.0.0.1' and
-          source_ip != '239.255.255.250' and destination_ip != '239.255.255.250' and
-          source_ip != '224.0.0.251' and destination_ip != '224.0.0.251'):
 
-        src_parts = source_ip.split('.')
-        src_parts = str(src_parts[0])
-        dst_parts = destination_ip.split('.')
-        dst_parts = str(dst_parts[0])
 
-        if (src_parts in subnet_ip_list) and (dst_parts in subnet_ip_list):
-          event = 'IP traffic is inside of local network'
-          # Not sure if it makes sense to store this data on the database.
-          #ip_traffic_data = {'ts': utc_time_now, 'src': source_ip, 'dst': destination_ip, 'not_local_ip': ''}
-        else:
-          not_local_ip = source_ip
-          if src_parts in subnet_ip_list:
-            not_local_ip = destination_ip
 
-          ip_traffic_data = {'ts': utc_time_now, 'src': source_ip, 'dst': destination_ip, 'not_local_ip': not_local_ip}
-          db.insert_ip_traffic_data(db_connection, ip_traffic_data)
 
+def ip_monitoring_callback(table):
+  """
+  Function returns a callback of Scapy's sniff function, which adds captured
+  packets to given flow table.
 
-  return upload_packet
+  Arguments:
+  - table: flow_capture.FlowTable.
+  """
 
+  """
+  Note that if I want to pass parameters into the sniff's custom_action function for
+  additional control or the ability to modularize out the custom_action function,
+  I have to use a nested function.
+  """
+  def upload_packet(packet):
+    frame = bytes(packet)
+    key = flow_capture.parse_frame(frame)
+    if key is not None:
+      table.add(key, len(frame), float(packet.time))
+
+
+  return upload_packet
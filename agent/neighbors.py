@@ -0,0 +1,258 @@
+"""
+Module Name:
+  neighbors.py
+
+
+Description:
+  Module provides functionality to read the kernel IPv4 neighbor (ARP) table
+  and a neighbor cache shared by discovery workers.
+
+  An entry is taken as a sign of life only if its rtnetlink state is
+  REACHABLE, DELAY or PROBE. STALE entries of hosts, which have left, stay in
+  the kernel table for minutes, so they are used for MAC and hostname lookup
+  only. /proc/net/arp has no state, entries read from it are never live.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import socket
+import threading
+import time
+import traceback
+
+import netlink
+
+
+# ATF_COM flag from <net/if_arp.h>, entry is complete (has a MAC address).
+ATF_COM = 0x02
+
+INCOMPLETE_MAC = '00:00:00:00:00:00'
+
+# Neighbor states of a host, which has been confirmed recently or is being
+# confirmed right now.
+NUD_LIVE = netlink.NUD_REACHABLE | netlink.NUD_DELAY | netlink.NUD_PROBE
+
+
+
+
+
+def read_proc_arp(path = '/proc/net/arp'):
+  """
+  Function reads the kernel neighbor table from /proc/net/arp in one pass.
+
+  Arguments:
+  - path: Path of the ARP table file. By default it is set /proc/net/arp.
+
+  Returns a list of (IPv4 address, MAC address, network interface name)
+  tuples of complete entries. If file cannot be read it returns an empty list.
+  """
+
+  neighbors = []
+
+  try:
+    with open(path, 'r') as file_:
+      lines = file_.read().splitlines()
+  except IOError:
+    traceback.print_exc()
+    return neighbors
+
+  # Skip first line as it contains IP address, HW type, Flags, HW address,
+  # Mask and Device.
+  for line in lines[1:]:
+    # list = ['192.168.1.174', '0x1', '0x2', 'b0:e1:7e:c2:8c:8f', '*', 'enp0s3']
+    fields = line.split()
+    if len(fields) != 6:
+      continue
+
+    try:
+      flags = int(fields[2], 16)
+    except ValueError:
+      continue
+
+    mac = fields[3].lower()
+    if not (flags & ATF_COM) or mac == INCOMPLETE_MAC:
+      continue
+
+    neighbors.append((fields[0], mac, fields[5]))
+
+  return neighbors
+
+
+
+
+
+def read_netlink_neighbors():
+  """
+  Function reads the kernel neighbor table with one rtnetlink dump.
+
+  Returns a list of (IPv4 address, MAC address, network interface name, live)
+  tuples of entries with a MAC address. Live is True if entry's state is one
+  of NUD_LIVE states. Raises OSError if rtnetlink is not available.
+  """
+
+  neighbors = []
+  names = {}
+  for msg_type, flags, msg in netlink.dump(netlink.RTM_GETNEIGH, socket.AF_INET):
+    if msg_type != netlink.RTM_NEWNEIGH:
+      continue
+
+    family, index, state, attrs = netlink.parse_neigh(msg)
+    dst = attrs.get(netlink.NDA_DST)
+    lladdr = attrs.get(netlink.NDA_LLADDR)
+    if family != socket.AF_INET or not dst or len(dst) != 4 or not lladdr or len(lladdr) != 6:
+      continue
+
+    mac = ':'.join('%02x' % octet for octet in lladdr)
+    if mac == INCOMPLETE_MAC or state & (netlink.NUD_INCOMPLETE | netlink.NUD_FAILED):
+      continue
+
+    if index not in names:
+      try:
+        names[index] = socket.if_indextoname(index)
+      except OSError:
+        names[index] = None
+    if names[index] is None:
+      continue
+
+    neighbors.append((socket.inet_ntoa(dst), mac, names[index], bool(state & NUD_LIVE)))
+
+  return neighbors
+
+
+
+
+
+def read_neighbors(path = '/proc/net/arp'):
+  """
+  Function reads the kernel neighbor table with rtnetlink or, if it is not
+  available, from given ARP table file.
+
+  Returns a list of (IPv4 address, MAC address, network interface name, live)
+  tuples, see read_netlink_neighbors function. Entries of the ARP table file
+  are never live.
+  """
+
+  try:
+    return read_netlink_neighbors()
+  except OSError:
+    return [(ip_addr, mac_addr, iface, False) for ip_addr, mac_addr, iface in read_proc_arp(path)]
+
+
+
+
+
+class NeighborCache(object):
+  """
+  In-memory copy of the kernel neighbor table indexed by MAC and IPv4 address.
+  Table is re-read in one pass when it is older than ttl seconds, so lookups
+  of all discovery workers are answered from memory. Hostnames of neighbors
+  are resolved once and cached for hostname_ttl seconds.
+  """
+
+  def __init__(self, ttl = 2, hostname_ttl = 3600, path = '/proc/net/arp'):
+    """
+    Arguments:
+    - ttl: Maximum age (s) of the neighbor table copy.
+    - hostname_ttl: Time (s) a resolved hostname, or failed resolution, is
+      cached.
+    - path: Path of the ARP table file.
+    """
+
+    self.ttl = ttl
+    self.hostname_ttl = hostname_ttl
+    self.path = path
+    self.lock = threading.Lock()
+    self.loaded = None
+    self.entries = []
+    self.by_mac = {}
+    self.by_ip = {}
+    # Key is IPv4 address and value is Tuple (hostname, expiration time).
+    self.hostnames = {}
+
+
+  def refresh(self, force = False):
+    """
+    Method re-reads neighbor table if it is older than ttl seconds or force is
+    set.
+    """
+
+    with self.lock:
+      now = time.monotonic()
+      if not force and self.loaded is not None and now - self.loaded < self.ttl:
+        return
+
+      entries = read_neighbors(self.path)
+      by_mac = {}
+      by_ip = {}
+      for ip_addr, mac_addr, iface, live in entries:
+        by_mac[mac_addr] = (ip_addr, iface)
+        by_ip[ip_addr] = (mac_addr, iface)
+
+      self.entries = entries
+      self.by_mac = by_mac
+      self.by_ip = by_ip
+      self.loaded = now
+
+
+  def get_entries(self, iface = None, live_only = False):
+    """
+    Method returns a list of (IPv4 address, MAC address, network interface
+    name) tuples. If iface is given only neighbors of the interface are
+    returned. If live_only is set only neighbors in REACHABLE, DELAY or PROBE
+    state are returned, see read_neighbors function.
+    """
+
+    self.refresh()
+    return [(ip_addr, mac_addr, entry_iface) for ip_addr, mac_addr, entry_iface, live in self.entries
+            if (iface is None or entry_iface == iface) and (live or not live_only)]
+
+
+  def lookup_mac(self, mac_addr):
+    """
+    Method returns Tuple (IPv4 address, network interface name) of given MAC
+    address or None if it is not in the neighbor table.
+    """
+
+    self.refresh()
+    return self.by_mac.get(mac_addr.lower())
+
+
+  def lookup_ip(self, ip_addr):
+    """
+    Method returns Tuple (MAC address, network interface name) of given IPv4
+    address or None if it is not in the neighbor table.
+    """
+
+    self.refresh()
+    return self.by_ip.get(ip_addr)
+
+
+  def hostname(self, ip_addr):
+    """
+    Method returns hostname of given IPv4 address, or an empty string if it
+    cannot be resolved. Results are cached for hostname_ttl seconds.
+    """
+
+    now = time.monotonic()
+    cached = self.hostnames.get(ip_addr)
+    if cached and cached[1] > now:
+      return cached[0]
+
+    try:
+      hostname = socket.gethostbyaddr(ip_addr)[0]
+    except (socket.herror, socket.gaierror, OSError):
+      hostname = ''
+
+    self.hostnames[ip_addr] = (hostname, now + self.hostname_ttl)
+    return hostname
+
+
+
+
+
+# Neighbor cache shared by all discovery workers.
+cache = NeighborCache()
@@ -0,0 +1,256 @@
+"""
+Module Name:
+  netlink.py
+
+
+Description:
+  Module provides minimal rtnetlink (NETLINK_ROUTE) functionality: opening
+  sockets, dump requests and parsing of netlink messages and route attributes
+  with struct. Only what the Agent needs is implemented, which are link,
+  IPv4 address and neighbor messages.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import os
+import socket
+import struct
+
+
+NETLINK_ROUTE = 0
+
+# Multicast groups from <linux/rtnetlink.h>.
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+
+# Message types.
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+RTM_GETNEIGH = 30
+
+# Message flags.
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_DUMP = 0x300
+
+# Link attributes.
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_STATS64 = 23
+
+# Address attributes.
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_LABEL = 3
+
+# Neighbor attributes.
+NDA_DST = 1
+NDA_LLADDR = 2
+
+# Neighbor states from <linux/neighbour.h>.
+NUD_INCOMPLETE = 0x01
+NUD_REACHABLE = 0x02
+NUD_STALE = 0x04
+NUD_DELAY = 0x08
+NUD_PROBE = 0x10
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+NUD_PERMANENT = 0x80
+
+# Interface flags from <net/if.h>.
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_RUNNING = 0x40
+
+NLMSG_HEADER = struct.Struct('=LHHLL')
+IFINFOMSG = struct.Struct('=BxHiII')
+IFADDRMSG = struct.Struct('=BBBBI')
+NDMSG = struct.Struct('=BxxxiHBB')
+RTATTR = struct.Struct('=HH')
+
+RECV_BUFFER = 1 << 16
+
+
+
+
+
+def align(length):
+  """
+  Function returns length aligned to 4 bytes (NLMSG_ALIGN and RTA_ALIGN).
+  """
+  return (length + 3) & ~3
+
+
+
+
+
+def open_socket(groups = 0, rcvbuf = 1 << 20):
+  """
+  Function opens a NETLINK_ROUTE socket.
+
+  Arguments:
+  - groups: Bit mask of multicast groups to subscribe to.
+  - rcvbuf: Receive buffer size. Dumps of hundreds of interfaces and bursts
+    of events must fit into it.
+  """
+
+  sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+  try:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind((0, groups))
+  except:
+    sock.close()
+    raise
+
+  return sock
+
+
+
+
+
+def parse_attrs(data, offset):
+  """
+  Function parses route attributes starting at offset.
+
+  Returns a dictionary, key is attribute type and value is payload (bytes).
+  """
+
+  attrs = {}
+  end = len(data)
+  while offset + RTATTR.size <= end:
+    length, attr_type = RTATTR.unpack_from(data, offset)
+    if length < RTATTR.size:
+      break
+    attrs[attr_type & 0x3fff] = data[offset + RTATTR.size:offset + length]
+    offset += align(length)
+
+  return attrs
+
+
+
+
+
+def parse_messages(data):
+  """
+  Function splits received buffer into netlink messages.
+
+  Returns a list of (message type, flags, message bytes) tuples. Message bytes
+  do not contain netlink header.
+  """
+
+  messages = []
+  offset = 0
+  while offset + NLMSG_HEADER.size <= len(data):
+    length, msg_type, flags, seq, pid = NLMSG_HEADER.unpack_from(data, offset)
+    if length < NLMSG_HEADER.size:
+      break
+    messages.append((msg_type, flags, data[offset + NLMSG_HEADER.size:offset + length]))
+    offset += align(length)
+
+  return messages
+
+
+
+
+
+def parse_link(msg):
+  """
+  Function parses RTM_NEWLINK/RTM_DELLINK message.
+
+  Returns Tuple (interface index, interface flags, attributes dictionary).
+  """
+
+  family, dev_type, index, flags, change = IFINFOMSG.unpack_from(msg)
+  return (index, flags, parse_attrs(msg, IFINFOMSG.size))
+
+
+
+
+
+def parse_addr(msg):
+  """
+  Function parses RTM_NEWADDR/RTM_DELADDR message.
+
+  Returns Tuple (address family, prefix length, interface index, attributes
+  dictionary).
+  """
+
+  family, prefixlen, flags, scope, index = IFADDRMSG.unpack_from(msg)
+  return (family, prefixlen, index, parse_attrs(msg, IFADDRMSG.size))
+
+
+
+
+
+def parse_neigh(msg):
+  """
+  Function parses RTM_NEWNEIGH/RTM_DELNEIGH message.
+
+  Returns Tuple (address family, interface index, neighbor state (NUD_*),
+  attributes dictionary).
+  """
+
+  family, index, state, flags, neigh_type = NDMSG.unpack_from(msg)
+  return (family, index, state, parse_attrs(msg, NDMSG.size))
+
+
+
+
+
+def dump(msg_type, family = socket.AF_UNSPEC, sock = None):
+  """
+  Function sends a dump request (e.g., RTM_GETLINK) and reads the whole
+  answer.
+
+  Arguments:
+  - msg_type: Request message type, RTM_GETLINK, RTM_GETADDR or
+    RTM_GETNEIGH.
+  - family: Address family of the request.
+  - sock: NETLINK_ROUTE socket. If it is None a temporary socket is used.
+
+  Returns a list of (message type, flags, message bytes) tuples.
+  """
+
+  own_sock = sock is None
+  if own_sock:
+    sock = open_socket()
+
+  try:
+    if msg_type == RTM_GETADDR:
+      body = IFADDRMSG.pack(family, 0, 0, 0, 0)
+    elif msg_type == RTM_GETNEIGH:
+      body = NDMSG.pack(family, 0, 0, 0, 0)
+    else:
+      body = IFINFOMSG.pack(family, 0, 0, 0, 0)
+
+    seq = int.from_bytes(os.urandom(4), 'little')
+    header = NLMSG_HEADER.pack(NLMSG_HEADER.size + len(body), msg_type, NLM_F_REQUEST | NLM_F_DUMP, seq, 0)
+    sock.send(header + body)
+
+    messages = []
+    while 1:
+      data = sock.recv(RECV_BUFFER)
+      for message in parse_messages(data):
+        if message[0] == NLMSG_DONE:
+          return messages
+        if message[0] == NLMSG_ERROR:
+          error = struct.unpack_from('=i', message[2])[0]
+          if error:
+            raise OSError(-error, os.strerror(-error))
+          return messages
+        messages.append(message)
+  finally:
+    if own_sock:
+      sock.close()
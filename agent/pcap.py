@@ -0,0 +1,231 @@
+"""
+Module Name:
+  pcap.py
+
+
+Description:
+  Module provides a minimal reader and writer of classic pcap capture files
+  and a reader of pcapng files, so captured traffic can be replayed through
+  the Agent's packet pipelines (e.g., by benchmark.py and replay.py) without
+  Scapy.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import struct
+
+
+# Magic numbers of microsecond and nanosecond resolution files.
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+
+# Link type of Ethernet frames.
+LINKTYPE_ETHERNET = 1
+
+PCAP_HEADER = struct.Struct('=IHHiIII')
+RECORD_HEADER_SIZE = 16
+
+# Pcapng block types: section header, interface description, (obsolete)
+# packet, simple packet and enhanced packet block.
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_INTERFACE = 1
+PCAPNG_PACKET = 2
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+
+# Byte-order magic of a section header block.
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+# Interface description block option of timestamp resolution.
+PCAPNG_IF_TSRESOL = 9
+
+
+
+
+
+def read_pcap(path):
+  """
+  Function reads packets of a classic pcap file.
+
+  Arguments:
+  - path: File name.
+
+  Yields (timestamp (s), original length, frame) tuples. Frame may be shorter
+  than original length if it was captured with a snapshot length. Raises
+  ValueError if the file is not a pcap file or its link type is not
+  Ethernet.
+  """
+
+  with open(path, 'rb') as file_:
+    header = file_.read(PCAP_HEADER.size)
+    if len(header) < PCAP_HEADER.size:
+      raise ValueError('%s is not a pcap file' % path)
+
+    for endian in ('<', '>'):
+      magic, major, minor, zone, sigfigs, snaplen, linktype = struct.unpack(endian + PCAP_HEADER.format[1:], header)
+      if magic in (PCAP_MAGIC, PCAP_MAGIC_NSEC):
+        break
+    else:
+      raise ValueError('%s is not a pcap file' % path)
+
+    if linktype != LINKTYPE_ETHERNET:
+      raise ValueError('%s has unsupported link type %d' % (path, linktype))
+
+    record = struct.Struct(endian + 'IIII')
+    scale = 1e-9 if magic == PCAP_MAGIC_NSEC else 1e-6
+
+    while 1:
+      data = file_.read(RECORD_HEADER_SIZE)
+      if len(data) < RECORD_HEADER_SIZE:
+        return
+      seconds, fraction, captured, length = record.unpack(data)
+      frame = file_.read(captured)
+      if len(frame) < captured:
+        return
+      yield (seconds + fraction * scale, length, frame)
+
+
+
+
+
+def read_pcapng(path):
+  """
+  Function reads packets of a pcapng file. Packets of interfaces, whose link
+  type is not Ethernet, are skipped. Simple packet blocks have no timestamp,
+  they get the timestamp of the previous packet.
+
+  Arguments:
+  - path: File name.
+
+  Yields (timestamp (s), original length, frame) tuples. Raises ValueError if
+  the file is not a pcapng file.
+  """
+
+  with open(path, 'rb') as file_:
+    endian = None
+    # (link type, timestamp resolution (s)) of interfaces of current section.
+    interfaces = []
+    ts = 0.0
+
+    while 1:
+      header = file_.read(12)
+      if len(header) < 12:
+        return
+
+      block_type = struct.unpack('<I', header[:4])[0]
+      if block_type == PCAPNG_SECTION_HEADER:
+        # Section header block tells byte order of the section.
+        for endian in ('<', '>'):
+          if struct.unpack(endian + 'I', header[8:])[0] == PCAPNG_BYTE_ORDER_MAGIC:
+            break
+        else:
+          raise ValueError('%s is not a pcapng file' % path)
+        interfaces = []
+      elif endian is None:
+        raise ValueError('%s is not a pcapng file' % path)
+      else:
+        block_type = struct.unpack(endian + 'I', header[:4])[0]
+
+      length = struct.unpack(endian + 'I', header[4:8])[0]
+      if length < 12 or length % 4:
+        raise ValueError('%s has a corrupted block' % path)
+      # Body without type, length and trailing length, and first 4 bytes of
+      # body which were read with the header.
+      body = header[8:] + file_.read(length - 12)
+      if len(body) < length - 8:
+        return
+      body = body[:-4]
+
+      if block_type == PCAPNG_INTERFACE:
+        linktype, snaplen = struct.unpack_from(endian + 'HxxI', body)
+        interfaces.append((linktype, get_ts_resolution(body, 8, endian)))
+      elif block_type == PCAPNG_ENHANCED_PACKET or block_type == PCAPNG_PACKET:
+        if block_type == PCAPNG_ENHANCED_PACKET:
+          iface, high, low, captured, original = struct.unpack_from(endian + 'IIIII', body)
+        else:
+          iface, drops, high, low, captured, original = struct.unpack_from(endian + 'HHIIII', body)
+        if iface >= len(interfaces):
+          raise ValueError('%s has a packet of unknown interface %d' % (path, iface))
+        linktype, resolution = interfaces[iface]
+        ts = ((high << 32) | low) * resolution
+        if linktype == LINKTYPE_ETHERNET:
+          yield (ts, original, body[20:20 + captured])
+      elif block_type == PCAPNG_SIMPLE_PACKET:
+        if interfaces and interfaces[0][0] == LINKTYPE_ETHERNET:
+          original = struct.unpack_from(endian + 'I', body)[0]
+          yield (ts, original, body[4:4 + original])
+
+
+
+
+
+def get_ts_resolution(body, offset, endian):
+  """
+  Function returns timestamp resolution (s) of an interface description
+  block, microseconds if the block has no if_tsresol option.
+  """
+
+  while offset + 4 <= len(body):
+    code, length = struct.unpack_from(endian + 'HH', body, offset)
+    if code == 0:
+      break
+    if code == PCAPNG_IF_TSRESOL and length >= 1:
+      value = body[offset + 4]
+      # Most significant bit tells if the resolution is a power of 2 or 10.
+      if value & 0x80:
+        return 2.0 ** -(value & 0x7f)
+      return 10.0 ** -value
+    offset += 4 + (length + 3) // 4 * 4
+
+  return 1e-6
+
+
+
+
+
+def read_packets(path):
+  """
+  Function reads packets of a pcap or pcapng file, the format is detected by
+  the file's magic number. See read_pcap function.
+  """
+
+  with open(path, 'rb') as file_:
+    magic = file_.read(4)
+
+  if magic == struct.pack('<I', PCAPNG_SECTION_HEADER):
+    return read_pcapng(path)
+
+  return read_pcap(path)
+
+
+
+
+
+def write_pcap(path, packets, snaplen = 65535):
+  """
+  Function writes Ethernet frames into a classic pcap file with microsecond
+  resolution.
+
+  Arguments:
+  - path: File name.
+  - packets: Iterable of (timestamp (s), frame) tuples.
+  - snaplen: Snapshot length stored in the file header.
+
+  Returns number of written packets.
+  """
+
+  record = struct.Struct('=IIII')
+  count = 0
+  with open(path, 'wb') as file_:
+    file_.write(PCAP_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, snaplen, LINKTYPE_ETHERNET))
+    for ts, frame in packets:
+      seconds = int(ts)
+      file_.write(record.pack(seconds, int((ts - seconds) * 1e6), len(frame), len(frame)))
+      file_.write(frame)
+      count += 1
+
+  return count
@@ -13,56 +13,149 @@ Authors:
 """
 
 
-import nmap
-nmap_port_scan = nmap.PortScanner()
 import time
 import random
+import traceback
 
 from scapy.all import sr, sr1, IP, TCP, UDP
 from datetime import datetime
 
 import db
 import utils
+import tcp_scanner
+import syn_scanner
+import scan_scheduler
+import udp_scanner
+import banner_grabber
+
+# nmap is an optional backend, see scan_tcp_ports function.
+try:
+  import nmap
+  nmap_port_scan = nmap.PortScanner()
+except Exception:
+  nmap_port_scan = None
+
+
+# Default port scanning options. See scan_ports function.
+DEFAULT_OPTIONS = {
+  'port_backend': 'native',
+  'tcp_ports': '1-512',
+  'scan_concurrency': 512,
+  'scan_host_concurrency': 32,
+  'scan_timeout': 1.0,
+  'syn_rate': 2000,
+  'rescan_interval': 3600,
+  'scan_stale': 480,
+  'udp_ports': udp_scanner.DEFAULT_PORTS,
+  'udp_concurrency': 256,
+  'udp_host_rate': 10,
+  'udp_timeout': 2.0,
+  'udp_retries': 1,
+  'grab_banners': False,
+  'banner_concurrency': 32,
+  'banner_timeout': 3.0
+}
+
+
+# TCP and UDP port scan schedulers, see scan_tcp_ports and scan_udp_ports
+# functions.
+tcp_scheduler = None
+udp_scheduler = None
+
+
+
+
+
+def get_options(options):
+  """
+  Function returns port scanning options, where missing keys are set to
+  DEFAULT_OPTIONS values.
+
+  Arguments:
+  - options: A dictionary (e.g., command line data) or None.
+  """
+
+  ret = dict(DEFAULT_OPTIONS)
+  if options:
+    for key in DEFAULT_OPTIONS:
+      if options.get(key) is not None:
+        ret[key] = options[key]
+
+  return ret
+
 
 
-def scan_ports(db_connection):
+
+
+def scan_ports(db_connection, options = None):
   """
   Function scans TCP/UDP ports and result stores on the SQLite3 database.
 
   Arguments:
   - db_connection: SQLite3 database connection.
+  - options: A dictionary (e.g., command line data), keys are
+    - port_backend: 'native' scans all devices concurrently with the asyncio
+      connect scanner (see tcp_scanner module), 'syn' sends raw SYN packets
+      at syn_rate packets per second (see syn_scanner module, needs root),
+      'nmap' runs nmap for one device at a time.
+    - tcp_ports: TCP port set, e.g., '1-512,8080'.
+    - scan_concurrency: Maximum number of connection attempts in flight.
+    - scan_host_concurrency: Maximum number of connection attempts in flight to
+      a single device.
+    - scan_timeout: Connection attempt timeout (s). SYN scanner waits as
+      long for late replies.
+    - syn_rate: Maximum number of SYN packets per second.
+    - rescan_interval: Interval (s) between two scans of a stable device.
+      New devices and devices whose IPv4 address changed are scanned as soon
+      as possible.
+    - scan_stale: Devices not seen for more than scan_stale seconds are not
+      scanned.
+    - udp_ports: UDP port set. An empty string disables UDP scanning.
+    - udp_concurrency: Maximum number of UDP probes in flight.
+    - udp_host_rate: Maximum number of UDP probes per second sent to one
+      device.
+    - udp_timeout: Time (s) to wait for a reply to a UDP probe.
+    - udp_retries: Number of retransmissions of unanswered UDP probes.
+    - grab_banners: Fingerprint services of newly opened TCP ports, see
+      banner_grabber module.
+    - banner_concurrency: Maximum number of banner grabbing connections in
+      flight.
+    - banner_timeout: Time (s) given to one port by the banner grabber.
+    Missing keys are set to DEFAULT_OPTIONS values.
   """
 
-  while 1:
-    try:
-      utc_time_now = str(datetime.utcnow())
-      print('[' + utc_time_now + '] ' + 'Start scanning TCP ports .........................')
-      start = datetime.now()
+  options = get_options(options)
+  if options['port_backend'] == 'nmap' and nmap_port_scan is None:
+    utils.print_error('nmap is not available, falling back to native port scanner')
+    options['port_backend'] = 'native'
 
-      scan_tcp_ports(db_connection)
+  if options['port_backend'] == 'syn':
+    try:
+      syn_scanner.SynScanner().close()
+    except OSError:
+      utils.print_error('Unable to open raw sockets, falling back to native port scanner')
+      options['port_backend'] = 'native'
 
-      end = datetime.now()
-      time_diff = end - start
-      utc_time_now = str(datetime.utcnow())
-      print('[' + utc_time_now + '] ' + 'Finished scanning TCP ports, it took', time_diff)
+  while 1:
+    try:
+      scan_tcp_ports(db_connection, options)
     except:
       print('An exception occurred in scan_tcp_ports function')
+      traceback.print_exc()
 
     try:
-      """
-      utc_time_now = str(datetime.utcnow())
-      print('[' + utc_time_now + '] ' + 'Start scanning UDP ports .........................')
-      start = datetime.now()
-
-      scan_udp_ports(db_connection)
-
-      end = datetime.now()
-      time_diff = end - start
-      utc_time_now = str(datetime.utcnow())
-      print('[' + utc_time_now + '] ' + 'Finished scanning UDP ports, it took', time_diff)
-      """
+      if options['grab_banners']:
+        banner_grabber.grab_devices(db_connection, options)
+    except:
+      print('An exception occurred in grab_devices function')
+      traceback.print_exc()
+
+    try:
+      if options['udp_ports']:
+        scan_udp_ports(db_connection, options)
     except:
       print('An exception occurred in scan_udp_ports function')
+      traceback.print_exc()
 
     # Just random sleep between 1 and 5 seconds before starting next round.
     random_seconds = random.randint(1, 6)
@@ -72,36 +165,163 @@ def scan_ports(db_connection):
 
 
 
-def scan_tcp_ports(db_connection):
+def get_db_time():
+  """
+  Function returns current time (s) on the clock of last_update values of
+  agent_devices table (see utils.get_unix_epoch_milliseconds function), so
+  scan schedulers compare last seen times with the same clock.
+  """
+
+  return utils.get_unix_epoch_milliseconds() / 1000.0
+
+
+
+
+
+def get_due_devices(db_connection, scheduler):
+  """
+  Function passes devices data (MAC and IPv4 addresses and last update) from
+  agent_devices table to the scan scheduler and returns devices which are
+  due for scanning. See scan_scheduler module.
+
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - scheduler: scan_scheduler.ScanScheduler.
+
+  Returns a list of (MAC address, IPv4 address) tuples.
+  """
+
+  query = db.query_from_table(db_connection, 'agent_devices', ['mac', 'ip', 'last_update'])
+  # last_update is Unix Epoch time in milliseconds.
+  scheduler.sync([(mac, ip, (last_update or 0) / 1000.0) for mac, ip, last_update in query])
+
+  return scheduler.next_batch()
+
+
+
+
+
+def run_scan_round(name, scheduler, devices, scan):
+  """
+  Function scans given devices with scan(devices), reschedules them and logs
+  scan queue depth and age of the oldest scan.
+  """
+
+  utc_time_now = str(datetime.utcnow())
+  print('[' + utc_time_now + '] ' + 'Start scanning %s ports of %d devices ...........' % (name, len(devices)))
+  start = datetime.now()
+
+  try:
+    scan(devices)
+  finally:
+    # Devices are rescheduled even if scan failed, so a failing device does
+    # not block the queue.
+    for device_mac, device_ip in devices:
+      scheduler.done(device_mac)
+
+  time_diff = datetime.now() - start
+  stats = scheduler.get_stats()
+  oldest = stats['oldest_scan_age']
+  utc_time_now = str(datetime.utcnow())
+  print('[' + utc_time_now + '] ' + 'Finished scanning %s ports, it took' % name, time_diff,
+        '(queue depth: %d, oldest scan: %s, stale devices: %d)' %
+        (stats['queue_depth'], '%.0f s' % oldest if oldest is not None else '-', stats['stale']))
+
+
+
+
+
+def scan_tcp_ports(db_connection, options = None):
   """
   Function scans TCP ports and result stores on the SQLite3 database.
   At first it queries devices data (MAC and IPv1 addresses) from database,
-  particularly agent_devices table.
+  particularly agent_devices table, and passes them to the scan scheduler
+  (see scan_scheduler module), then it scans only devices which are due.
 
   Arguments:
   - db_connection: SQLite3 database connection.
+  - options: Port scanning options. See scan_ports function.
+
+  Returns number of scanned devices.
   """
 
-  # TODO I may use gevent for scanning TCP ports or nmap's PortScannerAsync().
+  global tcp_scheduler
 
-  # TCP port range to be scanned.
-  tcp_port_range = [1, 512]
-  query = db.query_from_table(db_connection, 'agent_devices', ['mac', 'ip', 'last_update'])
+  options = get_options(options)
+  if tcp_scheduler is None:
+    tcp_scheduler = scan_scheduler.ScanScheduler(options['rescan_interval'], stale_after = options['scan_stale'],
+                                                 clock = get_db_time)
+
+  devices = get_due_devices(db_connection, tcp_scheduler)
+  if devices:
+    run_scan_round('TCP', tcp_scheduler, devices, lambda batch: scan_tcp_devices(db_connection, batch, options))
+
+  return len(devices)
 
-  for device_data in query:
-    last_update = device_data[2]
-    utc_time_now_sec = utils.get_unix_epoch_milliseconds()
-    # TODO
-    # If device data updated ~8 minutes ago, then I should assume that
-    # device is not visible.
-    #if (utc_time_now_sec - last_update) >= 480:
-    #  print('Do not scan TCP ports')
 
-    device_ip = device_data[1]
+
+
+
+def get_tcp_scan_stats():
+  """
+  Function returns TCP port scan scheduler statistics, see
+  scan_scheduler.ScanScheduler.get_stats method, or None if scanning has not
+  started.
+  """
+
+  if tcp_scheduler is None:
+    return None
+
+  return tcp_scheduler.get_stats()
+
+
+
+
+
+def get_udp_scan_stats():
+  """
+  Function returns UDP port scan scheduler statistics, see
+  get_tcp_scan_stats function.
+  """
+
+  if udp_scheduler is None:
+    return None
+
+  return udp_scheduler.get_stats()
+
+
+
+
+
+def scan_tcp_devices(db_connection, devices, options):
+  """
+  Function scans TCP ports of given devices with configured backend and
+  stores results on the SQLite3 database.
+
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - devices: A list of (MAC address, IPv4 address) tuples.
+  - options: Port scanning options. See scan_ports function.
+  """
+
+  if options['port_backend'] == 'syn':
+    try:
+      syn_scanner.scan_devices(db_connection, devices, options['tcp_ports'], options)
+      return
+    except OSError:
+      utils.print_error('Unable to open raw sockets, falling back to native port scanner')
+
+  if options['port_backend'] != 'nmap':
+    tcp_scanner.scan_devices(db_connection, devices, options['tcp_ports'], options)
+    return
+
+  # TCP port range to be scanned.
+  tcp_port_range = options['tcp_ports']
+
+  for device_mac, device_ip in devices:
     #open_tcp_ports = scapy_tcp_ping(device_ip, tcp_port_range)
     open_tcp_ports = scan_tcp_range(device_ip, tcp_port_range)
-    if open_tcp_ports:
-      device_mac = device_data[0]
+    if open_tcp_ports is not None:
       db.insert_port_data(db_connection, device_mac, device_ip, open_tcp_ports, 'tcp')
 
     # Just random sleep between 2 and 100 milliseconds before scanning next device.
@@ -112,36 +332,58 @@ def scan_tcp_ports(db_connection):
 
 
 
-def scan_udp_ports(db_connection):
+def scan_udp_ports(db_connection, options = None):
   """
   Function scans UDP ports and result stores on the SQLite3 database.
-  At first it queries devices data (MAC and IPv1 addresses) from database,
-  particularly agent_devices table.
+  Devices are scheduled the same way as in scan_tcp_ports function.
 
   Arguments:
   - db_connection: SQLite3 database connection.
+  - options: Port scanning options. See scan_ports function.
+
+  Returns number of scanned devices.
   """
 
-  # TODO I may use gevent for scanning UDP ports or nmap's PortScannerAsync().
+  global udp_scheduler
+
+  options = get_options(options)
+  if udp_scheduler is None:
+    udp_scheduler = scan_scheduler.ScanScheduler(options['rescan_interval'], stale_after = options['scan_stale'],
+                                                 clock = get_db_time)
+
+  devices = get_due_devices(db_connection, udp_scheduler)
+  if devices:
+    run_scan_round('UDP', udp_scheduler, devices, lambda batch: scan_udp_devices(db_connection, batch, options))
+
+  return len(devices)
 
-  # UDP port range to be scanned.
-  udp_port_range = [1, 8]
-  query = db.query_from_table(db_connection, 'agent_devices', ['mac', 'ip', 'last_update'])
 
-  for device_data in query:
-    last_update = device_data[2]
-    utc_time_now_sec = utils.get_unix_epoch_milliseconds()
-    # TODO
-    # If device data updated ~8 minutes ago, then I should assume that
-    # device is not visible.
-    #if (utc_time_now_sec - last_update) >= 480:
-    #  print('Do not scan UDP ports')
 
-    device_ip = device_data[1]
+
+
+def scan_udp_devices(db_connection, devices, options):
+  """
+  Function scans UDP ports of given devices with the asynchronous UDP prober
+  (see udp_scanner module), or with nmap if it is the configured backend, and
+  stores results on the SQLite3 database.
+
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - devices: A list of (MAC address, IPv4 address) tuples.
+  - options: Port scanning options. See scan_ports function.
+  """
+
+  if options['port_backend'] != 'nmap':
+    udp_scanner.scan_devices(db_connection, devices, options['udp_ports'], options)
+    return
+
+  # UDP port set to be scanned.
+  udp_port_range = options['udp_ports']
+
+  for device_mac, device_ip in devices:
     #open_udp_ports = scapy_udp_ping(device_ip, udp_port_range)
     open_udp_ports = scan_udp_range(device_ip, udp_port_range)
-    if open_udp_ports:
-      device_mac = device_data[0]
+    if open_udp_ports is not None:
       db.insert_port_data(db_connection, device_mac, device_ip, open_udp_ports, 'udp')
 
     # Just random sleep between 2 and 100 milliseconds before scanning next device.
@@ -161,16 +403,32 @@ def scan_tcp_range(device_ip, tcp_port_range):
   - tcp_port_range: TCP port range to be scanned. It must contain two elements.
     Firts element should be min range and second element max range.
     For example, tcp_port_range = [21, 443], then it will scan all ports from 21 to 443.
+    It may also be a port set string in nmap format, e.g., '1-512,8080'.
 
   Returns a list of open TCP port numbers. If there is not an open TCP port it
-  will return an empty list.
+  will return an empty list. Returns None if the scan failed or the device did
+  not respond, so previously stored ports are kept.
   """
 
   open_tcp_ports = []
-  port_range = str(tcp_port_range[0]) + '-' + str(tcp_port_range[1])
+  if isinstance(tcp_port_range, str):
+    port_range = tcp_port_range.replace(' ', '')
+  else:
+    port_range = str(tcp_port_range[0]) + '-' + str(tcp_port_range[1])
 
-  nmap_port_scan.scan(device_ip, port_range)
-  if nmap_port_scan.has_host(device_ip) and 'tcp' in nmap_port_scan[device_ip]:
+  if nmap_port_scan is None:
+    return None
+
+  try:
+    nmap_port_scan.scan(device_ip, port_range)
+  except Exception:
+    traceback.print_exc()
+    return None
+
+  if not nmap_port_scan.has_host(device_ip):
+    return None
+
+  if 'tcp' in nmap_port_scan[device_ip]:
     tcp_data = nmap_port_scan[device_ip]['tcp']
     for port_number in tcp_data:
       if 'state' in tcp_data[port_number] and tcp_data[port_number]['state'] == 'open':
@@ -193,16 +451,32 @@ def scan_udp_range(device_ip, udp_port_range):
   - udp_port_range: UDP port range to be scanned. It must contain two elements.
     Firts element should be min range and second element max range.
     For example, udp_port_range = [21, 443], then it will scan all ports from 21 to 443.
+    It may also be a port set string in nmap format, e.g., '53,123,161'.
 
   Returns a list of open UDP port numbers. If there is not an open UDP port it
-  will return an empty list.
+  will return an empty list. Returns None if the scan failed or the device did
+  not respond, so previously stored ports are kept.
   """
 
   open_udp_ports = []
-  port_range = str(udp_port_range[0]) + '-' + str(udp_port_range[1])
+  if isinstance(udp_port_range, str):
+    port_range = udp_port_range.replace(' ', '')
+  else:
+    port_range = str(udp_port_range[0]) + '-' + str(udp_port_range[1])
+
+  if nmap_port_scan is None:
+    return None
+
+  try:
+    nmap_port_scan.scan(device_ip, port_range, '-sU')
+  except Exception:
+    traceback.print_exc()
+    return None
+
+  if not nmap_port_scan.has_host(device_ip):
+    return None
 
-  nmap_port_scan.scan(device_ip, port_range, '-sU')
-  if nmap_port_scan.has_host(device_ip) and 'udp' in nmap_port_scan[device_ip]:
+  if 'udp' in nmap_port_scan[device_ip]:
     udp_data = nmap_port_scan[device_ip]['udp']
     for port_number in udp_data:
       if 'state' in udp_data[port_number] and udp_data[port_number]['state'] == 'open':
@@ -0,0 +1,315 @@
+"""
+Module Name:
+  prefix_classifier.py
+
+
+Description:
+  Module classifies IPv4 addresses of IP traffic as local (in a monitored
+  network), external or ignored (unspecified, loopback, multicast and
+  broadcast addresses) by longest prefix match. Prefixes are compiled into a
+  three level lookup table over integer addresses, indexed by the first 16
+  bits and then by the third and by the fourth octet, so an address is
+  classified with at most three array lookups whatever the number and length
+  of prefixes.
+
+  Local prefixes are the subnets of monitored interfaces, the Agent's own
+  address and configured site prefixes. The table is rebuilt whenever the
+  interface table changes (see iface_watcher module).
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import array
+import ipaddress
+import socket
+import threading
+import traceback
+
+import iface_watcher
+
+
+# Address classes. On equal prefix length a higher class wins, so an ignored
+# prefix overrides a local one.
+EXTERNAL = 0
+LOCAL = 1
+IGNORED = 2
+
+# Entries of the first two levels, which are not smaller than NODE, are
+# indexes of a table of the next level.
+NODE = 4
+
+# Addresses never monitored: unspecified, loopback, multicast and reserved
+# (which includes the limited broadcast address).
+IGNORED_PREFIXES = ['0.0.0.0/8', '127.0.0.0/8', '224.0.0.0/4', '240.0.0.0/4']
+
+
+
+
+
+def parse_prefixes(prefixes):
+  """
+  Function converts prefixes into a list of ipaddress.IPv4Network objects.
+
+  Arguments:
+  - prefixes: A comma separated string or a list of prefixes, e.g.,
+    '10.1.0.0/16, 192.168.1.0/24'. An address without prefix length is a /32
+    prefix, host bits are ignored.
+
+  Raises ValueError if a prefix is not valid.
+  """
+
+  if isinstance(prefixes, str):
+    prefixes = prefixes.split(',')
+
+  networks = []
+  for prefix in prefixes:
+    if isinstance(prefix, str):
+      prefix = prefix.strip()
+      if not prefix:
+        continue
+    networks.append(ipaddress.IPv4Network(prefix, strict = False))
+
+  return networks
+
+
+
+
+
+def compile_prefixes(entries):
+  """
+  Function compiles prefixes into lookup tables.
+
+  Arguments:
+  - entries: Iterable of (ipaddress.IPv4Network, class) tuples. Addresses
+    not covered by any prefix are EXTERNAL.
+
+  Returns Tuple (first level array, list of second level arrays, list of
+  third level bytearrays). The first NODE elements of both lists are unused.
+  """
+
+  level1 = array.array('I', [EXTERNAL]) * 65536
+  level2 = [None] * NODE
+  level3 = [None] * NODE
+
+  # Shorter prefixes are written first and longer ones overwrite them, so
+  # every entry ends up with the class of its longest matching prefix.
+  for network, address_class in sorted(entries, key = lambda entry: (entry[0].prefixlen, entry[1])):
+    address = int(network.network_address)
+    prefixlen = network.prefixlen
+
+    if prefixlen <= 16:
+      first = address >> 16
+      count = 1 << (16 - prefixlen)
+      level1[first:first + count] = array.array('I', [address_class]) * count
+      continue
+
+    index = address >> 16
+    node = level1[index]
+    if node < NODE:
+      level2.append(array.array('I', [node]) * 256)
+      node = len(level2) - 1
+      level1[index] = node
+    table = level2[node]
+
+    if prefixlen <= 24:
+      first = (address >> 8) & 0xff
+      count = 1 << (24 - prefixlen)
+      table[first:first + count] = array.array('I', [address_class]) * count
+      continue
+
+    index = (address >> 8) & 0xff
+    node = table[index]
+    if node < NODE:
+      level3.append(bytearray([node]) * 256)
+      node = len(level3) - 1
+      table[index] = node
+
+    first = address & 0xff
+    count = 1 << (32 - prefixlen)
+    level3[node][first:first + count] = bytes([address_class]) * count
+
+  return (level1, level2, level3)
+
+
+
+
+
+class PrefixClassifier(object):
+  """
+  Longest prefix match classifier of IPv4 addresses.
+  """
+
+  def __init__(self, site_prefixes = (), ignored_prefixes = IGNORED_PREFIXES):
+    """
+    Arguments:
+    - site_prefixes: Prefixes of local networks, which are not subnets of
+      monitored interfaces, see parse_prefixes function.
+    - ignored_prefixes: Prefixes of addresses, whose traffic is not
+      monitored.
+    """
+
+    self.site_prefixes = parse_prefixes(site_prefixes)
+    self.ignored_prefixes = parse_prefixes(ignored_prefixes)
+    self.interface_prefixes = []
+    self.broadcasts = []
+    self.lock = threading.Lock()
+    self.stats = {'builds': 0}
+    self.build()
+
+
+  def set_interfaces(self, addresses):
+    """
+    Method sets addresses of monitored interfaces and rebuilds lookup tables
+    if they changed. Subnets of the addresses are local, their directed
+    broadcast addresses are ignored.
+
+    Arguments:
+    - addresses: A list of IPv4 addresses with prefix length, e.g.,
+      ['10.1.0.2/16']. An address without prefix length is a local host.
+    """
+
+    prefixes = []
+    broadcasts = []
+    for address in addresses:
+      try:
+        interface = ipaddress.IPv4Interface(address)
+      except ValueError:
+        continue
+      prefixes.append(interface.network)
+      if interface.network.prefixlen < 31:
+        broadcasts.append(ipaddress.IPv4Network(interface.network.broadcast_address))
+
+    with self.lock:
+      if set(prefixes) == set(self.interface_prefixes) and set(broadcasts) == set(self.broadcasts):
+        return
+      self.interface_prefixes = prefixes
+      self.broadcasts = broadcasts
+      self.build()
+
+
+  def build(self):
+    entries = [(network, LOCAL) for network in self.interface_prefixes + self.site_prefixes]
+    entries += [(network, IGNORED) for network in self.ignored_prefixes + self.broadcasts]
+    # Readers pick up all three levels at once, so a table is swapped
+    # atomically while packets are being classified.
+    self.tables = compile_prefixes(entries)
+    self.stats['builds'] += 1
+
+
+  def classify(self, address):
+    """
+    Method returns class (EXTERNAL, LOCAL or IGNORED) of an IPv4 address
+    given as integer.
+    """
+
+    level1, level2, level3 = self.tables
+    node = level1[address >> 16]
+    if node < NODE:
+      return node
+    node = level2[node][(address >> 8) & 0xff]
+    if node < NODE:
+      return node
+    return level3[node][address & 0xff]
+
+
+  def classify_packed(self, address):
+    """
+    Method returns class of an IPv4 address given as 4 bytes in network order
+    (e.g., a flow key address, see flow_capture.parse_frame function).
+    """
+
+    level1, level2, level3 = self.tables
+    node = level1[address[0] << 8 | address[1]]
+    if node < NODE:
+      return node
+    node = level2[node][address[2]]
+    if node < NODE:
+      return node
+    return level3[node][address[3]]
+
+
+  def classify_ip(self, ip_addr):
+    """
+    Method returns class of an IPv4 address in dotted notation.
+    """
+
+    return self.classify_packed(socket.inet_aton(ip_addr))
+
+
+  def get_prefixes(self):
+    """
+    Method returns a dictionary with local and ignored lists of prefixes.
+    """
+
+    with self.lock:
+      return {'local': [str(network) for network in self.interface_prefixes + self.site_prefixes],
+              'ignored': [str(network) for network in self.ignored_prefixes + self.broadcasts]}
+
+
+
+
+
+def get_interface_addresses(net_interfaces, table = None):
+  """
+  Function returns IPv4 addresses with prefix length of monitored network
+  interfaces.
+
+  Arguments:
+  - net_interfaces: A list of provided network interfaces, e.g.,
+    [{'ip': '192.168.0.1/24', 'iface': 'enp0s3'}].
+  - table: iface_watcher.InterfaceTable or None. If it is given current
+    addresses of the interfaces are read from it, otherwise (or if an
+    interface is not in the table) the provided address is used.
+  """
+
+  addresses = []
+  for data in net_interfaces:
+    iface_addrs = table.get_addresses(data['iface']) if table is not None else []
+    if iface_addrs:
+      addresses += ['%s/%d' % (addr['addr'], addr['prefixlen']) for addr in iface_addrs]
+    elif data.get('ip'):
+      addresses.append(data['ip'])
+
+  return addresses
+
+
+
+
+
+def configure(options, net_interfaces, agent_ip = None, watch = True):
+  """
+  Function creates a classifier of the monitored networks, which is rebuilt
+  whenever the interface table changes.
+
+  Arguments:
+  - options: A dictionary (e.g., command line data). Used keys are
+    site_prefixes and ignore_prefixes.
+  - net_interfaces: A list of provided network interfaces.
+  - agent_ip: An IPv4 address of agent, it is local.
+  - watch: If it is False, the classifier is built from net_interfaces only
+    and the interface table is not used (e.g., when replaying a capture).
+
+  Returns the classifier.
+  """
+
+  classifier = PrefixClassifier(options.get('site_prefixes') or [],
+                                IGNORED_PREFIXES + parse_prefixes(options.get('ignore_prefixes') or []))
+  extra = [agent_ip] if agent_ip else []
+  classifier.set_interfaces(get_interface_addresses(net_interfaces) + extra)
+  if not watch:
+    return classifier
+
+  try:
+    table = iface_watcher.get_table()
+    if table is not None:
+      refresh = lambda table: classifier.set_interfaces(get_interface_addresses(net_interfaces, table) + extra)
+      refresh(table)
+      table.add_listener(refresh)
+  except Exception:
+    traceback.print_exc()
+
+  return classifier
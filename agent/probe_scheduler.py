@@ -0,0 +1,351 @@
+"""
+Module Name:
+  probe_scheduler.py
+
+
+Description:
+  Module provides an adaptive ARP probe scheduler, which allows discovering
+  devices on prefixes larger than /24 (e.g., flat /20 or /16 networks).
+
+  Per-address state is kept in flat arrays indexed by host offset in the
+  subnet (last seen time, next probe tick and number of unanswered probes),
+  and due addresses are found through a timing wheel, so memory is linear in
+  the number of addresses and independent of the number of probes. Known-live
+  hosts are probed every live_interval seconds, silent addresses back off
+  exponentially up to dead_max seconds and the total probe rate is limited by
+  a packets-per-second budget.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import array
+import collections
+import ipaddress
+import random
+import socket
+import struct
+import threading
+import time
+
+
+# Number of unanswered probes after which a host is considered down and goes
+# to the exponential back-off schedule.
+LIVE_RETRIES = 2
+
+MAX_MISSES = 255
+
+# Pending state of next_tick, address is in the backlog waiting for budget.
+PENDING = -1
+
+
+
+
+
+class TokenBucket(object):
+  """
+  Token bucket rate limiter.
+  """
+
+  def __init__(self, rate, burst = None):
+    """
+    Arguments:
+    - rate: Tokens per second. If it is 0 or None bucket is unlimited.
+    - burst: Bucket size. By default it is set to rate (one second worth of
+      tokens).
+    """
+
+    self.rate = float(rate or 0)
+    self.burst = float(burst or self.rate or 1)
+    self.tokens = self.burst
+    self.last = time.monotonic()
+    self.lock = threading.Lock()
+
+
+  def refill(self, now = None):
+    if now is None:
+      now = time.monotonic()
+    if self.rate:
+      self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+
+
+  def take(self, count, now = None):
+    """
+    Method takes up to count tokens.
+
+    Returns number of taken tokens.
+    """
+
+    if not self.rate:
+      return count
+
+    with self.lock:
+      self.refill(now)
+      taken = min(int(self.tokens), count)
+      self.tokens -= taken
+
+    return taken
+
+
+  def put(self, count):
+    """
+    Method returns count unused tokens to the bucket.
+    """
+
+    if not self.rate:
+      return
+
+    with self.lock:
+      self.tokens = min(self.burst, self.tokens + count)
+
+
+
+
+
+class ProbeScheduler(object):
+  """
+  Adaptive probe scheduler of one IPv4 subnet.
+  """
+
+  def __init__(self, subnet, exclude = (), live_interval = 2.5, dead_min = 30,
+               dead_max = 600, resolution = 0.25, budget = None, now = None):
+    """
+    Arguments:
+    - subnet: ipaddress.IPv4Network or a string, e.g., '10.1.0.0/16'.
+    - exclude: IPv4 addresses which are never probed (e.g., our own address).
+    - live_interval: Interval (s) between two probes of a live host.
+    - dead_min: First back-off interval (s) of a host which does not reply.
+    - dead_max: Maximum back-off interval (s).
+    - resolution: Timing wheel slot length (s).
+    - budget: TokenBucket shared by schedulers, which limits probes per second.
+      If it is None probes are not limited.
+    - now: Current time (s), time.monotonic() by default. Initial probes are
+      spread so that the first sweep respects the budget.
+    """
+
+    self.subnet = ipaddress.IPv4Network(subnet, strict = False)
+    self.live_interval = float(live_interval)
+    self.dead_min = float(dead_min)
+    self.dead_max = float(dead_max)
+    self.resolution = float(resolution)
+    self.budget = budget
+
+    if self.subnet.prefixlen >= 31:
+      self.first = int(self.subnet.network_address)
+      self.size = self.subnet.num_addresses
+    else:
+      # Skip network and broadcast addresses.
+      self.first = int(self.subnet.network_address) + 1
+      self.size = self.subnet.num_addresses - 2
+
+    self.last_seen = array.array('d', bytes(8 * self.size))
+    self.next_tick = array.array('q', bytes(8 * self.size))
+    self.misses = bytearray(self.size)
+
+    self.excluded = set()
+    for ip_addr in exclude:
+      index = self.index(ip_addr)
+      if index is not None:
+        self.excluded.add(index)
+
+    # Timing wheel, slot is an array of host indexes. Entries are validated
+    # against next_tick when slot expires, so rescheduling never has to
+    # search the wheel.
+    self.slots = int(max(self.dead_max, self.live_interval) * 1.5 / self.resolution) + 2
+    self.wheel = [array.array('I') for i in range(self.slots)]
+    self.backlog = collections.deque()
+
+    if now is None:
+      now = time.monotonic()
+    self.tick = int(now / self.resolution)
+
+    spread = self.live_interval
+    if budget is not None and budget.rate:
+      spread = max(spread, self.size / budget.rate)
+    spread = min(spread, self.dead_max)
+
+    for index in range(self.size):
+      if index not in self.excluded:
+        self.schedule(index, now + spread * index / self.size)
+
+    self.probes_sent = 0
+
+
+  def index(self, ip_addr):
+    """
+    Method returns index of given IPv4 address or None if it is not a host
+    address of the subnet.
+    """
+
+    index = int(ipaddress.IPv4Address(ip_addr)) - self.first
+    if 0 <= index < self.size:
+      return index
+
+    return None
+
+
+  def address(self, index):
+    return socket.inet_ntoa(struct.pack('!I', self.first + index))
+
+
+  def schedule(self, index, when):
+    # Current slot has already been expired. Intervals never exceed the wheel
+    # horizon, upper clamp only guards against clock jumps.
+    tick = int(when / self.resolution)
+    tick = min(max(tick, self.tick + 1), self.tick + self.slots - 1)
+    self.next_tick[index] = tick
+    self.wheel[tick % self.slots].append(index)
+
+
+  def mark_seen(self, ip_addr, now = None):
+    """
+    Method records that given address replied or has been heard.
+
+    Returns True if address belongs to the subnet.
+    """
+
+    index = self.index(ip_addr)
+    if index is None or index in self.excluded:
+      return False
+
+    if now is None:
+      now = time.monotonic()
+
+    self.last_seen[index] = now
+    was_down = self.misses[index] > LIVE_RETRIES
+    self.misses[index] = 0
+
+    # A host which came back should not wait for the rest of its back-off.
+    if was_down and self.next_tick[index] != PENDING:
+      self.schedule(index, now + self.live_interval)
+
+    return True
+
+
+  def interval(self, index):
+    """
+    Method returns probe interval (s) of given host based on number of
+    unanswered probes.
+    """
+
+    misses = self.misses[index]
+    if misses <= LIVE_RETRIES:
+      return self.live_interval
+
+    backoff = self.dead_min * (2 ** min(misses - LIVE_RETRIES - 1, 16))
+    return min(backoff, self.dead_max)
+
+
+  def advance(self, now):
+    """
+    Method moves addresses of expired wheel slots to the backlog.
+    """
+
+    current = int(now / self.resolution)
+    # Do not loop over the wheel more than once after a long pause.
+    start = max(self.tick, current - self.slots + 1)
+
+    for tick in range(start, current + 1):
+      self.tick = tick
+      slot = self.wheel[tick % self.slots]
+      if not slot:
+        continue
+
+      self.wheel[tick % self.slots] = array.array('I')
+      for index in slot:
+        # Skip stale entries of rescheduled or pending addresses. Entries of
+        # slots skipped after a long pause expire late.
+        next_tick = self.next_tick[index]
+        if next_tick == PENDING or next_tick > tick:
+          continue
+
+        # Host has been heard recently (e.g., passively), no need to probe.
+        seen = self.last_seen[index]
+        if seen and now - seen < self.live_interval:
+          self.schedule(index, seen + self.live_interval)
+          continue
+
+        self.next_tick[index] = PENDING
+        self.backlog.append(index)
+
+    self.tick = current
+
+
+  def due(self, now = None, limit = None):
+    """
+    Method returns a list of IPv4 addresses, which should be probed now, and
+    schedules their next probe. Number of addresses is limited by the budget.
+
+    Arguments:
+    - now: Current time (s), time.monotonic() by default.
+    - limit: Maximum number of addresses to return.
+    """
+
+    if now is None:
+      now = time.monotonic()
+
+    self.advance(now)
+
+    count = len(self.backlog)
+    if limit is not None:
+      count = min(count, limit)
+    if self.budget is not None:
+      count = self.budget.take(count, now)
+
+    ip_list = []
+    for i in range(count):
+      index = self.backlog.popleft()
+      if self.misses[index] < MAX_MISSES:
+        self.misses[index] += 1
+      interval = self.interval(index)
+      # Jitter spreads probes of hosts which were discovered together.
+      self.schedule(index, now + interval * random.uniform(0.9, 1.1))
+      ip_list.append(self.address(index))
+
+    self.probes_sent += count
+    return ip_list
+
+
+  def requeue(self, ip_list):
+    """
+    Method returns addresses, which were returned by due method but could not
+    be sent (e.g., socket buffer is full), to the front of the backlog. Their
+    unanswered probe count and budget tokens are given back, so they are
+    probed first next time instead of being counted as silent.
+    """
+
+    indexes = []
+    for ip_addr in ip_list:
+      index = self.index(ip_addr)
+      if index is None or index in self.excluded or self.next_tick[index] == PENDING:
+        continue
+      # A count at MAX_MISSES has not been increased by due method.
+      if 0 < self.misses[index] < MAX_MISSES:
+        self.misses[index] -= 1
+      # Entry of the rescheduled probe in the wheel becomes stale.
+      self.next_tick[index] = PENDING
+      indexes.append(index)
+
+    self.backlog.extendleft(reversed(indexes))
+    self.probes_sent -= len(indexes)
+    if self.budget is not None:
+      self.budget.put(len(indexes))
+
+
+  def live_hosts(self, now = None, max_age = None):
+    """
+    Method returns a list of IPv4 addresses heard within max_age seconds
+    (by default three live intervals).
+    """
+
+    if now is None:
+      now = time.monotonic()
+    if max_age is None:
+      max_age = 3 * self.live_interval
+
+    return [self.address(index) for index in range(self.size)
+            if self.last_seen[index] and now - self.last_seen[index] <= max_age]
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+"""
+Module Name:
+  replay.py
+
+
+Description:
+  Module replays a pcap or pcapng capture file through the Agent's IP traffic
+  and device discovery pipelines, so they can be benchmarked and tested
+  without network interfaces or root privileges. Frames go through the same
+  stages as live capture:
+  - read: capture file records are decoded (see pcap module).
+  - parse: flow keys are unpacked (see flow_capture.parse_frame function),
+    ARP packets are parsed (see arp_engine.parse_arp_frame function).
+  - aggregate: IPv4 packets are added to a flow table.
+  - discovery: ARP senders are marked seen by the subnets' probe schedulers.
+  - flush: every flow_interval seconds of capture time flows are classified
+    as local or not local, counted by the top talkers tracker and stored on
+    the database (see ip_traffic.store_flows function).
+  - devices: every sweep_interval seconds of capture time seen devices are
+    stored on the database.
+
+  Packets are replayed as fast as possible or in real time, i.e., gaps
+  between packets are kept (and divided by a speed factor). At the end
+  packets per second, latency of every stage and peak memory are reported.
+  Latencies of per-packet stages are kept for every sample-th packet only,
+  so they take little memory in long replays.
+
+  Usage:
+    python3 replay.py capture.pcapng --local 10.213.0.1/24
+    python3 replay.py capture.pcap --local 10.213.0.1/24,192.168.1.10/24 --pace realtime --speed 2
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import argparse
+import resource
+import sys
+import time
+import tracemalloc
+
+import arp_engine
+import db
+import flow_capture
+import heavy_hitters
+import ip_traffic
+import pcap
+import prefix_classifier
+import probe_scheduler
+
+
+# Interval (s) of capture time between two stores of seen devices, see
+# discover_devices.DEFAULT_OPTIONS.
+SWEEP_INTERVAL = 2.5
+
+# Latencies of per-packet stages are kept for every SAMPLE_EVERY-th packet.
+SAMPLE_EVERY = 16
+
+PACKET_STAGES = ('read', 'parse', 'aggregate', 'discovery')
+BATCH_STAGES = ('flush', 'devices')
+
+
+
+
+
+class Replay(object):
+  """
+  Replay of captured packets through the traffic and discovery pipelines.
+  """
+
+  def __init__(self, db_connection, net_interfaces, agent_ip, options = None):
+    """
+    Arguments:
+    - db_connection: sqlite3 database connection.
+    - net_interfaces: A list of local networks, dictionaries with ip (IPv4
+      address with prefix length, e.g., '10.1.0.2/16') and iface keys.
+    - agent_ip: An IPv4 address of agent.
+    - options: A dictionary (e.g., command line data). Used keys are
+      flow_interval, flow_retention, sweep_interval, top_talkers,
+      talkers_half_life, site_prefixes, ignore_prefixes and sample.
+    """
+
+    options = options or {}
+    self.db_connection = db_connection
+    self.interval = float(options.get('flow_interval') or flow_capture.FLUSH_INTERVAL)
+    # Rows of old captures are kept by default.
+    self.retention = options.get('flow_retention') or time.time()
+    self.sweep_interval = float(options.get('sweep_interval') or SWEEP_INTERVAL)
+    self.sample = max(1, int(options.get('sample') or SAMPLE_EVERY))
+    self.talkers = heavy_hitters.configure(options)
+    self.classifier = prefix_classifier.configure(options, net_interfaces, agent_ip, watch = False)
+
+    self.schedulers = []
+    for data in net_interfaces:
+      host_ip = data['ip'].split('/')[0]
+      scheduler = probe_scheduler.ProbeScheduler(data['ip'], exclude = [host_ip], now = 0)
+      self.schedulers.append((data['iface'], scheduler))
+
+    self.table = flow_capture.FlowTable()
+    # Devices seen during current sweep interval, key is (iface, IPv4) and
+    # value is MAC.
+    self.seen_devices = {}
+    # Key is stage and value is a list of measured latencies (s).
+    self.latency = dict((stage, []) for stage in PACKET_STAGES + BATCH_STAGES)
+    self.stats = {'packets': 0, 'ipv4': 0, 'arp': 0, 'bytes': 0, 'flushes': 0, 'flows': 0,
+                  'devices': 0, 'first_ts': None, 'last_ts': None}
+
+
+  def run(self, packets, pace = 'fast', speed = 1.0):
+    """
+    Method replays packets and stores remaining flows and devices at the end.
+
+    Arguments:
+    - packets: Iterable of (timestamp (s), original length, frame) tuples,
+      see pcap.read_packets function.
+    - pace: 'fast' replays packets as fast as possible, 'realtime' keeps gaps
+      between packets.
+    - speed: Factor of real-time replay speed.
+
+    Returns replay wall time (s).
+    """
+
+    clock = time.perf_counter
+    table = self.table
+    stats = self.stats
+    latency = self.latency
+    sample = self.sample
+    schedulers = self.schedulers
+    seen_devices = self.seen_devices
+    parse_frame = flow_capture.parse_frame
+    parse_arp_frame = arp_engine.parse_arp_frame
+    realtime = pace == 'realtime'
+
+    iterator = iter(packets)
+    first_ts = None
+    flush_deadline = sweep_deadline = None
+    count = 0
+    ts = 0.0
+    start = clock()
+
+    while 1:
+      timed = count % sample == 0
+      t0 = clock()
+      try:
+        ts, length, frame = next(iterator)
+      except StopIteration:
+        break
+      t1 = clock()
+      count += 1
+
+      if first_ts is None:
+        first_ts = ts
+        flush_deadline = ts + self.interval
+        sweep_deadline = ts + self.sweep_interval
+      if realtime:
+        delay = (ts - first_ts) / speed - (t1 - start)
+        if delay > 0:
+          time.sleep(delay)
+
+      if ts >= flush_deadline or len(table) >= flow_capture.MAX_FLOWS:
+        self.flush(ts)
+        flush_deadline = ts + self.interval
+      if ts >= sweep_deadline:
+        self.store_devices(ts)
+        sweep_deadline = ts + self.sweep_interval
+
+      t2 = clock()
+      key = parse_frame(frame)
+      arp = parse_arp_frame(frame) if key is None else None
+      t3 = clock()
+
+      if key is not None:
+        table.add(key, length, ts)
+        stats['ipv4'] += 1
+        stats['bytes'] += length
+        if timed:
+          t4 = clock()
+          latency['read'].append(t1 - t0)
+          latency['parse'].append(t3 - t2)
+          latency['aggregate'].append(t4 - t3)
+      elif arp is not None:
+        opcode, ip_addr, mac_addr, target_ip = arp
+        for iface, scheduler in schedulers:
+          if scheduler.mark_seen(ip_addr, ts):
+            seen_devices[(iface, ip_addr)] = mac_addr
+        stats['arp'] += 1
+        if timed:
+          t4 = clock()
+          latency['read'].append(t1 - t0)
+          latency['parse'].append(t3 - t2)
+          latency['discovery'].append(t4 - t3)
+
+    self.flush(ts)
+    self.store_devices(ts)
+    db.flush_device_updates(self.db_connection)
+
+    stats['packets'] += count
+    if count:
+      if stats['first_ts'] is None:
+        stats['first_ts'] = first_ts
+      stats['last_ts'] = ts
+
+    return clock() - start
+
+
+  def flush(self, now):
+    """
+    Method classifies and stores flows of the flow table, see
+    ip_traffic.store_flows function.
+    """
+
+    flows = self.table.drain()
+    start = time.perf_counter()
+    ip_traffic.store_flows(self.db_connection, flows, self.classifier, self.retention,
+                           self.talkers, now)
+    self.latency['flush'].append(time.perf_counter() - start)
+    self.stats['flushes'] += 1
+    self.stats['flows'] += len(flows)
+
+
+  def store_devices(self, now):
+    """
+    Method stores and/or updates devices seen during the sweep interval.
+    Hostnames are not resolved, so replays do not depend on the network.
+    """
+
+    start = time.perf_counter()
+    utc_time_now = int(now * 1000)
+    for (iface, ip_addr), mac_addr in self.seen_devices.items():
+      db.update_device_data(self.db_connection, {'mac': mac_addr, 'ip': ip_addr, 'hostname': '',
+                                                 'iface': iface, 'last_update': utc_time_now})
+    self.latency['devices'].append(time.perf_counter() - start)
+    self.stats['devices'] += len(self.seen_devices)
+    self.seen_devices.clear()
+
+
+  def get_latency_stats(self):
+    """
+    Method returns a dictionary, where key is stage and value is a dictionary
+    with samples, mean, p50, p99 and max latency (µs) keys.
+    """
+
+    ret = {}
+    for stage in PACKET_STAGES + BATCH_STAGES:
+      values = sorted(self.latency[stage])
+      if not values:
+        ret[stage] = {'samples': 0, 'mean': 0.0, 'p50': 0.0, 'p99': 0.0, 'max': 0.0}
+        continue
+
+      def percentile(fraction):
+        return values[min(len(values) - 1, int(len(values) * fraction))] * 1e6
+
+      ret[stage] = {'samples': len(values), 'mean': sum(values) / len(values) * 1e6,
+                    'p50': percentile(0.5), 'p99': percentile(0.99), 'max': values[-1] * 1e6}
+
+    return ret
+
+
+
+
+
+def parse_local_networks(networks):
+  """
+  Function converts comma separated local networks (e.g., '10.1.0.2/16,
+  192.168.1.10/24') into a list of net_interfaces dictionaries. Interfaces
+  are named replay0, replay1, etc.
+  """
+
+  net_interfaces = []
+  for network in networks.split(','):
+    network = network.strip()
+    if network:
+      if '/' not in network:
+        network += '/24'
+      net_interfaces.append({'ip': network, 'iface': 'replay' + str(len(net_interfaces))})
+
+  return net_interfaces
+
+
+
+
+
+def print_report(replay, wall, peak_traced = None):
+  """
+  Function prints packets per second, latency of every stage, peak memory and
+  top talkers of a finished replay.
+  """
+
+  stats = replay.stats
+  pps = stats['packets'] / wall if wall else 0
+  span = 0.0
+  if stats['first_ts'] is not None:
+    span = stats['last_ts'] - stats['first_ts']
+
+  print('packets: %d  ipv4: %d  arp: %d  bytes: %d  capture time: %.3f s' %
+        (stats['packets'], stats['ipv4'], stats['arp'], stats['bytes'], span))
+  print('wall: %.3f s  pps: %.1f  flushes: %d  flows: %d  devices stored: %d' %
+        (wall, pps, stats['flushes'], stats['flows'], stats['devices']))
+
+  print('%-10s %8s %10s %10s %10s %10s' % ('stage', 'samples', 'mean us', 'p50 us', 'p99 us', 'max us'))
+  for stage, data in sorted(replay.get_latency_stats().items(),
+                            key = lambda item: (PACKET_STAGES + BATCH_STAGES).index(item[0])):
+    print('%-10s %8d %10.2f %10.2f %10.2f %10.2f' %
+          (stage, data['samples'], data['mean'], data['p50'], data['p99'], data['max']))
+
+  print('max RSS: %.2f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+  if peak_traced is not None:
+    print('peak traced Python memory: %.2f MB' % (peak_traced / 1024.0 / 1024.0))
+
+  for talker in replay.talkers.top(replay.talkers.top_count, 'bytes', stats['last_ts']):
+    print('talker %-15s bytes: %12.1f  packets: %10s' % (talker['ip'], talker['bytes'], talker['packets']))
+
+
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Agent offline pcap replay')
+  parser.add_argument('path', type = str, help = 'Pcap or pcapng file')
+  parser.add_argument('--local', type = str, required = True,
+                      help = 'Comma separated local networks, e.g., 10.1.0.2/16,192.168.1.10/24')
+  parser.add_argument('--agent_ip', type = str, default = None, help = 'IPv4 address of agent, the first local address by default')
+  parser.add_argument('--pace', type = str, default = 'fast', choices = ['fast', 'realtime'], help = 'Replay pacing')
+  parser.add_argument('--speed', type = float, default = 1, help = 'Factor of real-time replay speed')
+  parser.add_argument('--db', type = str, default = ':memory:', help = 'SQLite database file, in-memory by default')
+  parser.add_argument('--flow_interval', type = float, default = flow_capture.FLUSH_INTERVAL, help = 'Flush interval (s) of capture time')
+  parser.add_argument('--site_prefixes', type = str, default = None, help = 'Comma separated local prefixes besides the local networks')
+  parser.add_argument('--ignore_prefixes', type = str, default = None, help = 'Comma separated prefixes, whose traffic is not monitored')
+  parser.add_argument('--sweep_interval', type = float, default = SWEEP_INTERVAL, help = 'Interval (s) of capture time between stores of seen devices')
+  parser.add_argument('--top_talkers', type = int, default = heavy_hitters.TOP_COUNT, help = 'Number of top talkers reported')
+  parser.add_argument('--talkers_half_life', type = float, default = heavy_hitters.HALF_LIFE, help = 'Half-life (s) of talkers counts')
+  parser.add_argument('--sample', type = int, default = SAMPLE_EVERY, help = 'Latencies of per-packet stages are kept for every sample-th packet')
+  parser.add_argument('--tracemalloc', action = 'store_true', help = 'Report peak traced Python memory (slows replay down)')
+  args = parser.parse_args(sys.argv[1:])
+
+  net_interfaces = parse_local_networks(args.local)
+  if not net_interfaces:
+    parser.error('--local has no network')
+  if args.speed <= 0:
+    parser.error('--speed must be positive')
+  agent_ip = args.agent_ip or net_interfaces[0]['ip'].split('/')[0]
+  try:
+    prefix_classifier.parse_prefixes(args.site_prefixes or [])
+    prefix_classifier.parse_prefixes(args.ignore_prefixes or [])
+  except ValueError as e:
+    parser.error(str(e))
+
+  try:
+    packets = pcap.read_packets(args.path)
+  except (OSError, ValueError) as e:
+    sys.stderr.write('Cannot read %s: %s\n' % (args.path, e))
+    sys.exit(1)
+
+  db_connection = db.init_database(args.db)
+  try:
+    replay = Replay(db_connection, net_interfaces, agent_ip, vars(args))
+    if args.tracemalloc:
+      tracemalloc.start()
+    try:
+      wall = replay.run(packets, args.pace, args.speed)
+    except ValueError as e:
+      sys.stderr.write('Cannot read %s: %s\n' % (args.path, e))
+      sys.exit(1)
+
+    peak_traced = None
+    if args.tracemalloc:
+      peak_traced = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+    print_report(replay, wall, peak_traced)
+  finally:
+    db_connection.close()
+
+
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,434 @@
+"""
+Module Name:
+  resolver.py
+
+
+Description:
+  Module provides an asynchronous device name resolver. Discovery workers
+  submit newly seen devices and get cached names back immediately, while
+  reverse DNS, mDNS and NetBIOS name queries run on a separate asyncio event
+  loop with bounded concurrency. Resolved names and failed resolutions are
+  cached with separate TTLs, and resolved names are written to
+  agent_devices.hostname.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import asyncio
+import random
+import socket
+import struct
+import threading
+import time
+import traceback
+from datetime import datetime
+
+import db
+
+
+MDNS_PORT = 5353
+NETBIOS_PORT = 137
+
+DNS_TYPE_PTR = 12
+NETBIOS_TYPE_NBSTAT = 0x21
+DNS_CLASS_IN = 1
+# Unicast-response bit of mDNS question class.
+MDNS_CLASS_QU = 0x8000
+
+DNS_HEADER = struct.Struct('!HHHHHH')
+
+
+# Resolver shared by discovery workers, see start_resolver function.
+resolver = None
+
+
+
+
+
+def reverse_name(ip_addr):
+  """
+  Function returns reverse lookup name of given IPv4 address, e.g.,
+  4.3.2.1.in-addr.arpa for 1.2.3.4.
+  """
+  return '.'.join(reversed(ip_addr.split('.'))) + '.in-addr.arpa'
+
+
+
+
+
+def encode_name(name):
+  """
+  Function encodes domain name in DNS wire format.
+  """
+
+  labels = [label.encode() for label in name.rstrip('.').split('.')]
+  return b''.join(struct.pack('B', len(label)) + label for label in labels) + b'\x00'
+
+
+
+
+
+def decode_name(message, offset):
+  """
+  Function decodes a (possibly compressed) domain name from DNS message.
+
+  Returns Tuple (name, offset right after the name in the message).
+  """
+
+  labels = []
+  end = None
+  jumps = 0
+
+  while 1:
+    length = message[offset]
+    if length & 0xc0 == 0xc0:
+      # Compression pointer.
+      if end is None:
+        end = offset + 2
+      offset = struct.unpack_from('!H', message, offset)[0] & 0x3fff
+      jumps += 1
+      if jumps > 16:
+        raise ValueError('DNS compression loop')
+      continue
+
+    offset += 1
+    if length == 0:
+      break
+
+    labels.append(message[offset:offset + length].decode('utf-8', 'replace'))
+    offset += length
+
+  if end is None:
+    end = offset
+
+  return ('.'.join(labels), end)
+
+
+
+
+
+def build_ptr_query(ip_addr, query_id):
+  """
+  Function builds mDNS PTR query (with unicast-response bit) for given IPv4
+  address.
+  """
+
+  header = DNS_HEADER.pack(query_id, 0, 1, 0, 0, 0)
+  question = encode_name(reverse_name(ip_addr)) + struct.pack('!HH', DNS_TYPE_PTR, DNS_CLASS_IN | MDNS_CLASS_QU)
+
+  return header + question
+
+
+
+
+
+def parse_ptr_response(message):
+  """
+  Function returns the first PTR record name of DNS response or an empty
+  string.
+  """
+
+  query_id, flags, qdcount, ancount, nscount, arcount = DNS_HEADER.unpack_from(message)
+  offset = DNS_HEADER.size
+
+  for i in range(qdcount):
+    name, offset = decode_name(message, offset)
+    offset += 4
+
+  for i in range(ancount):
+    name, offset = decode_name(message, offset)
+    rtype, rclass, ttl, rdlength = struct.unpack_from('!HHIH', message, offset)
+    offset += 10
+    if rtype == DNS_TYPE_PTR:
+      ptr_name, end = decode_name(message, offset)
+      if ptr_name.endswith('.local'):
+        ptr_name = ptr_name[:-len('.local')]
+      return ptr_name
+    offset += rdlength
+
+  return ''
+
+
+
+
+
+def build_nbstat_query(ip_addr, query_id):
+  """
+  Function builds NetBIOS node status (NBSTAT) request for the wildcard name.
+  Node status is queried directly at given IPv4 address, so ip_addr is not
+  part of the request.
+  """
+
+  header = DNS_HEADER.pack(query_id, 0, 1, 0, 0, 0)
+  # Wildcard name '*' padded with zeros, first-level encoded.
+  raw_name = b'*' + b'\x00' * 15
+  encoded = b''.join(bytes([0x41 + (c >> 4), 0x41 + (c & 0x0f)]) for c in raw_name)
+  question = struct.pack('B', 32) + encoded + b'\x00' + struct.pack('!HH', NETBIOS_TYPE_NBSTAT, DNS_CLASS_IN)
+
+  return header + question
+
+
+
+
+
+def parse_nbstat_response(message):
+  """
+  Function returns workstation (unique, suffix 0x00) name from NetBIOS node
+  status response or an empty string.
+  """
+
+  qdcount, ancount = struct.unpack_from('!HH', message, 4)
+  offset = DNS_HEADER.size
+  if ancount < 1:
+    return ''
+
+  # Answer name (34 bytes, uncompressed), type, class, TTL and rdlength.
+  name, offset = decode_name(message, offset)
+  offset += 10
+  num_names = message[offset]
+  offset += 1
+
+  for i in range(num_names):
+    entry = message[offset:offset + 18]
+    offset += 18
+    if len(entry) < 18:
+      break
+    suffix = entry[15]
+    flags = struct.unpack_from('!H', entry, 16)[0]
+    # Skip group names.
+    if suffix == 0x00 and not flags & 0x8000:
+      return entry[:15].decode('ascii', 'replace').strip()
+
+  return ''
+
+
+
+
+
+class DatagramQuery(asyncio.DatagramProtocol):
+  """
+  Datagram protocol, which resolves future with the first received datagram.
+  """
+
+  def __init__(self, future):
+    self.future = future
+
+  def datagram_received(self, data, addr):
+    if not self.future.done():
+      self.future.set_result(data)
+
+  def error_received(self, exc):
+    if not self.future.done():
+      self.future.set_exception(exc)
+
+
+
+
+
+class HostnameResolver(object):
+  """
+  Asynchronous device name resolver with positive and negative caching.
+  """
+
+  def __init__(self, db_connection, methods = ('dns',), concurrency = 16,
+               positive_ttl = 3600, negative_ttl = 300, timeout = 2):
+    """
+    Arguments:
+    - db_connection: SQLite3 database connection. Resolved names are stored
+      in agent_devices table.
+    - methods: Name resolution methods tried in given order, 'dns' (reverse
+      DNS), 'mdns' (unicast mDNS PTR query) and 'netbios' (NetBIOS node
+      status query).
+    - concurrency: Maximum number of devices resolved at the same time.
+    - positive_ttl: Time (s) a resolved name is cached.
+    - negative_ttl: Time (s) a failed resolution is cached.
+    - timeout: Timeout (s) of a single query.
+    """
+
+    self.db_connection = db_connection
+    self.methods = list(methods)
+    self.concurrency = concurrency
+    self.positive_ttl = positive_ttl
+    self.negative_ttl = negative_ttl
+    self.timeout = timeout
+
+    # Key is IPv4 address and value is Tuple (hostname, expiration time).
+    self.cache = {}
+    # Key is IPv4 address and value is MAC address of devices being resolved.
+    self.pending = {}
+    self.lock = threading.Lock()
+
+    self.loop = None
+    self.queue = None
+    self.ready = threading.Event()
+
+    self.stats = {'hits': 0, 'misses': 0, 'resolved': 0, 'failed': 0}
+
+
+  def lookup(self, mac_addr, ip_addr):
+    """
+    Method returns cached name of given device, or an empty string if name is
+    not known yet. Uncached or expired devices are submitted for resolution.
+    Method never blocks, so it may be called on the discovery hot path.
+    """
+
+    now = time.monotonic()
+    cached = self.cache.get(ip_addr)
+    if cached and cached[1] > now:
+      self.stats['hits'] += 1
+      return cached[0]
+
+    self.stats['misses'] += 1
+    self.submit(mac_addr, ip_addr)
+
+    if cached:
+      # Keep serving expired name until resolution finishes.
+      return cached[0]
+
+    return ''
+
+
+  def submit(self, mac_addr, ip_addr):
+    """
+    Method queues given device for resolution, unless it is already queued.
+    """
+
+    with self.lock:
+      if ip_addr in self.pending or self.loop is None:
+        return
+      self.pending[ip_addr] = mac_addr
+
+    self.loop.call_soon_threadsafe(self.queue.put_nowait, ip_addr)
+
+
+  def run(self):
+    """
+    Method runs resolver's event loop forever. It is meant to be a thread
+    target.
+    """
+
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+    self.queue = asyncio.Queue()
+    self.ready.set()
+
+    workers = [self.loop.create_task(self.worker()) for i in range(self.concurrency)]
+    self.loop.run_until_complete(asyncio.gather(*workers))
+
+
+  async def worker(self):
+    while 1:
+      ip_addr = await self.queue.get()
+      try:
+        hostname = await self.resolve(ip_addr)
+      except Exception:
+        traceback.print_exc()
+        hostname = ''
+
+      with self.lock:
+        mac_addr = self.pending.pop(ip_addr, None)
+
+      self.store(mac_addr, ip_addr, hostname)
+
+
+  async def resolve(self, ip_addr):
+    """
+    Method tries configured resolution methods and returns the first name
+    found, or an empty string.
+    """
+
+    for method in self.methods:
+      try:
+        if method == 'dns':
+          hostname = await self.resolve_dns(ip_addr)
+        elif method == 'mdns':
+          hostname = await self.query_udp(ip_addr, MDNS_PORT, build_ptr_query, parse_ptr_response)
+        elif method == 'netbios':
+          hostname = await self.query_udp(ip_addr, NETBIOS_PORT, build_nbstat_query, parse_nbstat_response)
+        else:
+          continue
+      except (asyncio.TimeoutError, OSError, ValueError, IndexError, struct.error):
+        continue
+
+      if hostname:
+        return hostname
+
+    return ''
+
+
+  async def resolve_dns(self, ip_addr):
+    host, port = await asyncio.wait_for(self.loop.getnameinfo((ip_addr, 0), socket.NI_NAMEREQD), self.timeout)
+    return host
+
+
+  async def query_udp(self, ip_addr, port, build, parse):
+    """
+    Method sends a UDP query built by build(ip_addr, query_id) to given
+    address and port, and returns parse(response).
+    """
+
+    future = self.loop.create_future()
+    transport, protocol = await self.loop.create_datagram_endpoint(lambda: DatagramQuery(future),
+                                                                   remote_addr = (ip_addr, port))
+    try:
+      transport.sendto(build(ip_addr, random.randint(0, 0xffff)))
+      message = await asyncio.wait_for(future, self.timeout)
+    finally:
+      transport.close()
+
+    return parse(message)
+
+
+  def store(self, mac_addr, ip_addr, hostname):
+    """
+    Method caches resolution result and stores resolved name on the database.
+    """
+
+    now = time.monotonic()
+    if hostname:
+      self.stats['resolved'] += 1
+      self.cache[ip_addr] = (hostname, now + self.positive_ttl)
+      if mac_addr:
+        db.insert_devices_hostname(self.db_connection, {mac_addr: hostname})
+    else:
+      self.stats['failed'] += 1
+      self.cache[ip_addr] = ('', now + self.negative_ttl)
+
+
+
+
+
+def start_resolver(db_connection, options = None):
+  """
+  Function starts the shared resolver in a separate thread.
+
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - options: A dictionary (e.g., command line data). Used keys are
+    name_resolution (list of methods), resolver_concurrency, hostname_ttl and
+    negative_hostname_ttl.
+
+  Returns the resolver.
+  """
+
+  global resolver
+
+  options = options or {}
+  methods = options.get('name_resolution') or ['dns']
+  resolver = HostnameResolver(db_connection, methods,
+                              int(options.get('resolver_concurrency') or 16),
+                              float(options.get('hostname_ttl') or 3600),
+                              float(options.get('negative_hostname_ttl') or 300))
+
+  thread = threading.Thread(target = resolver.run)
+  thread.daemon = True
+  thread.start()
+  resolver.ready.wait()
+
+  utc_time_now = str(datetime.utcnow())
+  print('[' + utc_time_now + '] ' + 'Resolving device names using ' + ', '.join(methods))
+  return resolver
@@ -30,6 +30,8 @@ import ip_traffic
 import socket_client
 import utils
 import external
+import resolver
+import governor
 
 
 def main():
@@ -50,11 +52,15 @@ def main():
 
   if len(net_interfaces):
     print("Running device and port scanners on interfaces %s" % [i['iface'] for i in net_interfaces])
-    device_scan = threading.Thread(target = dd.search_network_devices, args = (db_connection, net_interfaces,))
+    resolver.start_resolver(db_connection, config_data)
+    # Probe engines draw from the governor, so it must exist before they start.
+    governor.configure(config_data, [i['iface'] for i in net_interfaces])
+    device_scan = threading.Thread(target = dd.search_network_devices, args = (db_connection, net_interfaces, config_data,))
     device_scan.start()
 
-    #port_scan = threading.Thread(target = port_scanner.scan_ports, args = (db_connection,))
-    #port_scan.start()
+    if config_data['scan_ports']:
+      port_scan = threading.Thread(target = port_scanner.scan_ports, args = (db_connection, config_data,))
+      port_scan.start()
   else:
     print("No network interfaces, disabling device and port scanners")
 
@@ -68,7 +74,7 @@ def main():
       t.start()
 
 
-  net_iface_thr = threading.Thread(target = iface_data.process_network_traffic_data, args = (db_connection,))
+  net_iface_thr = threading.Thread(target = iface_data.process_network_traffic_data, args = (db_connection, config_data,))
   net_iface_thr.start()
 
 
@@ -77,7 +83,7 @@ def main():
 
   #utc_time_now = str(datetime.utcnow())
   #print('[' + utc_time_now + '] ' + 'Start monitoring IP traffic ......................')
-  #ip_traffic_thr = threading.Thread(target = ip_traffic.run_ip_traffic_monitor, args = (db_connection, net_interfaces, agent_id, agent_ip,))
+  #ip_traffic_thr = threading.Thread(target = ip_traffic.run_ip_traffic_monitor, args = (db_connection, net_interfaces, agent_id, agent_ip, config_data,))
   #ip_traffic_thr.start()
 
 
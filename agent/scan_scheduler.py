@@ -0,0 +1,224 @@
+"""
+Module Name:
+  scan_scheduler.py
+
+
+Description:
+  Module provides an incremental port scan scheduler. Devices are kept in a
+  priority queue (heapq), new devices and devices whose IPv4 address changed
+  are scanned first, already scanned devices are rescanned on a longer,
+  jittered cadence and devices which have not been seen recently are skipped
+  until they show up again. Queue depth and age of the oldest scan show
+  whether scanning keeps up with the network.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import heapq
+import random
+import time
+
+
+# Priorities, lower is scanned first.
+PRIORITY_NEW = 0
+PRIORITY_RESCAN = 1
+
+
+
+
+
+class ScanScheduler(object):
+  """
+  Priority queue of devices to be port scanned.
+  """
+
+  def __init__(self, rescan_interval = 3600, jitter = 0.2, stale_after = 480, clock = time.time):
+    """
+    Arguments:
+    - rescan_interval: Interval (s) between two scans of a stable device.
+    - jitter: Relative jitter of rescan interval, e.g., 0.2 spreads rescans
+      over [0.8, 1.2] * rescan_interval, so devices found at the same time are
+      not rescanned in one burst.
+    - stale_after: Devices not seen for more than stale_after seconds are
+      not scanned.
+    - clock: Function returning current time (s). It must be the clock of
+      last seen times passed to sync method, otherwise devices are wrongly
+      taken for stale (or never are).
+    """
+
+    self.rescan_interval = float(rescan_interval)
+    self.jitter = float(jitter)
+    self.stale_after = float(stale_after)
+    self.clock = clock
+
+    # Heap of (priority, due time, sequence number, MAC address). Entries are
+    # never removed from the middle of the heap, an entry is valid only if its
+    # sequence number matches the device's one.
+    self.heap = []
+    # Key is MAC address and value is a dictionary
+    # {'ip': <IPv4>, 'last_seen': <s>, 'last_scan': <s or None>,
+    #  'added': <s>, 'seq': <sequence number of valid heap entry>}.
+    self.devices = {}
+    self.seq = 0
+    self.stats = {'scheduled_new': 0, 'scheduled_changed': 0, 'scanned': 0}
+
+
+  def push(self, mac_addr, priority, due):
+    self.seq += 1
+    self.devices[mac_addr]['seq'] = self.seq
+    heapq.heappush(self.heap, (priority, due, self.seq, mac_addr))
+
+
+  def sync(self, devices, now = None):
+    """
+    Method updates scheduler with current device table.
+
+    Arguments:
+    - devices: A list of (MAC address, IPv4 address, last seen time (s))
+      tuples, e.g., rows of agent_devices table with last_update converted to
+      seconds.
+    - now: Current time (s), see clock argument of the constructor.
+    """
+
+    if now is None:
+      now = self.clock()
+
+    current = set()
+    for mac_addr, ip_addr, last_seen in devices:
+      current.add(mac_addr)
+      device = self.devices.get(mac_addr)
+      if device is None:
+        self.devices[mac_addr] = {'ip': ip_addr, 'last_seen': last_seen or 0,
+                                  'last_scan': None, 'added': now, 'seq': 0}
+        self.push(mac_addr, PRIORITY_NEW, now)
+        self.stats['scheduled_new'] += 1
+        continue
+
+      device['last_seen'] = last_seen or 0
+      if device['ip'] != ip_addr:
+        # Device moved to another address, its ports must be scanned again.
+        device['ip'] = ip_addr
+        self.push(mac_addr, PRIORITY_NEW, now)
+        self.stats['scheduled_changed'] += 1
+
+    for mac_addr in list(self.devices):
+      if mac_addr not in current:
+        del self.devices[mac_addr]
+
+    # Drop invalid entries once they make up most of the heap.
+    if len(self.heap) > 2 * len(self.devices) + 64:
+      self.heap = [entry for entry in self.heap
+                   if entry[3] in self.devices and self.devices[entry[3]]['seq'] == entry[2]]
+      heapq.heapify(self.heap)
+
+
+  def is_stale(self, device, now):
+    return now - device['last_seen'] > self.stale_after
+
+
+  def next_batch(self, now = None, limit = None):
+    """
+    Method pops devices due for scanning, new and changed devices first.
+    Stale devices stay queued and are scanned once they are seen again.
+
+    Arguments:
+    - now: Current time (s), see clock argument of the constructor.
+    - limit: Maximum number of devices. If it is None all due devices are
+      returned.
+
+    Returns a list of (MAC address, IPv4 address) tuples.
+    """
+
+    if now is None:
+      now = self.clock()
+
+    batch = []
+    deferred = []
+    while self.heap and (limit is None or len(batch) < limit):
+      priority, due, seq, mac_addr = self.heap[0]
+      device = self.devices.get(mac_addr)
+      if device is None or device['seq'] != seq:
+        heapq.heappop(self.heap)
+        continue
+
+      if due > now:
+        break
+
+      heapq.heappop(self.heap)
+      if self.is_stale(device, now):
+        deferred.append((priority, due, seq, mac_addr))
+        continue
+
+      batch.append((mac_addr, device['ip']))
+
+    for entry in deferred:
+      heapq.heappush(self.heap, entry)
+
+    return batch
+
+
+  def done(self, mac_addr, now = None):
+    """
+    Method marks device as scanned and schedules its next scan.
+    """
+
+    if now is None:
+      now = self.clock()
+
+    device = self.devices.get(mac_addr)
+    if device is None:
+      return
+
+    device['last_scan'] = now
+    self.stats['scanned'] += 1
+    spread = random.uniform(1 - self.jitter, 1 + self.jitter)
+    self.push(mac_addr, PRIORITY_RESCAN, now + self.rescan_interval * spread)
+
+
+  def get_stats(self, now = None):
+    """
+    Method returns a dictionary with
+    - devices: Number of tracked devices.
+    - stale: Number of devices not seen for more than stale_after seconds.
+    - queue_depth: Number of devices due for scanning (stale devices are not
+      counted).
+    - never_scanned: Number of devices which have not been scanned yet.
+    - oldest_scan_age: Age (s) of the oldest scan of a device which is not
+      stale. A device which has not been scanned yet counts from the time it
+      was added. None if there is no such device.
+    and counters of scheduled and scanned devices.
+    """
+
+    if now is None:
+      now = self.clock()
+
+    due = set()
+    for priority, due_time, seq, mac_addr in self.heap:
+      device = self.devices.get(mac_addr)
+      if device is not None and device['seq'] == seq and due_time <= now and not self.is_stale(device, now):
+        due.add(mac_addr)
+
+    stale = 0
+    never_scanned = 0
+    oldest = None
+    for device in self.devices.values():
+      if self.is_stale(device, now):
+        stale += 1
+        continue
+      if device['last_scan'] is None:
+        never_scanned += 1
+        age = now - device['added']
+      else:
+        age = now - device['last_scan']
+      if oldest is None or age > oldest:
+        oldest = age
+
+    stats = dict(self.stats)
+    stats.update({'devices': len(self.devices), 'stale': stale, 'queue_depth': len(due),
+                  'never_scanned': never_scanned, 'oldest_scan_age': oldest})
+
+    return stats
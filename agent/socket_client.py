@@ -32,9 +32,24 @@ from datetime import datetime
 
 
 # Global variable stores devices' timestamp in order to check if data is not
-# updated then do not send device data to server.
+# updated then do not send device data to server. Key is MAC and value is a
+# dictionary {'state': <values of DEVICE_STATE_KEYS>, 'device_ts': <last_update>}.
 devices_update_timestamp = {}
 
+# Device values, whose change is sent as the whole device record. Open ports
+# are sent as port change events, see db.get_port_events function, and
+# last_update alone changes every sweep, so it is sent in a devices_seen
+# message every DEVICES_SEEN_INTERVAL seconds.
+DEVICE_STATE_KEYS = ('ip', 'hostname', 'iface', 'bandwidth')
+
+# Interval (s) between two devices_seen messages. Server takes a device for
+# down if it has not been seen for a minute.
+DEVICES_SEEN_INTERVAL = 20
+
+# Global variable stores last_update of devices, which have been seen but not
+# changed, since the last devices_seen message. Key is MAC.
+devices_seen = {}
+
 
 # Global variable stores network interfaces' timestamp in order to check if
 # data is not updated then do not send device data to server.
@@ -101,8 +116,10 @@ async def run_websocket(db_connection, server_url, config):
     utc_time_now = str(datetime.utcnow())
     print('[' + utc_time_now + '] ' +  'Websocket client has connected successfully ......')
 
+    seen_sent = time.monotonic()
+
     while 1:
-      data_types = ['devices_data', 'link_data', 'ids_data', 'iface_data']
+      data_types = ['devices_data', 'link_data', 'ids_data', 'iface_data', 'ip_traffic']
       for data_type in data_types:
         query = db.query_data(db_connection, data_type)
         json_data = filter_query_data(query, data_type, agent_id)
@@ -141,6 +158,32 @@ async def run_websocket(db_connection, server_url, config):
           print('Got response ..............................................................')
           """
 
+      # Port changes since the last round, instead of whole port lists.
+      events = db.get_port_events()
+      if events:
+        json_data = {'agent_id': agent_id, 'msg_type': 'port_events', 'data': events}
+        try:
+          await websocket.send(json.dumps(json_data))
+        except websockets.ConnectionClosed:
+          db.requeue_port_events(events)
+          print('Websocket disconnected')
+          return
+
+        utc_time_now = str(datetime.utcnow())
+        print('[' + utc_time_now + '] ' + str(len(events)) + ' port events have been sent ..............')
+
+      # Only last_update of devices, which did not change otherwise.
+      if devices_seen and time.monotonic() - seen_sent >= DEVICES_SEEN_INTERVAL:
+        json_data = {'agent_id': agent_id, 'msg_type': 'devices_seen', 'data': dict(devices_seen)}
+        try:
+          await websocket.send(json.dumps(json_data))
+        except websockets.ConnectionClosed:
+          print('Websocket disconnected')
+          return
+
+        devices_seen.clear()
+        seen_sent = time.monotonic()
+
       await asyncio.sleep(2)
 
 
@@ -182,6 +225,17 @@ def filter_query_data(query, data_type, agent_id):
     return filtered_data
 
 
+  # Process top external talkers, they are reported every round in which
+  # some external traffic has been seen.
+  if data_type == 'ip_traffic':
+    if not query.get('by_bytes'):
+      return {}
+    filtered_data['agent_id'] = agent_id
+    filtered_data['msg_type'] = data_type
+    filtered_data['data'] = query
+    return filtered_data
+
+
   # Process Intrusion Detection System (IDS) data.
   if data_type == 'ids_data':
     filtered_data['agent_id'] = agent_id
@@ -190,33 +244,23 @@ def filter_query_data(query, data_type, agent_id):
     return filtered_data
 
 
-  # Process devices data.
+  # Process devices data. A device record is sent if device is new or one of
+  # DEVICE_STATE_KEYS values changed. If only last_update changed it is
+  # queued for the next devices_seen message instead.
   if data_type == 'devices_data':
     filtered_data['agent_id'] = agent_id
     filtered_data['msg_type'] = data_type
 
     for key, value in query.items():
-      if str(key) in devices_update_timestamp:
-        ts_data = devices_update_timestamp[key]
-        if (value['last_update'] != ts_data['device_ts'] or
-            value['last_tcp_update'] != ts_data['tcp_ts'] or
-            value['last_udp_update'] != ts_data['udp_ts']):
-
-          data[str(key)] = value
-
-          # Better to initialize all than compare one by one.
-          ts_data['device_ts'] = value['last_update']
-          ts_data['tcp_ts'] = value['last_tcp_update']
-          ts_data['udp_ts'] = value['last_udp_update']
-          devices_update_timestamp[key] = ts_data
-
-      else:
-        ts_data = {'device_ts': value['last_update'],
-                   'tcp_ts': value['last_tcp_update'],
-                   'udp_ts': value['last_udp_update']
-                  }
-        devices_update_timestamp[key] = ts_data
+      state = tuple(value[name] for name in DEVICE_STATE_KEYS)
+      ts_data = devices_update_timestamp.get(key)
+      if ts_data is None or ts_data['state'] != state:
+        devices_update_timestamp[key] = {'state': state, 'device_ts': value['last_update']}
+        devices_seen.pop(str(key), None)
         data[str(key)] = value
+      elif ts_data['device_ts'] != value['last_update']:
+        ts_data['device_ts'] = value['last_update']
+        devices_seen[str(key)] = value['last_update']
 
     if data:
       filtered_data['data'] = data
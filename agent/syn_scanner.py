@@ -0,0 +1,427 @@
+"""
+Module Name:
+  syn_scanner.py
+
+
+Description:
+  Module provides a stateless TCP SYN scanner on top of raw sockets. One
+  sender pushes SYN packets for many (device, port) pairs at a controlled
+  packet rate and one receiver matches SYN-ACK and RST replies. No per-probe
+  state is kept, the sequence number of every SYN is a keyed hash (cookie) of
+  the target address and port, so a reply is valid only if it acknowledges
+  the cookie. Handshakes are never completed, the kernel answers SYN-ACKs with
+  RST as there is no socket behind them.
+
+  The scanner needs root (CAP_NET_RAW).
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import collections
+import errno
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+import traceback
+
+import arp_engine
+import db
+import governor
+import tcp_scanner
+
+
+# TCP flags.
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+TCP_HEADER = struct.Struct('!HHIIBBHHH')
+TCP_HEADER_LEN = TCP_HEADER.size
+
+# Window advertised in SYN packets.
+SYN_WINDOW = 1024
+
+# Classic BPF instructions as (code, jt, jf, k), see arp_engine module.
+BPF_LDX_B_MSH = 0xb1
+BPF_LD_H_IND = 0x48
+
+# Number of packets sent between two pacing checks.
+PACING_BATCH = 16
+
+# Number of devices scanned together. Results of a group are complete and
+# reported once wait seconds have passed since its last SYN.
+HOST_GROUP = 32
+
+
+
+
+
+def reply_filter(port):
+  """
+  Function returns BPF program for a raw IPv4 socket, which accepts only TCP
+  segments sent to given port:
+    ldxb 4*([0]&0xf)     ; IPv4 header length
+    ldh [x+2]            ; TCP destination port
+    jeq #port, 0, 1
+    ret #0x40000
+    ret #0
+  """
+
+  return [
+    (BPF_LDX_B_MSH, 0, 0, 0),
+    (BPF_LD_H_IND, 0, 0, 2),
+    (arp_engine.BPF_JEQ_K, 0, 1, port),
+    (arp_engine.BPF_RET_K, 0, 0, 0x40000),
+    (arp_engine.BPF_RET_K, 0, 0, 0),
+  ]
+
+
+
+
+
+def checksum_fold(total):
+  """
+  Function folds 32-bit one's complement sum to 16 bits and returns its
+  complement (Internet checksum).
+  """
+
+  total = (total & 0xffff) + (total >> 16)
+  total = (total & 0xffff) + (total >> 16)
+  return ~total & 0xffff
+
+
+
+
+
+def get_source_ip(ip_addr):
+  """
+  Function returns local IPv4 address the kernel would use to reach given
+  address. No packet is sent.
+  """
+
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    sock.connect((ip_addr, 9))
+    return sock.getsockname()[0]
+  finally:
+    sock.close()
+
+
+
+
+
+class SynScanner(object):
+  """
+  Stateless TCP SYN scanner with decoupled send and receive paths.
+  """
+
+  def __init__(self, packet_rate = 2000, wait = 1.0, src_port = None):
+    """
+    Arguments:
+    - packet_rate: Maximum number of SYN packets per second. If it is 0 or
+      None packets are sent as fast as possible.
+    - wait: Time (s) to wait for late replies after the last SYN was sent.
+    - src_port: Source port of SYN packets, replies are recognized by it. By
+      default a random port above the ephemeral port range is used.
+    """
+
+    self.packet_rate = float(packet_rate or 0)
+    self.wait = float(wait)
+    self.src_port = src_port or random.randint(61001, 65535)
+    self.secret = struct.unpack('!Q', os.urandom(8))[0]
+
+    self.send_sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_TCP)
+    self.recv_sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_TCP)
+    try:
+      self.send_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+      self.recv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+      self._filter = arp_engine.attach_filter(self.recv_sock, reply_filter(self.src_port))
+    except:
+      self.close()
+      raise
+
+    self.stats = {'sent': 0, 'open': 0, 'closed': 0, 'invalid': 0}
+
+
+  def close(self):
+    self.send_sock.close()
+    self.recv_sock.close()
+
+
+  def cookie(self, ip_int, port):
+    """
+    Method returns sequence number of SYN sent to given address and port.
+    """
+    return hash((self.secret, ip_int, port)) & 0xffffffff
+
+
+  def base_sum(self, src_ip, dst_ip):
+    """
+    Method returns one's complement sum of TCP pseudo header and all SYN
+    header fields, which do not depend on destination port and sequence
+    number. Per packet checksum then needs three additions only.
+    """
+
+    pseudo = socket.inet_aton(src_ip) + socket.inet_aton(dst_ip) + struct.pack('!BBH', 0, socket.IPPROTO_TCP, TCP_HEADER_LEN)
+    header = TCP_HEADER.pack(self.src_port, 0, 0, 0, (TCP_HEADER_LEN // 4) << 4, TCP_SYN, SYN_WINDOW, 0, 0)
+    data = pseudo + header
+
+    return sum(struct.unpack('!%dH' % (len(data) // 2), data))
+
+
+  def resolve(self, targets):
+    """
+    Method returns a list of (IPv4 address, address as integer, checksum base
+    sum, network interface) tuples of targets, which can be reached. See
+    base_sum method.
+    """
+
+    limiter = governor.get_governor()
+    hosts = []
+    for ip_addr in targets:
+      try:
+        src_ip = get_source_ip(ip_addr)
+      except OSError:
+        continue
+      ip_int = struct.unpack('!I', socket.inet_aton(ip_addr))[0]
+      iface = limiter.get_iface(ip_addr) if limiter else None
+      hosts.append((ip_addr, ip_int, self.base_sum(src_ip, ip_addr), iface))
+
+    return hosts
+
+
+  def send(self, hosts, ports):
+    """
+    Method sends one SYN to every port of every host. Ports are the outer
+    loop, so consecutive packets go to different devices.
+
+    Arguments:
+    - hosts: A list of resolved targets, see resolve method.
+    - ports: A list of port numbers.
+
+    Returns number of sent packets.
+    """
+
+    limiter = governor.get_governor()
+    inter = 0
+    if self.packet_rate:
+      inter = 1.0 / self.packet_rate
+
+    pack = TCP_HEADER.pack
+    sendto = self.send_sock.sendto
+    offset = (TCP_HEADER_LEN // 4) << 4
+    start = time.time()
+    sent = 0
+
+    for port in ports:
+      for ip_addr, ip_int, base, iface in hosts:
+        if limiter is not None:
+          limiter.acquire(iface, 1, governor.SYN_PACKET_SIZE, governor.PRIORITY_SCAN)
+        seq = self.cookie(ip_int, port)
+        check = checksum_fold(base + port + (seq >> 16) + (seq & 0xffff))
+        segment = pack(self.src_port, port, seq, 0, offset, TCP_SYN, SYN_WINDOW, check, 0)
+
+        while 1:
+          try:
+            sendto(segment, (ip_addr, 0))
+            break
+          except OSError as e:
+            if e.errno not in (errno.ENOBUFS, errno.EAGAIN):
+              break
+            # Queue is full, let it drain.
+            time.sleep(0.001)
+
+        sent += 1
+        if inter and sent % PACING_BATCH == 0:
+          # Pace against the start time, so sleep granularity does not add up.
+          delay = start + sent * inter - time.time()
+          if delay > 0:
+            time.sleep(delay)
+
+    self.stats['sent'] += sent
+    return sent
+
+
+  def parse_reply(self, packet):
+    """
+    Method parses a received IPv4 packet.
+
+    Returns Tuple (IPv4 address, port, True if port is open) or None if packet
+    is not a valid reply to our SYN.
+    """
+
+    ihl = (packet[0] & 0x0f) * 4
+    if len(packet) < ihl + TCP_HEADER_LEN:
+      return None
+
+    src_port, dst_port, seq, ack, offset, flags, window, check, urg = TCP_HEADER.unpack_from(packet, ihl)
+    if dst_port != self.src_port:
+      return None
+
+    ip_int = struct.unpack_from('!I', packet, 12)[0]
+    if (ack - 1) & 0xffffffff != self.cookie(ip_int, src_port):
+      self.stats['invalid'] += 1
+      return None
+
+    ip_addr = socket.inet_ntoa(packet[12:16])
+    if flags & (TCP_SYN | TCP_ACK) == TCP_SYN | TCP_ACK:
+      self.stats['open'] += 1
+      return (ip_addr, src_port, True)
+
+    if flags & TCP_RST:
+      self.stats['closed'] += 1
+      return (ip_addr, src_port, False)
+
+    return None
+
+
+  def receive(self, on_reply, stop):
+    """
+    Method receives replies until stop event is set.
+
+    Arguments:
+    - on_reply: Function called with (IPv4 address, port, open) of every
+      valid reply. Duplicates are reported as well.
+    - stop: threading.Event.
+    """
+
+    self.recv_sock.setblocking(False)
+    recv = self.recv_sock.recv
+    while not stop.is_set():
+      readable, writable, exceptional = select.select([self.recv_sock], [], [], 0.1)
+      if not readable:
+        continue
+
+      while 1:
+        try:
+          packet = recv(256)
+        except (BlockingIOError, InterruptedError):
+          break
+
+        reply = self.parse_reply(packet)
+        if reply is not None:
+          on_reply(*reply)
+
+
+  def scan(self, targets, ports, on_reply, on_done = None, group_size = HOST_GROUP):
+    """
+    Method sends SYNs to all ports of all targets in groups of group_size
+    devices, while replies are received in a separate thread, and returns
+    wait seconds after the last SYN.
+
+    Arguments:
+    - targets: A list of IPv4 addresses.
+    - ports: A list of port numbers.
+    - on_reply: Function called with (IPv4 address, port, open) of every
+      valid reply. It is called from the receiver thread.
+    - on_done: Function called with a list of IPv4 addresses of a group, once
+      wait seconds have passed since its last SYN, so no more replies of the
+      group are expected. It is called from the calling thread while later
+      groups are being scanned. Unreachable targets are not reported.
+    - group_size: Number of devices scanned together.
+    """
+
+    stop = threading.Event()
+    receiver = threading.Thread(target = self.receive, args = (on_reply, stop))
+    receiver.daemon = True
+    receiver.start()
+
+    # Groups waiting for late replies as (deadline, addresses) tuples.
+    pending = []
+    try:
+      for i in range(0, len(targets), group_size):
+        hosts = self.resolve(targets[i:i + group_size])
+        self.send(hosts, ports)
+        pending.append((time.time() + self.wait, [host[0] for host in hosts]))
+
+        while pending and pending[0][0] <= time.time():
+          deadline, group = pending.pop(0)
+          if on_done is not None:
+            on_done(group)
+
+      for deadline, group in pending:
+        delay = deadline - time.time()
+        if delay > 0:
+          time.sleep(delay)
+        if on_done is not None:
+          on_done(group)
+
+      if not targets:
+        time.sleep(self.wait)
+    finally:
+      stop.set()
+      receiver.join()
+
+
+
+
+
+def scan_devices(db_connection, devices, ports, options = None):
+  """
+  Function SYN scans TCP ports of given devices and stores open ports of every
+  device on the database as soon as its group is done (see SynScanner.scan
+  method). Replies arrive in any order, so a device's port set is complete
+  only when no more replies are expected, and storing partial sets would
+  report its other open ports as closed.
+
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - devices: A list of (MAC address, IPv4 address) tuples.
+  - ports: Port set, see tcp_scanner.parse_ports function.
+  - options: A dictionary (e.g., command line data). Used keys are syn_rate
+    and scan_timeout (time to wait for late replies).
+
+  Returns the scanner, its stats attribute contains counters of the scan.
+  Raises OSError (e.g., PermissionError) if raw sockets cannot be opened.
+  """
+
+  options = options or {}
+  scanner = SynScanner(options.get('syn_rate') or 2000, options.get('scan_timeout') or 1.0)
+
+  # Key is IPv4 address and value is a list of MAC addresses, devices may
+  # share an address (e.g., a reused DHCP lease).
+  macs = collections.OrderedDict()
+  for device_mac, device_ip in devices:
+    macs.setdefault(device_ip, []).append(device_mac)
+  open_ports = dict((device_ip, set()) for device_ip in macs)
+  # Addresses, which sent any valid SYN-ACK or RST. A silent device (down or
+  # dropping probes) is not stored, so its known ports are kept, see
+  # tcp_scanner.scan_host function.
+  replied = set()
+  lock = threading.Lock()
+
+  def on_reply(ip_addr, port, is_open):
+    with lock:
+      if ip_addr in open_ports:
+        replied.add(ip_addr)
+        if is_open:
+          open_ports[ip_addr].add(port)
+
+  def on_done(group):
+    for ip_addr in group:
+      # Late duplicates of a stored device are dropped.
+      with lock:
+        ports_found = open_ports.pop(ip_addr, None)
+        if ip_addr not in replied:
+          ports_found = None
+      if ports_found is not None:
+        for device_mac in macs[ip_addr]:
+          db.insert_port_data(db_connection, device_mac, ip_addr, sorted(ports_found), 'tcp')
+
+  try:
+    scanner.scan(list(macs), tcp_scanner.parse_ports(ports), on_reply, on_done)
+  except Exception:
+    traceback.print_exc()
+  finally:
+    scanner.close()
+
+  return scanner
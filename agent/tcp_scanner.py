@@ -0,0 +1,306 @@
+"""
+Module Name:
+  tcp_scanner.py
+
+
+Description:
+  Module provides an in-process TCP connect scanner built on asyncio. All
+  devices are scanned concurrently on one event loop, the number of connection
+  attempts in flight is bounded globally and per device, and every device's
+  result is handed over (e.g., stored on the database) as soon as its ports
+  have been scanned.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import asyncio
+import errno
+import resource
+import socket
+import struct
+import traceback
+
+import db
+import governor
+
+
+# Port states.
+PORT_OPEN = 'open'
+PORT_CLOSED = 'closed'
+PORT_FILTERED = 'filtered'
+HOST_UNREACHABLE = 'unreachable'
+
+# Connection errors, which mean that the device cannot be reached at all, so
+# the rest of its ports is not scanned.
+UNREACHABLE_ERRORS = (errno.EHOSTUNREACH, errno.ENETUNREACH, errno.EHOSTDOWN)
+
+# Close connections with RST (SO_LINGER with zero timeout), so scanning does
+# not leave thousands of sockets in TIME_WAIT state.
+LINGER_RST = struct.pack('ii', 1, 0)
+
+# File descriptors kept free for the rest of the Agent.
+RESERVED_FDS = 64
+
+
+
+
+
+def parse_ports(ports):
+  """
+  Function parses port set specification.
+
+  Arguments:
+  - ports: A string, e.g., '1-512,8080,8443', or a list of port numbers.
+
+  Returns a sorted list of unique port numbers.
+  """
+
+  if isinstance(ports, str):
+    result = set()
+    for item in ports.split(','):
+      item = item.strip()
+      if not item:
+        continue
+      if '-' in item:
+        low, high = item.split('-', 1)
+        result.update(range(int(low), int(high) + 1))
+      else:
+        result.add(int(item))
+  else:
+    result = set(int(port) for port in ports)
+
+  for port in result:
+    if port < 1 or port > 65535:
+      raise ValueError('Invalid port number %d' % port)
+
+  return sorted(result)
+
+
+
+
+
+def max_concurrency(concurrency):
+  """
+  Function returns concurrency limited by the number of file descriptors the
+  process may open, as every connection attempt needs one.
+  """
+
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if soft == resource.RLIM_INFINITY:
+    return concurrency
+
+  return max(1, min(concurrency, soft - RESERVED_FDS))
+
+
+
+
+
+def port_state(error):
+  """
+  Function returns port state of a finished connection attempt.
+
+  Arguments:
+  - error: errno of the connection attempt, 0 on success.
+  """
+
+  if error == 0:
+    return PORT_OPEN
+  if error == errno.ECONNREFUSED:
+    return PORT_CLOSED
+  if error in UNREACHABLE_ERRORS:
+    return HOST_UNREACHABLE
+
+  return PORT_FILTERED
+
+
+
+
+
+class TcpScanner(object):
+  """
+  Asynchronous TCP connect scanner.
+  """
+
+  def __init__(self, concurrency = 512, host_concurrency = 32, timeout = 1.0):
+    """
+    Arguments:
+    - concurrency: Maximum number of connection attempts in flight.
+    - host_concurrency: Maximum number of connection attempts in flight to a
+      single device.
+    - timeout: Time (s) after which an unanswered connection attempt is
+      considered filtered.
+    """
+
+    self.concurrency = max_concurrency(int(concurrency))
+    self.host_concurrency = max(1, min(int(host_concurrency), self.concurrency))
+    self.timeout = float(timeout)
+
+    self.loop = None
+    self.slots = None
+    # Agent-wide packet rate governor (see governor module) or None. Only one
+    # coroutine at a time waits for it, the others queue on gate.
+    self.governor = governor.get_governor()
+    self.gate = None
+    self.stats = {'hosts': 0, 'probes': 0, 'open': 0, 'closed': 0, 'filtered': 0, 'unreachable': 0}
+
+
+  def probe(self, ip_addr, port):
+    """
+    Method starts a non-blocking connection attempt to given port.
+
+    Returns a future, which is resolved with port state. Connection attempts
+    are driven by the event loop's writer callbacks and timers directly, which
+    is much cheaper than a task per attempt.
+    """
+
+    future = self.loop.create_future()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, LINGER_RST)
+
+    error = sock.connect_ex((ip_addr, port))
+    if error != errno.EINPROGRESS:
+      sock.close()
+      future.set_result(port_state(error))
+      return future
+
+    fd = sock.fileno()
+
+    def finish(state):
+      if future.done():
+        return
+      self.loop.remove_writer(fd)
+      timer.cancel()
+      sock.close()
+      future.set_result(state)
+
+    def writable():
+      finish(port_state(sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)))
+
+    timer = self.loop.call_later(self.timeout, finish, PORT_FILTERED)
+    self.loop.add_writer(fd, writable)
+
+    return future
+
+
+  async def scan_host(self, ip_addr, ports):
+    """
+    Method scans given ports of one device with at most host_concurrency
+    connection attempts in flight.
+
+    Returns a sorted list of open ports, or None if device is unreachable.
+    """
+
+    open_ports = []
+    pending = iter(ports)
+    state = {'unreachable': False}
+    iface = self.governor.get_iface(ip_addr) if self.governor else None
+
+    async def worker():
+      for port in pending:
+        if state['unreachable']:
+          return
+        if self.governor is not None:
+          async with self.gate:
+            await self.governor.wait(iface, 1, governor.SYN_PACKET_SIZE, governor.PRIORITY_SCAN)
+        async with self.slots:
+          result = await self.probe(ip_addr, port)
+        self.stats['probes'] += 1
+        self.stats[result] += 1
+        if result == PORT_OPEN:
+          open_ports.append(port)
+        elif result == HOST_UNREACHABLE:
+          state['unreachable'] = True
+
+    workers = min(self.host_concurrency, len(ports))
+    await asyncio.gather(*[worker() for i in range(workers)])
+
+    self.stats['hosts'] += 1
+    if state['unreachable'] and not open_ports:
+      return None
+
+    return sorted(open_ports)
+
+
+  async def scan(self, devices, ports, on_result):
+    """
+    Method scans given ports of all devices.
+
+    Arguments:
+    - devices: A list of (MAC address, IPv4 address) tuples.
+    - ports: Port set, see parse_ports function.
+    - on_result: Function called with (MAC address, IPv4 address, open ports)
+      as soon as a device is scanned. Unreachable devices are not reported.
+    """
+
+    self.loop = asyncio.get_event_loop()
+    self.slots = asyncio.Semaphore(self.concurrency)
+    self.gate = asyncio.Lock()
+    ports = parse_ports(ports)
+    if not ports:
+      return
+
+    pending = iter(devices)
+
+    async def worker():
+      for device_mac, device_ip in pending:
+        try:
+          open_ports = await self.scan_host(device_ip, ports)
+          if open_ports is not None:
+            on_result(device_mac, device_ip, open_ports)
+        except Exception:
+          traceback.print_exc()
+
+    # Just enough devices in progress to fill all global slots. More would
+    # only queue up on the semaphore.
+    workers = max(1, self.concurrency // self.host_concurrency)
+    await asyncio.gather(*[worker() for i in range(min(workers, len(devices)))])
+
+
+  def run(self, devices, ports, on_result):
+    """
+    Method runs scan on a new event loop in the calling thread and returns
+    when all devices are scanned.
+    """
+
+    loop = asyncio.new_event_loop()
+    try:
+      asyncio.set_event_loop(loop)
+      loop.run_until_complete(self.scan(list(devices), ports, on_result))
+    finally:
+      asyncio.set_event_loop(None)
+      loop.close()
+
+
+
+
+
+def scan_devices(db_connection, devices, ports, options = None):
+  """
+  Function scans TCP ports of given devices and stores every device's open
+  ports on the database as soon as it is scanned.
+
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - devices: A list of (MAC address, IPv4 address) tuples.
+  - ports: Port set, see parse_ports function.
+  - options: A dictionary (e.g., command line data). Used keys are
+    scan_concurrency, scan_host_concurrency and scan_timeout.
+
+  Returns the scanner, its stats attribute contains counters of the scan.
+  """
+
+  options = options or {}
+  scanner = TcpScanner(options.get('scan_concurrency') or 512,
+                       options.get('scan_host_concurrency') or 32,
+                       options.get('scan_timeout') or 1.0)
+
+  def store(device_mac, device_ip, open_ports):
+    db.insert_port_data(db_connection, device_mac, device_ip, open_ports, 'tcp')
+
+  scanner.run(devices, ports, store)
+  return scanner
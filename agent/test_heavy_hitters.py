@@ -0,0 +1,107 @@
+"""
+Module Name:
+  test_heavy_hitters.py
+
+
+Description:
+  Tests of Space-Saving summaries and top talkers of heavy_hitters module.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import math
+
+import pytest
+
+import heavy_hitters
+
+
+
+
+
+def test_eviction_replaces_smallest():
+  summary = heavy_hitters.SpaceSaving(capacity = 2, half_life = 0, now = 0)
+  summary.add('a', 5, 0)
+  summary.add('b', 3, 0)
+  summary.add('a', 2, 0)
+
+  # c replaces b, the smallest item, and inherits its count as error.
+  summary.add('c', 1, 0)
+  assert summary.get('b') is None
+  assert summary.get('a') == (7, 0)
+  assert summary.get('c') == (4, 3)
+  assert summary.stats['evictions'] == 1
+
+  # c is the smallest now, a grown item is not evicted.
+  summary.add('d', 10, 0)
+  assert summary.get('c') is None
+  assert summary.get('d') == (14, 4)
+  assert [item for item, count, error in summary.top(2)] == ['d', 'a']
+  assert len(summary) == 2
+
+
+def test_eviction_skips_stale_heap_entries():
+  summary = heavy_hitters.SpaceSaving(capacity = 2, half_life = 0, now = 0)
+  summary.add('a', 1, 0)
+  summary.add('b', 2, 0)
+  # Heap still holds (1, 'a'), but a is the largest item now.
+  summary.add('a', 10, 0)
+
+  summary.add('c', 1, 0)
+  assert summary.get('b') is None
+  assert summary.get('a') == (11, 0)
+  assert summary.get('c') == (3, 2)
+
+
+def test_decay_half_life():
+  summary = heavy_hitters.SpaceSaving(capacity = 4, half_life = 10, now = 0)
+  summary.add('a', 100, 0)
+  summary.add('b', 100, 10)
+
+  assert summary.get('a', 10)[0] == pytest.approx(50)
+  assert summary.get('b', 10)[0] == pytest.approx(100)
+  assert summary.get('a', 30)[0] == pytest.approx(12.5)
+  assert [item for item, count, error in summary.top(2, 10)] == ['b', 'a']
+
+
+def test_rescale_keeps_counts_and_order():
+  half_life = 1.0
+  tau = half_life / math.log(2)
+  summary = heavy_hitters.SpaceSaving(capacity = 2, half_life = half_life, now = 0)
+  summary.add('a', 8, 0)
+  summary.add('b', 4, 0)
+
+  # Past the rescale exponent the landmark moves to now.
+  now = (heavy_hitters.RESCALE_EXPONENT + 1) * tau
+  summary.add('b', 1, now)
+  assert summary.stats['rescales'] == 1
+  assert summary.landmark == now
+
+  expected = 8 * math.exp(-now / tau)
+  assert summary.get('a', now)[0] == pytest.approx(expected)
+  assert summary.get('b', now)[0] == pytest.approx(1 + expected / 2)
+  assert [item for item, count, error in summary.top(2, now)] == ['b', 'a']
+
+  # Eviction after the rescale still picks the smallest item.
+  summary.add('c', 0.5, now)
+  assert summary.get('a', now) is None
+  assert summary.get('c', now) == pytest.approx((0.5 + expected, expected))
+
+
+def test_top_talkers_by_bytes_and_packets():
+  talkers = heavy_hitters.HeavyHitters(capacity = 8, half_life = 0, top_count = 2)
+  talkers.update('1.1.1.1', 1500, 1, 0)
+  talkers.update('8.8.8.8', 100, 10, 0)
+  talkers.update('9.9.9.9', 50, 1, 0)
+
+  by_bytes = talkers.top(2, 'bytes', 0)
+  assert [talker['ip'] for talker in by_bytes] == ['1.1.1.1', '8.8.8.8']
+  assert by_bytes[0]['bytes'] == 1500 and by_bytes[0]['packets'] == 1
+
+  by_packets = talkers.top(2, 'packets', 0)
+  assert [talker['ip'] for talker in by_packets] == ['8.8.8.8', '1.1.1.1']
+  assert by_packets[0]['bytes'] == 100
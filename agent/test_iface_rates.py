@@ -0,0 +1,88 @@
+"""
+Module Name:
+  test_iface_rates.py
+
+
+Description:
+  Tests of counter resets, wraps and rate tiers of iface_rates module.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import pytest
+
+import iface_rates
+
+
+
+
+
+def test_rates_between_samples():
+  rates = iface_rates.InterfaceRates()
+  rates.update({'rx_bytes': 1000, 'tx_bytes': 500}, 10)
+  assert rates.current == {}
+
+  rates.update({'rx_bytes': 3000, 'tx_bytes': 500}, 12)
+  assert rates.current == {'rx_bytes': 1000.0, 'tx_bytes': 0.0}
+  assert rates.stats == {'samples': 2, 'wraps': 0, 'resets': 0}
+
+
+def test_decrease_of_64_bit_counter_is_reset():
+  rates = iface_rates.InterfaceRates()
+  # A small 64-bit counter going back is not a 32-bit wrap.
+  rates.update({'rx_bytes': (1 << 32) - 100}, 0)
+  rates.update({'rx_bytes': 100}, 1)
+  assert rates.current == {}
+  assert rates.stats['resets'] == 1
+  assert rates.stats['wraps'] == 0
+  assert rates.tiers['1s'].get('rx_bytes', 0, 1) == [None]
+
+  # Rates continue from the sample after the reset.
+  rates.update({'rx_bytes': 600}, 2)
+  assert rates.current == {'rx_bytes': 500.0}
+
+
+def test_wrap_of_32_bit_counter():
+  rates = iface_rates.InterfaceRates(counter_bits = 32)
+  rates.update({'rx_bytes': (1 << 32) - 100}, 0)
+  rates.update({'rx_bytes': 100}, 1)
+  assert rates.current == {'rx_bytes': 200.0}
+  assert rates.stats['wraps'] == 1
+
+  # A small decrease of a 32-bit counter is still a reset.
+  rates.update({'rx_bytes': 50}, 2)
+  assert rates.current == {}
+  assert rates.stats['resets'] == 1
+
+
+def test_tier_spreads_increments_over_slots():
+  rates = iface_rates.InterfaceRates()
+  rates.update({'rx_bytes': 0}, 10.5)
+  rates.update({'rx_bytes': 300}, 13.5)
+
+  tier = rates.tiers['1s']
+  assert tier.get('rx_bytes', 13, 5) == [None, pytest.approx(100.0), pytest.approx(100.0),
+                                         pytest.approx(100.0), pytest.approx(100.0)]
+  assert tier.covered[10] == pytest.approx(0.5)
+  assert tier.sums['rx_bytes'][10] == pytest.approx(50.0)
+
+
+def test_rate_store_series():
+  store = iface_rates.RateStore()
+  store.update('eth0', {'rx_bytes': 0}, 60)
+  store.update('eth0', {'rx_bytes': 6000}, 120)
+  store.update('eth0', {}, 130)
+
+  assert store.get_current('eth0') == {'rx_bytes': 100.0}
+
+  series = store.get_series('eth0', 'rx_bytes', '1m', 2, now = 121)
+  assert [value for ts, value in series] == [pytest.approx(100.0), None]
+  assert series[1][0] - series[0][0] == 60
+
+  store.retain(['eth1'])
+  assert store.get_current('eth0') == {}
+  assert store.get_stats() == {}
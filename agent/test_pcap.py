@@ -0,0 +1,153 @@
+"""
+Module Name:
+  test_pcap.py
+
+
+Description:
+  Tests of pcap and pcapng readers and of the pcap writer of pcap module.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import struct
+
+import pytest
+
+import pcap
+
+
+LINKTYPE_RAW = 101
+
+FRAMES = [bytes([i]) * (60 + i) for i in range(1, 6)]
+
+
+
+
+
+def block(endian, block_type, body):
+  body += b'\x00' * (-len(body) % 4)
+  length = len(body) + 12
+  return struct.pack(endian + 'II', block_type, length) + body + struct.pack(endian + 'I', length)
+
+
+
+
+
+def section_header(endian):
+  return block(endian, pcap.PCAPNG_SECTION_HEADER,
+               struct.pack(endian + 'IHHq', pcap.PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1))
+
+
+
+
+
+def interface(endian, linktype, tsresol = None):
+  body = struct.pack(endian + 'HHI', linktype, 0, 65535)
+  if tsresol is not None:
+    body += struct.pack(endian + 'HH', pcap.PCAPNG_IF_TSRESOL, 1) + bytes([tsresol, 0, 0, 0])
+    body += struct.pack(endian + 'HH', 0, 0)
+  return block(endian, pcap.PCAPNG_INTERFACE, body)
+
+
+
+
+
+def enhanced_packet(endian, iface, ticks, frame, original = None):
+  body = struct.pack(endian + 'IIIII', iface, ticks >> 32, ticks & 0xffffffff, len(frame), original or len(frame))
+  return block(endian, pcap.PCAPNG_ENHANCED_PACKET, body + frame)
+
+
+
+
+
+def obsolete_packet(endian, iface, ticks, frame):
+  body = struct.pack(endian + 'HHIIII', iface, 0, ticks >> 32, ticks & 0xffffffff, len(frame), len(frame))
+  return block(endian, pcap.PCAPNG_PACKET, body + frame)
+
+
+
+
+
+def simple_packet(endian, frame):
+  return block(endian, pcap.PCAPNG_SIMPLE_PACKET, struct.pack(endian + 'I', len(frame)) + frame)
+
+
+
+
+
+def test_read_pcapng_sections(tmp_path):
+  path = tmp_path / 'capture.pcapng'
+  data = b''.join([
+    # Big-endian section with nanosecond Ethernet and a raw IP interface.
+    section_header('>'),
+    interface('>', pcap.LINKTYPE_ETHERNET, tsresol = 9),
+    interface('>', LINKTYPE_RAW),
+    enhanced_packet('>', 1, 1500000000000000, FRAMES[1]),
+    enhanced_packet('>', 0, 1500000000123456789, FRAMES[0], original = 1514),
+    simple_packet('>', FRAMES[2]),
+    # Little-endian section with default microsecond and 2^-10 s interfaces.
+    section_header('<'),
+    interface('<', pcap.LINKTYPE_ETHERNET),
+    interface('<', pcap.LINKTYPE_ETHERNET, tsresol = 0x80 | 10),
+    enhanced_packet('<', 0, 1600000000250000, FRAMES[3]),
+    obsolete_packet('<', 1, 1024 * 1700000000 + 512, FRAMES[4]),
+  ])
+  path.write_bytes(data)
+
+  packets = list(pcap.read_pcapng(str(path)))
+  assert [frame for ts, length, frame in packets] == [FRAMES[0], FRAMES[2], FRAMES[3], FRAMES[4]]
+  assert [length for ts, length, frame in packets] == [1514, len(FRAMES[2]), len(FRAMES[3]), len(FRAMES[4])]
+
+  timestamps = [ts for ts, length, frame in packets]
+  assert timestamps[0] == pytest.approx(1500000000.123456789, abs = 1e-6)
+  # Simple packet block gets the timestamp of the previous packet.
+  assert timestamps[1] == timestamps[0]
+  assert timestamps[2] == pytest.approx(1600000000.25)
+  assert timestamps[3] == pytest.approx(1700000000.5)
+
+  assert list(pcap.read_packets(str(path))) == packets
+
+
+def test_read_pcapng_errors(tmp_path):
+  path = tmp_path / 'unknown.pcapng'
+  path.write_bytes(section_header('<') + enhanced_packet('<', 0, 0, FRAMES[0]))
+  with pytest.raises(ValueError):
+    list(pcap.read_pcapng(str(path)))
+
+  path = tmp_path / 'nosection.pcapng'
+  path.write_bytes(interface('<', pcap.LINKTYPE_ETHERNET))
+  with pytest.raises(ValueError):
+    list(pcap.read_pcapng(str(path)))
+
+
+def test_write_and_read_pcap(tmp_path):
+  path = tmp_path / 'capture.pcap'
+  packets = [(1000.0 + i * 0.25, frame) for i, frame in enumerate(FRAMES)]
+  assert pcap.write_pcap(str(path), packets) == len(FRAMES)
+
+  read = list(pcap.read_packets(str(path)))
+  assert [(ts, length, frame) for ts, length, frame in read] == \
+         [(pytest.approx(ts), len(frame), frame) for ts, frame in packets]
+
+
+def test_read_pcap_big_endian_nanoseconds(tmp_path):
+  path = tmp_path / 'capture.pcap'
+  header = struct.pack('>IHHiIII', pcap.PCAP_MAGIC_NSEC, 2, 4, 0, 0, 65535, pcap.LINKTYPE_ETHERNET)
+  record = struct.pack('>IIII', 1500000000, 500000001, 60, 1514)
+  path.write_bytes(header + record + FRAMES[0][:60])
+
+  ((ts, length, frame),) = list(pcap.read_pcap(str(path)))
+  assert ts == pytest.approx(1500000000.500000001)
+  assert length == 1514
+  assert frame == FRAMES[0][:60]
+
+
+def test_read_pcap_unsupported_link_type(tmp_path):
+  path = tmp_path / 'raw.pcap'
+  path.write_bytes(struct.pack('<IHHiIII', pcap.PCAP_MAGIC, 2, 4, 0, 0, 65535, LINKTYPE_RAW))
+  with pytest.raises(ValueError):
+    list(pcap.read_pcap(str(path)))
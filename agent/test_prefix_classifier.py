@@ -0,0 +1,143 @@
+"""
+Module Name:
+  test_prefix_classifier.py
+
+
+Description:
+  Tests of longest prefix match lookup tables of prefix_classifier module.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import ipaddress
+import random
+import socket
+
+import prefix_classifier
+from prefix_classifier import EXTERNAL, LOCAL, IGNORED
+
+
+# Nested prefixes of every level of the lookup table.
+ENTRIES = [
+  ('10.0.0.0/8', LOCAL),
+  ('10.1.0.0/16', IGNORED),
+  ('10.1.2.0/24', LOCAL),
+  ('10.1.2.128/25', IGNORED),
+  ('10.1.2.200/30', LOCAL),
+  ('10.1.2.201/32', IGNORED),
+  ('192.168.1.7/32', LOCAL),
+  ('172.16.0.0/12', LOCAL),
+  ('172.16.5.0/24', IGNORED),
+]
+
+
+
+
+
+def lookup(tables, ip_addr):
+  address = int(ipaddress.IPv4Address(ip_addr))
+  level1, level2, level3 = tables
+  node = level1[address >> 16]
+  if node < prefix_classifier.NODE:
+    return node
+  node = level2[node][(address >> 8) & 0xff]
+  if node < prefix_classifier.NODE:
+    return node
+  return level3[node][address & 0xff]
+
+
+
+
+
+def brute_force(entries, ip_addr):
+  address = ipaddress.IPv4Address(ip_addr)
+  best = (-1, EXTERNAL)
+  for network, address_class in entries:
+    if address in network and (network.prefixlen, address_class) > best:
+      best = (network.prefixlen, address_class)
+  return best[1]
+
+
+
+
+
+def test_compile_prefixes_longest_match():
+  entries = [(ipaddress.IPv4Network(prefix), address_class) for prefix, address_class in ENTRIES]
+  tables = prefix_classifier.compile_prefixes(entries)
+
+  expected = {
+    '10.200.0.1': LOCAL,
+    '10.1.0.1': IGNORED,
+    '10.1.2.1': LOCAL,
+    '10.1.2.127': LOCAL,
+    '10.1.2.128': IGNORED,
+    '10.1.2.200': LOCAL,
+    '10.1.2.201': IGNORED,
+    '10.1.2.203': LOCAL,
+    '10.1.2.204': IGNORED,
+    '10.1.3.1': IGNORED,
+    '192.168.1.7': LOCAL,
+    '192.168.1.8': EXTERNAL,
+    '172.31.255.255': LOCAL,
+    '172.16.5.9': IGNORED,
+    '172.32.0.1': EXTERNAL,
+    '8.8.8.8': EXTERNAL,
+  }
+  for ip_addr, address_class in expected.items():
+    assert lookup(tables, ip_addr) == address_class, ip_addr
+
+
+def test_compile_prefixes_matches_brute_force():
+  rand = random.Random(7)
+  entries = [(ipaddress.IPv4Network(prefix), address_class) for prefix, address_class in ENTRIES]
+  for i in range(40):
+    prefixlen = rand.randint(8, 32)
+    address = rand.getrandbits(32) & 0x0affffff | 0x0a000000
+    entries.append((ipaddress.IPv4Network((address, prefixlen), strict = False), rand.choice([LOCAL, IGNORED])))
+
+  tables = prefix_classifier.compile_prefixes(entries)
+  for i in range(2000):
+    ip_addr = str(ipaddress.IPv4Address(rand.getrandbits(32) & 0x0affffff | 0x0a000000))
+    assert lookup(tables, ip_addr) == brute_force(entries, ip_addr), ip_addr
+
+
+def test_equal_prefix_ignored_wins():
+  network = ipaddress.IPv4Network('10.9.0.0/16')
+  tables = prefix_classifier.compile_prefixes([(network, IGNORED), (network, LOCAL)])
+  assert lookup(tables, '10.9.1.1') == IGNORED
+
+
+def test_classifier_interfaces_and_broadcast():
+  classifier = prefix_classifier.PrefixClassifier(site_prefixes = '100.64.0.0/10')
+  classifier.set_interfaces(['192.168.1.10/24', '10.8.0.1'])
+
+  assert classifier.classify_ip('192.168.1.77') == LOCAL
+  assert classifier.classify_ip('192.168.1.255') == IGNORED
+  assert classifier.classify_ip('10.8.0.1') == LOCAL
+  assert classifier.classify_ip('10.8.0.2') == EXTERNAL
+  assert classifier.classify_ip('100.127.0.1') == LOCAL
+  assert classifier.classify_ip('127.0.0.1') == IGNORED
+  assert classifier.classify_ip('239.255.255.250') == IGNORED
+  assert classifier.classify_ip('255.255.255.255') == IGNORED
+  assert classifier.classify_ip('1.1.1.1') == EXTERNAL
+
+  packed = socket.inet_aton('192.168.1.77')
+  assert classifier.classify_packed(packed) == classifier.classify(int.from_bytes(packed, 'big')) == LOCAL
+
+
+def test_classifier_rebuilds_only_on_change():
+  classifier = prefix_classifier.PrefixClassifier()
+  classifier.set_interfaces(['192.168.1.10/24'])
+  builds = classifier.stats['builds']
+
+  classifier.set_interfaces(['192.168.1.10/24'])
+  assert classifier.stats['builds'] == builds
+
+  classifier.set_interfaces(['192.168.2.10/24'])
+  assert classifier.stats['builds'] == builds + 1
+  assert classifier.classify_ip('192.168.1.77') == EXTERNAL
+  assert classifier.classify_ip('192.168.2.77') == LOCAL
@@ -0,0 +1,127 @@
+"""
+Module Name:
+  test_replay.py
+
+
+Description:
+  End-to-end test of replay module: a small pcap file written by pcap module
+  is replayed through the traffic and discovery pipelines into an in-memory
+  database.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import socket
+import struct
+
+import pytest
+
+# Replay stores data through db module, which imports them (see utils module).
+for module in ('netifaces', 'ifaddr'):
+  pytest.importorskip(module)
+
+import db
+import pcap
+import replay
+
+
+LOCAL_MAC = bytes.fromhex('020000000001')
+ROUTER_MAC = bytes.fromhex('020000000002')
+DEVICE_MAC = bytes.fromhex('0200000000aa')
+
+
+
+
+
+def udp_frame(src, dst, sport, dport, payload_len):
+  """
+  Function returns Ethernet frame of an IPv4 UDP packet.
+  """
+
+  total = 20 + 8 + payload_len
+  ip_header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, total, 0, 0, 64, socket.IPPROTO_UDP, 0,
+                          socket.inet_aton(src), socket.inet_aton(dst))
+  udp_header = struct.pack('!HHHH', sport, dport, 8 + payload_len, 0)
+  return ROUTER_MAC + LOCAL_MAC + struct.pack('!H', 0x0800) + ip_header + udp_header + b'\x00' * payload_len
+
+
+
+
+
+def arp_reply(sender_mac, sender_ip, target_ip):
+  """
+  Function returns Ethernet frame of an ARP reply.
+  """
+
+  arp = struct.pack('!HHBBH6s4s6s4s', 1, 0x0800, 6, 4, 2, sender_mac, socket.inet_aton(sender_ip),
+                    LOCAL_MAC, socket.inet_aton(target_ip))
+  return LOCAL_MAC + sender_mac + struct.pack('!H', 0x0806) + arp + b'\x00' * 18
+
+
+
+
+
+def test_replay_pcap(tmp_path):
+  packets = [
+    # Local host talking to two external addresses.
+    (1000.0, udp_frame('10.213.0.5', '8.8.8.8', 5353, 53, 100)),
+    (1000.5, udp_frame('8.8.8.8', '10.213.0.5', 53, 5353, 300)),
+    (1001.0, udp_frame('10.213.0.5', '1.1.1.1', 5353, 53, 10)),
+    # Local traffic is stored but not counted as talker.
+    (1001.5, udp_frame('10.213.0.5', '10.213.0.6', 1000, 2000, 50)),
+    # Multicast traffic is ignored.
+    (1002.0, udp_frame('10.213.0.5', '224.0.0.251', 5353, 5353, 50)),
+    (1002.5, arp_reply(DEVICE_MAC, '10.213.0.7', '10.213.0.1')),
+    # Flushed in the next flow interval.
+    (1012.0, udp_frame('8.8.8.8', '10.213.0.5', 53, 5353, 300)),
+  ]
+  path = tmp_path / 'capture.pcap'
+  pcap.write_pcap(str(path), packets)
+
+  db.device_state.clear()
+  db.pending_last_update.clear()
+  db_connection = db.init_database(':memory:')
+  try:
+    net_interfaces = [{'ip': '10.213.0.1/24', 'iface': 'replay0'}]
+    options = {'flow_interval': 10, 'sweep_interval': 5, 'talkers_half_life': 0, 'sample': 1}
+    runner = replay.Replay(db_connection, net_interfaces, '10.213.0.1', options)
+    runner.run(pcap.read_packets(str(path)))
+
+    stats = runner.stats
+    assert stats['packets'] == 7
+    assert stats['ipv4'] == 6
+    assert stats['arp'] == 1
+    assert stats['flushes'] == 2
+    assert stats['flows'] == 6
+    assert stats['devices'] == 1
+    assert (stats['first_ts'], stats['last_ts']) == (1000.0, 1012.0)
+
+    # Bytes are frame lengths, as captured on the interface.
+    rows = db_connection.execute("""
+      SELECT source_ip, destination_ip, proto, source_port, dest_port, bytes, packets, first_seen, last_seen
+      FROM flow_data ORDER BY first_seen, source_ip
+      """).fetchall()
+    assert rows == [
+      ('10.213.0.5', '8.8.8.8', socket.IPPROTO_UDP, 5353, 53, 142, 1, 1000000, 1000000),
+      ('8.8.8.8', '10.213.0.5', socket.IPPROTO_UDP, 53, 5353, 342, 1, 1000500, 1000500),
+      ('10.213.0.5', '1.1.1.1', socket.IPPROTO_UDP, 5353, 53, 52, 1, 1001000, 1001000),
+      ('10.213.0.5', '10.213.0.6', socket.IPPROTO_UDP, 1000, 2000, 92, 1, 1001500, 1001500),
+      ('8.8.8.8', '10.213.0.5', socket.IPPROTO_UDP, 53, 5353, 342, 1, 1012000, 1012000),
+    ]
+
+    talkers = runner.talkers.top(2, 'bytes', stats['last_ts'])
+    assert [(talker['ip'], talker['bytes'], talker['packets']) for talker in talkers] == \
+           [('8.8.8.8', 826, 3), ('1.1.1.1', 52, 1)]
+
+    devices = db_connection.execute("""SELECT mac, ip, iface, last_update FROM agent_devices""").fetchall()
+    assert devices == [('02:00:00:00:00:aa', '10.213.0.7', 'replay0', 1012000)]
+
+    latency = runner.get_latency_stats()
+    assert latency['parse']['samples'] == 7
+    assert latency['discovery']['samples'] == 1
+  finally:
+    db_connection.close()
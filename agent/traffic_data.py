@@ -19,25 +19,45 @@ import time
 import netifaces
 import traceback
 import iptc
+import iface_watcher
+import iface_rates
+import iface_stats
+import accounting
 from datetime import datetime
 
 
-def process_network_traffic_data(db_connection):
+# Devices not seen for more than this time (s) have no accounting rules. It is
+# the default of port_scanner's scan_stale option.
+DEVICE_STALE = 480
+
+
+def process_network_traffic_data(db_connection, options = None):
   """
   Function gathers given network interfaces', devices bandwidth data, and stores
   on the database.
 
   Arguments:
   - db_connection: SQLite3 database connection.
+  - options: A dictionary (e.g., command line data). Used key is scan_stale,
+    devices not seen for more than scan_stale seconds are not accounted.
   """
 
-  net_ifaces = utils.get_interfaces()
+  options = options or {}
+  stale_after = float(options.get('scan_stale') or DEVICE_STALE)
 
   # Interval in seconds
   time_interval = 5
   prev_bytes = {}
 
+  # Devices' bytes are counted by the accounting engine if iptables can be
+  # used, otherwise they are read from the hand-maintained COUNTING chain.
+  engine = accounting.start_accounting()
+
   while 1:
+    # Interface list is read from the interface table on every round, so
+    # hot-plugged interfaces are picked up.
+    net_ifaces = utils.get_interfaces()
+
     try:
       process_network_interfaces_data(db_connection, net_ifaces)
     except Exception:
@@ -45,7 +65,10 @@ def process_network_traffic_data(db_connection):
       traceback.print_exc()
 
     try:
-      prev_bytes = get_devices_bandwidth(db_connection, prev_bytes, time_interval)
+      if engine is not None:
+        prev_bytes = get_accounted_bandwidth(db_connection, engine, prev_bytes, time_interval, stale_after)
+      else:
+        prev_bytes = get_devices_bandwidth(db_connection, prev_bytes, time_interval)
     except Exception:
       utils.print_error('Getting network bandwidth data failed')
       traceback.print_exc()
@@ -60,30 +83,48 @@ def process_network_traffic_data(db_connection):
 def process_network_interfaces_data(db_connection, net_ifaces):
   """
   Function iterates over given network interfaces gets TX and RX for per-interface
-  and stores on the database.
+  and stores on the database. Addresses are read from the interface table
+  (see iface_watcher module) instead of being enumerated every round. Counters
+  of all interfaces are read in one snapshot (see iface_stats module), stored
+  with their error and FIFO error counters (see db.IFACE_ERROR_COUNTERS) and
+  also added to interfaces' rate time series (see iface_rates module).
 
   Arguments:
   - db_connection: SQLite3 database connection.
   - net_ifaces: A list of network interfaces.
   """
 
-  for iface in net_ifaces:
-    addrs = netifaces.ifaddresses(iface)
-    if (netifaces.AF_INET not in addrs) or (netifaces.AF_LINK not in addrs):
-      continue
+  table = iface_watcher.get_table()
+  iface_rates.rates.retain(net_ifaces)
+  snapshot = iface_stats.get_snapshot()
 
+  for iface in net_ifaces:
     # It is possible that network interface has two or more addresses.
     ip_list = []
-    inet_data = addrs[netifaces.AF_INET]
-    for inet in inet_data:
-      ip_list.append(inet['addr'])
+    if table is not None:
+      mac = table.get_mac(iface)
+      ip_list = [addr['addr'] for addr in table.get_addresses(iface)]
+      if not ip_list or not mac:
+        continue
+    else:
+      addrs = netifaces.ifaddresses(iface)
+      if (netifaces.AF_INET not in addrs) or (netifaces.AF_LINK not in addrs):
+        continue
+
+      inet_data = addrs[netifaces.AF_INET]
+      for inet in inet_data:
+        ip_list.append(inet['addr'])
+      mac = addrs[netifaces.AF_LINK][0]['addr']
 
     # I do this, because on the database I cannot store as a list.
     ip_list = ','.join(ip_list)
 
-    # In case get_iface_stats returns a empty dictionary that is okay.
-    iface_data = utils.get_iface_stats(iface)
-    iface_data['mac'] = addrs[netifaces.AF_LINK][0]['addr']
+    # Interface may have gone away since the interface list was read.
+    iface_data = dict(snapshot.get(iface, {}))
+    if not iface_data:
+      continue
+    iface_rates.rates.update(iface, iface_data)
+    iface_data['mac'] = mac
     iface_data['ip'] = ip_list
     iface_data['iface'] = iface
     iface_data['last_update'] = utils.get_unix_epoch_milliseconds()
@@ -94,23 +135,27 @@ def process_network_interfaces_data(db_connection, net_ifaces):
 
 
 
-def get_devices_bandwidth(db_connection, prev_bytes, time_interval):
+def get_bandwidth_ips(db_connection, stale_after = None):
   """
-  Function parses iptables data using python-iptables library. It gathers bytes,
-  source and destination IP address, calculates bandwidth data for every single
-  IP address, and returns JSON object.
+  Function returns Tuple (devices, agents) of dictionaries, where key is IPv4
+  address and value is MAC address, of the agent_devices and agent_data
+  tables.
 
   Arguments:
   - db_connection: SQLite3 database connection.
-  - prev_bytes: Previous gathered data in {<ip address>: <total bytes>} format
-  - time_interval: Data gathering time interval.
+  - stale_after: If it is given, devices whose last_update is older than
+    stale_after seconds are left out.
   """
 
-  # TODO function is not properly tested and it may need some modifications.
+  oldest = None
+  if stale_after is not None:
+    oldest = utils.get_unix_epoch_milliseconds() - stale_after * 1000
 
   db_data = {}
-  query = db.query_from_table(db_connection, 'agent_devices', ['mac', 'ip'])
+  query = db.query_from_table(db_connection, 'agent_devices', ['mac', 'ip', 'last_update'])
   for device_data in query:
+    if oldest is not None and (device_data[2] or 0) < oldest:
+      continue
     # Key is an IP and value is MAC. This is because iptables gives source IP
     # and by MAC to update database as MAC is primary key.
     key = device_data[1]
@@ -124,27 +169,25 @@ def get_devices_bandwidth(db_connection, prev_bytes, time_interval):
     key = agent_data[1]
     db_agent_data[key] = agent_data[0]
 
+  return (db_data, db_agent_data)
 
-  table = iptc.Table(iptc.Table.FILTER)
-  table.refresh()
 
-  chain_forward = iptc.Chain(table, 'COUNTING')
 
-  current_bytes = {}
-  for rule in chain_forward.rules:
-    (packets, bytes) = rule.get_counters()
-    dst = (rule.dst).split('/')[0]
-    src = (rule.src).split('/')[0]
-    if bytes:
-      total_bytes = 0
-      if src != '0.0.0.0':
-        total_bytes = total_bytes + bytes
-        current_bytes[src] = total_bytes
-      if dst != '0.0.0.0':
-        total_bytes = total_bytes + bytes
-        current_bytes[dst] = total_bytes
 
 
+def store_bandwidth(db_connection, db_data, db_agent_data, current_bytes, prev_bytes, time_interval):
+  """
+  Function calculates bandwidth (bits per second) of every IP address from its
+  total bytes now and time_interval seconds ago and stores it on the database.
+
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - db_data, db_agent_data: See get_bandwidth_ips function.
+  - current_bytes: Current data in {<ip address>: <total bytes>} format.
+  - prev_bytes: Previous gathered data in the same format.
+  - time_interval: Data gathering time interval.
+  """
+
   current_bandwidth = {}
   for ip in current_bytes:
     # Otherwise I cannot calculate bandwidth.
@@ -167,5 +210,78 @@ def get_devices_bandwidth(db_connection, prev_bytes, time_interval):
 
   db.updated_devices_bandwidth(db_connection, db_devices_bandwidth, db_agent_bandwidth)
 
+
+
+
+
+def get_accounted_bandwidth(db_connection, engine, prev_bytes, time_interval, stale_after = DEVICE_STALE):
+  """
+  Function keeps accounting rules in sync with recently seen devices and the
+  Agent's own addresses, reads all counters with one dump (see accounting
+  module), and stores bandwidth of every device on the database. Rules of
+  devices, which have not been seen for stale_after seconds, are removed.
+
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - engine: accounting.Accounting.
+  - prev_bytes: Previous gathered data in {<ip address>: <total bytes>} format
+  - time_interval: Data gathering time interval.
+  - stale_after: Time (s) after which a device which has not been seen is
+    not accounted.
+
+  Returns current data in the same format as prev_bytes.
+  """
+
+  db_data, db_agent_data = get_bandwidth_ips(db_connection, stale_after)
+  engine.sync([ip for ip in list(db_data) + list(db_agent_data) if ip])
+  totals = engine.read()
+
+  current_bytes = {}
+  for ip, total in totals.items():
+    current_bytes[ip] = total['rx_bytes'] + total['tx_bytes']
+
+  store_bandwidth(db_connection, db_data, db_agent_data, current_bytes, prev_bytes, time_interval)
+
   return current_bytes
 
+
+
+
+
+def get_devices_bandwidth(db_connection, prev_bytes, time_interval):
+  """
+  Function parses iptables data using python-iptables library. It gathers bytes,
+  source and destination IP address, calculates bandwidth data for every single
+  IP address, and returns JSON object. It is used if the accounting engine
+  (see accounting module) cannot be started.
+
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - prev_bytes: Previous gathered data in {<ip address>: <total bytes>} format
+  - time_interval: Data gathering time interval.
+  """
+
+  # TODO function is not properly tested and it may need some modifications.
+
+  db_data, db_agent_data = get_bandwidth_ips(db_connection)
+
+  table = iptc.Table(iptc.Table.FILTER)
+  table.refresh()
+
+  chain_forward = iptc.Chain(table, 'COUNTING')
+
+  current_bytes = {}
+  for rule in chain_forward.rules:
+    (packets, bytes) = rule.get_counters()
+    dst = (rule.dst).split('/')[0]
+    src = (rule.src).split('/')[0]
+    if bytes:
+      # An address may match several rules, its bytes are summed up.
+      if src != '0.0.0.0':
+        current_bytes[src] = current_bytes.get(src, 0) + bytes
+      if dst != '0.0.0.0':
+        current_bytes[dst] = current_bytes.get(dst, 0) + bytes
+
+  store_bandwidth(db_connection, db_data, db_agent_data, current_bytes, prev_bytes, time_interval)
+
+  return current_bytes
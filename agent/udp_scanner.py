@@ -0,0 +1,489 @@
+"""
+Module Name:
+  udp_scanner.py
+
+
+Description:
+  Module provides an asynchronous UDP port prober. Every probe carries a
+  payload the service behind the port is expected to answer (DNS, NTP, SNMP,
+  Modbus, BACnet, ...), all probes are sent from one UDP socket and replies
+  are matched by source address and port. ICMP port unreachable messages are
+  read on a raw socket (root only), so closed ports are classified as soon as
+  the device answers instead of after a timeout. The number of probes in
+  flight is bounded globally and probes to one device are rate limited, as
+  devices rate limit their ICMP errors.
+
+
+Authors:
+  Columbia University, the Internet Real-Time Lab (IRT Lab). 2018-2019.
+
+"""
+
+
+import asyncio
+import collections
+import socket
+import struct
+import traceback
+
+import arp_engine
+import db
+import governor
+import resolver
+import tcp_scanner
+
+
+# Port states.
+PORT_OPEN = 'open'
+PORT_CLOSED = 'closed'
+PORT_FILTERED = 'filtered'
+# No reply at all, port is either open (service ignored the payload) or
+# filtered.
+PORT_OPEN_FILTERED = 'open|filtered'
+
+ICMP_DEST_UNREACH = 3
+ICMP_PORT_UNREACH = 3
+
+# Classic BPF instructions as (code, jt, jf, k), see arp_engine module.
+BPF_LDX_B_MSH = 0xb1
+BPF_LD_B_IND = 0x50
+
+# Accept ICMP destination unreachable messages only:
+#   ldxb 4*([0]&0xf)     ; IPv4 header length
+#   ldb [x+0]            ; ICMP type
+#   jeq #3, 0, 1
+#   ret #0x40000
+#   ret #0
+ICMP_UNREACH_FILTER = [
+  (BPF_LDX_B_MSH, 0, 0, 0),
+  (BPF_LD_B_IND, 0, 0, 0),
+  (arp_engine.BPF_JEQ_K, 0, 1, ICMP_DEST_UNREACH),
+  (arp_engine.BPF_RET_K, 0, 0, 0x40000),
+  (arp_engine.BPF_RET_K, 0, 0, 0),
+]
+
+# Maximum size of a reply kept in UdpScanner.responses.
+RESPONSE_SIZE = 512
+
+
+
+
+
+def ber(tag, content):
+  """
+  Function encodes one BER (ASN.1) element.
+  """
+
+  length = len(content)
+  if length < 0x80:
+    return struct.pack('BB', tag, length) + content
+
+  size = (length.bit_length() + 7) // 8
+  return struct.pack('BB', tag, 0x80 | size) + length.to_bytes(size, 'big') + content
+
+
+
+
+
+def ber_oid(oid):
+  """
+  Function encodes object identifier, e.g., '1.3.6.1.2.1.1.1.0'.
+  """
+
+  numbers = [int(number) for number in oid.split('.')]
+  encoded = bytearray([40 * numbers[0] + numbers[1]])
+  for number in numbers[2:]:
+    chunk = [number & 0x7f]
+    number >>= 7
+    while number:
+      chunk.append(0x80 | (number & 0x7f))
+      number >>= 7
+    encoded.extend(reversed(chunk))
+
+  return ber(0x06, bytes(encoded))
+
+
+
+
+
+def snmp_get_request(community = 'public', oid = '1.3.6.1.2.1.1.1.0', request_id = 1):
+  """
+  Function builds SNMPv1 GetRequest of one object (sysDescr.0 by default).
+  """
+
+  varbind = ber(0x30, ber_oid(oid) + ber(0x05, b''))
+  pdu = ber(0xa0, ber(0x02, struct.pack('!I', request_id)) + ber(0x02, b'\x00') +
+            ber(0x02, b'\x00') + ber(0x30, varbind))
+
+  return ber(0x30, ber(0x02, b'\x00') + ber(0x04, community.encode()) + pdu)
+
+
+
+
+
+def dns_query(name, qtype, qclass = resolver.DNS_CLASS_IN, flags = 0x0100, query_id = 0x4e4d):
+  """
+  Function builds DNS query with one question.
+  """
+
+  header = resolver.DNS_HEADER.pack(query_id, flags, 1, 0, 0, 0)
+  return header + resolver.encode_name(name) + struct.pack('!HH', qtype, qclass)
+
+
+
+
+
+# Probe payloads by UDP port. Ports which are not listed get an empty
+# datagram.
+PAYLOADS = {
+  # DNS, NS query of the root zone.
+  53: resolver.DNS_HEADER.pack(0x4e4d, 0x0100, 1, 0, 0, 0) + b'\x00' + struct.pack('!HH', 2, resolver.DNS_CLASS_IN),
+  # NTP, version 3 client request.
+  123: b'\x1b' + b'\x00' * 47,
+  # NetBIOS node status request.
+  137: resolver.build_nbstat_query('', 0x4e4d),
+  # SNMPv1 GetRequest of sysDescr.0 with community 'public'.
+  161: snmp_get_request(),
+  # Modbus (MBAP over UDP), Read Device Identification of unit 0.
+  502: b'\x00\x01\x00\x00\x00\x05\x00\x2b\x0e\x01\x00',
+  # IPMI, RMCP presence ping.
+  623: b'\x06\x00\xff\x06\x00\x00\x11\xbe\x80\x00\x00\x00',
+  # MS SQL Server browser ping.
+  1434: b'\x02',
+  # SSDP discovery.
+  1900: (b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\n'
+         b'MAN: "ssdp:discover"\r\nMX: 1\r\nST: ssdp:all\r\n\r\n'),
+  # mDNS, unicast service enumeration.
+  5353: dns_query('_services._dns-sd._udp.local', 12, resolver.DNS_CLASS_IN | resolver.MDNS_CLASS_QU, 0),
+  # CoAP, GET /.well-known/core.
+  5683: b'\x40\x01\x4e\x4d\xbb.well-known\x04core',
+  # EtherNet/IP ListIdentity.
+  44818: b'\x63\x00' + b'\x00' * 22,
+  # BACnet/IP Who-Is broadcast.
+  47808: b'\x81\x0b\x00\x0c\x01\x20\xff\xff\x00\xff\x10\x08',
+}
+
+DEFAULT_PORTS = ','.join(str(port) for port in sorted(PAYLOADS))
+
+
+
+
+
+def parse_icmp_unreachable(packet):
+  """
+  Function parses ICMP destination unreachable message, which quotes a UDP
+  datagram.
+
+  Returns Tuple (ICMP code, original destination IPv4, original destination
+  port, original source port) or None.
+  """
+
+  ihl = (packet[0] & 0x0f) * 4
+  if len(packet) < ihl + 8 + 20 or packet[ihl] != ICMP_DEST_UNREACH:
+    return None
+
+  code = packet[ihl + 1]
+  inner = ihl + 8
+  inner_ihl = (packet[inner] & 0x0f) * 4
+  if packet[inner + 9] != socket.IPPROTO_UDP or len(packet) < inner + inner_ihl + 4:
+    return None
+
+  dst_ip = socket.inet_ntoa(packet[inner + 16:inner + 20])
+  src_port, dst_port = struct.unpack_from('!HH', packet, inner + inner_ihl)
+
+  return (code, dst_ip, dst_port, src_port)
+
+
+
+
+
+class UdpScanner(object):
+  """
+  Asynchronous UDP port prober.
+  """
+
+  def __init__(self, concurrency = 256, host_rate = 10, timeout = 2.0, retries = 1, payloads = None):
+    """
+    Arguments:
+    - concurrency: Maximum number of probes in flight.
+    - host_rate: Maximum number of probes per second sent to one device.
+    - timeout: Time (s) to wait for a reply before a probe is retransmitted
+      or given up.
+    - retries: Number of retransmissions of unanswered probes.
+    - payloads: Dictionary of payloads by port, PAYLOADS by default.
+    """
+
+    self.concurrency = tcp_scanner.max_concurrency(int(concurrency))
+    self.host_rate = float(host_rate or 0)
+    self.timeout = float(timeout)
+    self.retries = int(retries)
+    self.payloads = PAYLOADS if payloads is None else payloads
+
+    self.loop = None
+    self.slots = None
+    # Agent-wide packet rate governor (see governor module) or None. Only one
+    # coroutine at a time waits for it, the others queue on gate.
+    self.governor = governor.get_governor()
+    self.gate = None
+    self.sock = None
+    self.icmp_sock = None
+    self._filter = None
+    # Source port of all probes.
+    self.port = None
+    # Key is (IPv4, port) and value is [future, timer, number of sent probes].
+    self.pending = {}
+    # Key is (IPv4, port) and value is the first bytes of the reply.
+    self.responses = {}
+    self.stats = {'hosts': 0, 'probes': 0, 'open': 0, 'closed': 0, 'filtered': 0, 'open|filtered': 0}
+
+
+  def open_sockets(self):
+    """
+    Method opens the probe socket and, if permitted, the raw ICMP socket.
+    """
+
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    self.sock.bind(('', 0))
+    self.sock.setblocking(False)
+    self.port = self.sock.getsockname()[1]
+
+    try:
+      self.icmp_sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+      self._filter = arp_engine.attach_filter(self.icmp_sock, ICMP_UNREACH_FILTER)
+      self.icmp_sock.setblocking(False)
+    except OSError:
+      # Not root, closed ports are reported as open|filtered.
+      if self.icmp_sock is not None:
+        self.icmp_sock.close()
+      self.icmp_sock = None
+
+
+  def close(self):
+    for sock in (self.sock, self.icmp_sock):
+      if sock is not None:
+        self.loop.remove_reader(sock.fileno())
+        sock.close()
+    self.sock = None
+    self.icmp_sock = None
+
+
+  def finish(self, key, state):
+    probe = self.pending.pop(key, None)
+    if probe is None:
+      return
+
+    probe[1].cancel()
+    self.stats[state] += 1
+    probe[0].set_result(state)
+
+
+  def on_datagram(self):
+    while 1:
+      try:
+        data, address = self.sock.recvfrom(4096)
+      except (BlockingIOError, InterruptedError):
+        return
+      except OSError:
+        # E.g., ECONNREFUSED of an earlier datagram, not tied to a probe.
+        continue
+
+      key = (address[0], address[1])
+      if key in self.pending:
+        self.responses[key] = data[:RESPONSE_SIZE]
+        self.finish(key, PORT_OPEN)
+
+
+  def on_icmp(self):
+    while 1:
+      try:
+        packet = self.icmp_sock.recv(2048)
+      except (BlockingIOError, InterruptedError):
+        return
+
+      message = parse_icmp_unreachable(packet)
+      if message is None:
+        continue
+
+      code, ip_addr, port, src_port = message
+      if src_port != self.port:
+        continue
+
+      if code == ICMP_PORT_UNREACH:
+        self.finish((ip_addr, port), PORT_CLOSED)
+      else:
+        # Host/network unreachable or administratively prohibited.
+        self.finish((ip_addr, port), PORT_FILTERED)
+
+
+  def send(self, key):
+    probe = self.pending[key]
+    probe[2] += 1
+    self.stats['probes'] += 1
+    try:
+      self.sock.sendto(self.payloads.get(key[1], b''), key)
+    except OSError:
+      pass
+    probe[1] = self.loop.call_later(self.timeout, self.expire, key)
+
+
+  def probe_size(self, port):
+    return governor.UDP_HEADERS_SIZE + len(self.payloads.get(port, b''))
+
+
+  def expire(self, key):
+    probe = self.pending.get(key)
+    if probe is None:
+      return
+
+    if probe[2] <= self.retries:
+      if self.governor is not None and not self.governor.take(self.governor.get_iface(key[0]), 1,
+                                                               self.probe_size(key[1]), governor.PRIORITY_SCAN):
+        # No budget left for the retransmission, try again shortly.
+        probe[1] = self.loop.call_later(governor.WAIT_INTERVAL, self.expire, key)
+        return
+      self.send(key)
+    else:
+      self.finish(key, PORT_OPEN_FILTERED)
+
+
+  def start_probe(self, ip_addr, port):
+    """
+    Method sends probe to given port and returns a future, which is resolved
+    with port state. Probes are driven by reader callbacks and timers, no task
+    is created per probe. A probe of the same port, which is still pending,
+    is not sent again and its future is returned.
+    """
+
+    probe = self.pending.get((ip_addr, port))
+    if probe is not None:
+      return probe[0]
+
+    future = self.loop.create_future()
+    self.pending[(ip_addr, port)] = [future, None, 0]
+    self.send((ip_addr, port))
+
+    return future
+
+
+  async def scan_host(self, ip_addr, ports):
+    """
+    Method probes given ports of one device, at most host_rate probes per
+    second.
+
+    Returns a dictionary of port states by port.
+    """
+
+    interval = 1.0 / self.host_rate if self.host_rate else 0
+    iface = self.governor.get_iface(ip_addr) if self.governor else None
+    futures = []
+    for port in ports:
+      if self.governor is not None:
+        async with self.gate:
+          await self.governor.wait(iface, 1, self.probe_size(port), governor.PRIORITY_SCAN)
+      await self.slots.acquire()
+      future = self.start_probe(ip_addr, port)
+      future.add_done_callback(lambda f: self.slots.release())
+      futures.append(future)
+      if interval:
+        await asyncio.sleep(interval)
+
+    states = await asyncio.gather(*futures)
+    self.stats['hosts'] += 1
+
+    return dict(zip(ports, states))
+
+
+  async def scan(self, devices, ports, on_result):
+    """
+    Method probes given ports of all devices.
+
+    Arguments:
+    - devices: A list of (MAC address, IPv4 address) tuples.
+    - ports: Port set, see tcp_scanner.parse_ports function.
+    - on_result: Function called with (MAC address, IPv4 address, dictionary
+      of port states) as soon as a device is scanned. Every address is probed
+      once, devices sharing it (e.g., a reused DHCP lease) get the same
+      result.
+    """
+
+    self.loop = asyncio.get_event_loop()
+    self.slots = asyncio.Semaphore(self.concurrency)
+    self.gate = asyncio.Lock()
+    ports = tcp_scanner.parse_ports(ports)
+    if not ports or not devices:
+      return
+
+    self.open_sockets()
+    self.loop.add_reader(self.sock.fileno(), self.on_datagram)
+    if self.icmp_sock is not None:
+      self.loop.add_reader(self.icmp_sock.fileno(), self.on_icmp)
+
+    # Key is IPv4 address and value is a list of MAC addresses.
+    macs = collections.OrderedDict()
+    for device_mac, device_ip in devices:
+      macs.setdefault(device_ip, []).append(device_mac)
+    pending = iter(macs.items())
+
+    async def worker():
+      for device_ip, device_macs in pending:
+        try:
+          states = await self.scan_host(device_ip, ports)
+          for device_mac in device_macs:
+            on_result(device_mac, device_ip, states)
+        except Exception:
+          traceback.print_exc()
+
+    # Rate limited devices spend most of the time waiting, so many devices
+    # are probed at the same time.
+    try:
+      await asyncio.gather(*[worker() for i in range(min(self.concurrency, len(macs)))])
+    finally:
+      self.close()
+
+
+  def run(self, devices, ports, on_result):
+    """
+    Method runs scan on a new event loop in the calling thread and returns
+    when all devices are scanned.
+    """
+
+    loop = asyncio.new_event_loop()
+    try:
+      asyncio.set_event_loop(loop)
+      loop.run_until_complete(self.scan(list(devices), ports, on_result))
+    finally:
+      asyncio.set_event_loop(None)
+      loop.close()
+
+
+
+
+
+def scan_devices(db_connection, devices, ports, options = None):
+  """
+  Function probes UDP ports of given devices and stores every device's open
+  ports (ports which replied) on the database as soon as it is scanned.
+
+  Arguments:
+  - db_connection: SQLite3 database connection.
+  - devices: A list of (MAC address, IPv4 address) tuples.
+  - ports: Port set, see tcp_scanner.parse_ports function.
+  - options: A dictionary (e.g., command line data). Used keys are
+    udp_concurrency, udp_host_rate, udp_timeout and udp_retries.
+
+  Returns the scanner, its stats attribute contains counters of the scan.
+  """
+
+  options = options or {}
+  scanner = UdpScanner(options.get('udp_concurrency') or 256,
+                       options.get('udp_host_rate') or 10,
+                       options.get('udp_timeout') or 2.0,
+                       options.get('udp_retries', 1))
+
+  def store(device_mac, device_ip, states):
+    open_ports = sorted(port for port, state in states.items() if state == PORT_OPEN)
+    db.insert_port_data(db_connection, device_mac, device_ip, open_ports, 'udp')
+
+  scanner.run(devices, ports, store)
+  return scanner
@@ -21,7 +21,9 @@ import uuid
 import json
 import socket
 import hashlib
+import ipaddress
 import traceback
+import iface_watcher
 from datetime import datetime
 
 
@@ -211,6 +213,13 @@ def getNetworkPrefixOfIP(net_interface_ip):
   Arguments:
   - net_interface_ip: An IP address
   """
+
+  # Look up in-memory interface table kept by iface_watcher module, it falls
+  # back to enumerating every adapter only if rtnetlink is not available.
+  table = iface_watcher.get_table()
+  if table is not None:
+    return table.get_prefix_of_ip(net_interface_ip)
+
   adapters = ifaddr.get_adapters()
   for adapter in adapters:
     for ip in adapter.ips:
@@ -223,65 +232,32 @@ def getNetworkPrefixOfIP(net_interface_ip):
 
 
 
-def get_iface_stats(iface):
+def get_iface_subnet(iface):
   """
-  Function reads RX and TX data (statistics) from system files for given network
-  interface and returns as a dictionary.
-
-  Note that this works only for unix based systems.
+  Function returns Tuple (IPv4 address, ipaddress.IPv4Network) of the first
+  IPv4 address of given network interface. Address is read from the
+  interface table (see iface_watcher module) or, if it is not available, from
+  netifaces.
 
   Arguments:
   - iface: Network interface name.
 
-  Returns a dictionary and format is
-       {
-        'tx_bytes': <number>,
-        'tx_packets': <number>,
-        'tx_dropped': <number>,
-        'rx_bytes': <number>,
-        'rx_packets': <number>,
-        'rx_dropped': <number>
-       }
-
-  If an eception occurred, then function returns an empty dictionary.
+  Raises an exception if interface has no IPv4 address.
   """
 
-  base_path = '/sys/class/net/' + str(iface) + '/statistics/'
-  iface_statistics = {}
-
-  try:
-    # RX statistics.
-    rx_bytes_file = base_path + 'rx_bytes'
-    with open(rx_bytes_file, 'r') as file_:
-      iface_statistics['rx_bytes'] = int(file_.read())
-
-    rx_packets_file = base_path + 'rx_packets'
-    with open(rx_packets_file, 'r') as file_:
-      iface_statistics['rx_packets'] = int(file_.read())
-
-    rx_dropped_file = base_path + 'rx_dropped'
-    with open(rx_dropped_file, 'r') as file_:
-      iface_statistics['rx_dropped'] = int(file_.read())
-
-
-    # TX statistics.
-    tx_bytes_file = base_path + 'tx_bytes'
-    with open(tx_bytes_file, 'r') as file_:
-      iface_statistics['tx_bytes'] = int(file_.read())
-
-    tx_packets_file = base_path + 'tx_packets'
-    with open(tx_packets_file, 'r') as file_:
-      iface_statistics['tx_packets'] = int(file_.read())
-
-    tx_dropped_file = base_path + 'tx_dropped'
-    with open(tx_dropped_file, 'r') as file_:
-      iface_statistics['tx_dropped'] = int(file_.read())
-
-  except:
-    traceback.print_exc()
-    return {}
+  table = iface_watcher.get_table()
+  if table is not None:
+    addrs = table.get_addresses(iface)
+    if not addrs:
+      raise ValueError('%s has no IPv4 address' % iface)
+    my_ip = addrs[0]['addr']
+    subnet = ipaddress.IPv4Network('%s/%d' % (my_ip, addrs[0]['prefixlen']), strict = False)
+  else:
+    cfg = netifaces.ifaddresses(iface)[netifaces.AF_INET][0]
+    my_ip = cfg['addr']
+    subnet = ipaddress.IPv4Network('%s/%s' % (my_ip, cfg['netmask']), strict = False)
 
-  return iface_statistics
+  return (my_ip, subnet)
 
 
 
@@ -290,8 +266,14 @@ def get_iface_stats(iface):
 def get_interfaces():
   """
   Function returns all, besides local, network interfaces of th current device.
+  Interfaces are read from the interface table (see iface_watcher module), so
+  hot-plugged interfaces are included.
   """
 
+  table = iface_watcher.get_table()
+  if table is not None:
+    return table.get_interfaces()
+
   try:
     net_ifaces = netifaces.interfaces()
     net_ifaces.remove('lo')
@@ -96,41 +96,55 @@ function ProcessDisconnection(db, agent) {
 
 
 
-function UpdateDevicesData(agent_devices, ws_data, vlan_name) {
-  const UpdateDeviceCurrentData = function (current_data, websocket_data) {
-    // TODO Notify if an IP, MAC or hostname have been changed.
-    current_data.ip = String(websocket_data.ip);
-    current_data.hostname = String(websocket_data.hostname);
-    if (!websocket_data.hostname) {
-      current_data.hostname = websocket_data.ip;
-    }
+// Function returns dotted path of a visible device's field, e.g.,
+// 'visible_devices.aa:bb:cc:dd:ee:ff.ip', or null if MAC cannot be used in a
+// path. Devices are updated field by field, so concurrent updates of an
+// agent's devices (devices_data, port_events and devices_seen messages of the
+// same round) do not overwrite each other.
+function DevicePath(mac, field) {
+  mac = String(mac);
+  if (!mac || mac.includes('.') || mac.startsWith('$')) {
+    return null;
+  }
 
-    current_data.bandwidth = Number(websocket_data.bandwidth);
-    if (!current_data.bandwidth) {
-      current_data.bandwidth = 0;
-    }
+  if (field) {
+    return 'visible_devices.' + mac + '.' + field;
+  }
+
+  return 'visible_devices.' + mac;
+}
 
-    current_data.iface = String(websocket_data.iface);
-    current_data.last_update = Number(websocket_data.last_update);
-    current_data.open_tcp_ports = String(websocket_data.open_tcp_ports);
-    current_data.last_tcp_update = Number(websocket_data.last_tcp_update);
-    current_data.open_udp_ports = String(websocket_data.open_udp_ports);
-    current_data.last_udp_update = Number(websocket_data.last_udp_update);
 
-    return current_data;
-  };
 
+// Function returns a $set update of visible devices' fields. New devices are
+// set as a whole, only received fields of known devices are set.
+function UpdateDevicesData(agent_devices, ws_data, vlan_name) {
+  const update = {};
 
   for (let [mac, data] of Object.entries(ws_data)) {
     mac = String(mac);
-    if (utils.HasKey(agent_devices, mac)) {
-      agent_devices[mac] = UpdateDeviceCurrentData(agent_devices[mac], data);
-    } else {
-      agent_devices[mac] = schemas.getDeviceSchema(mac, data, vlan_name);
+    if (DevicePath(mac) === null) {
+      continue;
     }
+
+    if (!utils.HasKey(agent_devices, mac)) {
+      update[DevicePath(mac)] = schemas.getDeviceSchema(mac, data, vlan_name);
+      continue;
+    }
+
+    // TODO Notify if an IP, MAC or hostname have been changed.
+    update[DevicePath(mac, 'ip')] = String(data.ip);
+    update[DevicePath(mac, 'hostname')] = data.hostname ? String(data.hostname) : String(data.ip);
+    update[DevicePath(mac, 'bandwidth')] = Number(data.bandwidth) || 0;
+    update[DevicePath(mac, 'iface')] = String(data.iface);
+    update[DevicePath(mac, 'last_update')] = Number(data.last_update);
+    update[DevicePath(mac, 'open_tcp_ports')] = String(data.open_tcp_ports);
+    update[DevicePath(mac, 'last_tcp_update')] = Number(data.last_tcp_update);
+    update[DevicePath(mac, 'open_udp_ports')] = String(data.open_udp_ports);
+    update[DevicePath(mac, 'last_udp_update')] = Number(data.last_udp_update);
   }
 
-  return agent_devices;
+  return update;
 }
 
 
@@ -141,12 +155,8 @@ function ProcessDevicesData(db, ws_data, vlan_name) {
 
   agents_col.findOne(query, (error, result) => {
     if (!error && result) {
-      const current_devices = result.visible_devices;
-      const updated_data = UpdateDevicesData(current_devices, ws_data.data, vlan_name);
-
-      const update = {};
+      const update = UpdateDevicesData(result.visible_devices || {}, ws_data.data, vlan_name);
       update['last_update'] = (new Date()).getTime();
-      update['visible_devices'] = updated_data;
       update['bandwidth'] = ws_data.agent_bandwidth || 0;
       agents_col.updateOne(query, {$set: update}, (error) => {
         if (error) {
@@ -165,6 +175,131 @@ function ProcessDevicesData(db, ws_data, vlan_name) {
 
 
 
+// Function applies port change events of an agent to its visible devices.
+// Event format is {mac, ip, proto: 'tcp' or 'udp', port, state: 'open' or
+// 'closed', ts}, open ports of a device are a comma separated string.
+function ProcessPortEvents(db, ws_data) {
+  const agents_col = db.collection(constants.agents_col);
+  const query = {_id: ws_data.agent_id};
+
+  agents_col.findOne(query, (error, result) => {
+    if (!error && result) {
+      const devices = result.visible_devices || {};
+      // Key is dotted path of a device's ports field and value is a set of
+      // open ports.
+      const open_ports = {};
+      const update = {};
+      for (let i = 0; i < ws_data.data.length; i++) {
+        const event = ws_data.data[i];
+        const mac = String(event.mac);
+        if (!utils.HasKey(devices, mac) || DevicePath(mac) === null ||
+            (event.proto !== 'tcp' && event.proto !== 'udp')) {
+          continue;
+        }
+
+        const ports_key = 'open_' + event.proto + '_ports';
+        const path = DevicePath(mac, ports_key);
+        if (!utils.HasKey(open_ports, path)) {
+          open_ports[path] = new Set(String(devices[mac][ports_key] || '').split(',').filter(
+            (port) => port !== '' && port !== 'null'));
+        }
+        if (event.state === 'open') {
+          open_ports[path].add(String(event.port));
+        } else {
+          open_ports[path].delete(String(event.port));
+        }
+
+        update[DevicePath(mac, 'last_' + event.proto + '_update')] = Number(event.ts);
+      }
+
+      for (const [path, ports] of Object.entries(open_ports)) {
+        update[path] = Array.from(ports).sort((a, b) => Number(a) - Number(b)).join(',');
+      }
+
+      update['last_update'] = (new Date()).getTime();
+      agents_col.updateOne(query, {$set: update}, (error) => {
+        if (error) {
+          console.error(error.message);
+        }
+      });
+    } else if (error) {
+      console.error(error.message);
+    }
+  });
+}
+
+
+
+// Function updates last_update of visible devices, which have been seen but
+// did not change otherwise. Data format is {<MAC>: <last_update>}.
+function ProcessDevicesSeen(db, ws_data) {
+  const agents_col = db.collection(constants.agents_col);
+  const query = {_id: ws_data.agent_id};
+
+  agents_col.findOne(query, (error, result) => {
+    if (!error && result) {
+      const devices = result.visible_devices || {};
+      const update = {};
+      for (const [mac, last_update] of Object.entries(ws_data.data)) {
+        // Unknown devices are skipped, a partial device must not be created.
+        if (utils.HasKey(devices, mac) && DevicePath(mac) !== null) {
+          update[DevicePath(mac, 'last_update')] = Number(last_update);
+        }
+      }
+
+      update['last_update'] = (new Date()).getTime();
+      agents_col.updateOne(query, {$set: update}, (error) => {
+        if (error) {
+          console.error(error.message);
+        }
+      });
+    } else if (error) {
+      console.error(error.message);
+    }
+  });
+}
+
+
+
+// Function stores the top external talkers of an agent, see the agent's
+// heavy_hitters module. Data format is {by_bytes: [...], by_packets: [...]},
+// where every element is {ip, bytes, packets, bytes_error, packets_error}.
+// Counts are decayed sums, a count is null if the talker is not tracked by
+// the other summary.
+function ProcessIpTraffic(db, ws_data) {
+  const ConvertTalkers = function (talkers) {
+    if (!Array.isArray(talkers)) {
+      return [];
+    }
+
+    const NumberOrNull = (value) => (value === null || value === undefined ? null : Number(value));
+    return talkers.map((talker) => ({
+      ip: String(talker.ip),
+      bytes: NumberOrNull(talker.bytes),
+      packets: NumberOrNull(talker.packets),
+      bytes_error: NumberOrNull(talker.bytes_error),
+      packets_error: NumberOrNull(talker.packets_error)
+    }));
+  };
+
+  const agents_col = db.collection(constants.agents_col);
+  const query = {_id: ws_data.agent_id};
+  const update = {};
+  update['last_update'] = (new Date()).getTime();
+  update['top_talkers'] = {
+    by_bytes: ConvertTalkers(ws_data.data.by_bytes),
+    by_packets: ConvertTalkers(ws_data.data.by_packets),
+    last_update: update['last_update']
+  };
+  agents_col.updateOne(query, {$set: update}, (error) => {
+    if (error) {
+      console.error(error.message);
+    }
+  });
+}
+
+
+
 function UpdateInterfaceData(db, agent_id, ws_data, vlan_name, callback) {
   const ifaces_data_col = db.collection(constants.ifaces_data_col);
   const query = {_id: agent_id};
@@ -452,6 +587,23 @@ function ProcessWebsocketData(db, ws_data, vlan_name) {
       break;
     }
 
+    case 'port_events': {
+      if (Array.isArray(ws_data.data)) {
+        ProcessPortEvents(db, ws_data);
+      }
+      break;
+    }
+
+    case 'devices_seen': {
+      ProcessDevicesSeen(db, ws_data);
+      break;
+    }
+
+    case 'ip_traffic': {
+      ProcessIpTraffic(db, ws_data);
+      break;
+    }
+
     default: {
       const msg = 'Skip';
     }